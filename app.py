@@ -4,17 +4,13 @@
 # to do list @ bottom, we can add more tabs to app if we have time!
 
 from flask import Flask, render_template_string, request, jsonify
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from sentence_transformers import SentenceTransformer
-import numpy as np
-import pandas as pd
 from chat.rag import WomensHealthRAG
 from back.nutrition_engine import SymptomNutritionEngine
 from back.nutrition_api import nutrition_bp
 from chat.find_a_provider import ProviderSearcher
-from flask import Flask, render_template, render_template_string, request, jsonify
+from flask import Flask, render_template, render_template_string, request, jsonify, Response, stream_with_context
 import time
+import os
 
 import json
 
@@ -4072,11 +4068,55 @@ print("=" * 60)
 
 print("Initializing RAG")
 rag = WomensHealthRAG(
-    knowledge_base_path="./chat/data.csv",
-    generation_model_path="./chat/fine-tune-attempts/distilgpt2-finetuned" 
+    # prebuilt kb from `python -m chat.build_kb` if there is one, otherwise the csv
+    knowledge_base_path="./chat/kb" if os.path.isdir("./chat/kb") else "./chat/data.csv",
+    generation_model_path="./chat/fine-tune-attempts/distilgpt2-finetuned",
+    # distilgpt2 decodes in 2 worker processes so slow generations don't tie up
+    # flask threads; past 16 queued or 20s the reply falls back to the direct answer
+    generation_workers=2,
+    generation_queue_size=16,
+    generation_timeout=20.0
 )
+# partner clinics' kbs: ./chat/namespaces/<name>/kb (built artifact) or .../data.csv,
+# served in this process with the same embedder and distilgpt2, picked per request
+# with {"namespace": ...} or the X-KB-Namespace header
+NAMESPACES_DIR = "./chat/namespaces"
+if os.path.isdir(NAMESPACES_DIR):
+    for name in sorted(os.listdir(NAMESPACES_DIR)):
+        kb_dir = os.path.join(NAMESPACES_DIR, name)
+        for kb_path in (os.path.join(kb_dir, "kb"), os.path.join(kb_dir, "data.csv")):
+            if os.path.exists(kb_path):
+                rag.add_namespace(name, kb_path)
+                break
+for kb_namespace in rag.namespaces.values():
+    # concurrent /api/chatbot requests share one embedder call
+    kb_namespace.enable_micro_batching(max_batch=32, max_wait_ms=5)
+    # pick up edits to data.csv (and feedback from other workers) without a restart
+    kb_namespace.start_watcher(interval=5.0)
 print("=" * 60)
 
+
+def namespace_for(data):
+    """The rag namespace a chatbot request asks for (JSON/query 'namespace' field, then
+    the X-KB-Namespace header), the default kb when neither is set. KeyError if unknown."""
+    name = (data.get("namespace") if data else None) or request.headers.get("X-KB-Namespace")
+    return rag.namespace(name or None)
+
+
+def max_tokens_for(data):
+    """The optional 'max_tokens' of a chatbot request as a positive int (None if not
+    given). ValueError for anything else, the rag caps it at max_new_tokens."""
+    value = data.get("max_tokens") if data else None
+    if value is None or value == "":
+        return None
+    # bools are ints in python, "true" isn't a token count either
+    if isinstance(value, bool) or not (isinstance(value, int) or str(value).strip().isdigit()):
+        raise ValueError("max_tokens must be a positive integer")
+    value = int(value)
+    if value < 1:
+        raise ValueError("max_tokens must be a positive integer")
+    return value
+
 # routes
 @app.route('/')
 def home():
@@ -4531,12 +4571,16 @@ def exercise_page():
 
 @app.route('/api/model/status', methods=['GET'])
 def model_status():
-    """Return whether a local model is available and where it's loaded from."""
+    """Return whether the generation model is loaded and where it's loaded from."""
     try:
-        from chat.rag import get_rag
-        rag = get_rag()
-        loaded = rag.is_ready()
-        return {"status": "success", "model_loaded": bool(loaded), "local_path": getattr(rag, 'model_path', None)}
+        status = rag.generator_status()
+        return {
+            "status": "success",
+            "model_loaded": status['ready'],
+            "state": status['state'],
+            "local_path": status['model_path'],
+            "generator": status
+        }
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
@@ -4552,12 +4596,10 @@ def model_generate():
         prompt = ''
 
     try:
-        from chat.rag import get_rag
-        rag = get_rag()
-        ok = rag.load()
-        if not ok:
-            return {"status": "error", "message": "Model not available locally. Install transformers/torch or set LOCAL_LLM_PATH."}
-        out = rag.generate(prompt)
+        generator = rag.load_generator()
+        if generator is None:
+            return {"status": "error", "message": f"Model not available: {rag.generator_error}"}
+        out = generator.generate(prompt, max_new_tokens=rag.max_new_tokens)
         return {"status": "success", "output": out}
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -4597,26 +4639,44 @@ def chatbot():
         print(f"\n{'='*60}")
         print(f"User: {user_msg}")
         
+        try:
+            kb = namespace_for(data)
+        except KeyError as e:
+            return jsonify({"reply": "Unknown knowledge base.", "error": str(e)}), 404
+        
         if not user_msg:
             return jsonify({"reply": "Please enter a message."})
         
-        response_data = rag.generate_response_simple(
+        try:
+            max_tokens = max_tokens_for(data)
+        except ValueError as e:
+            return jsonify({"reply": "Invalid request.", "error": str(e)}), 400
+        
+        # X-Debug-Timing: 1 adds per-stage timings (ms) to the response
+        debug_timing = request.headers.get('X-Debug-Timing', '').lower() in ('1', 'true')
+        
+        response_data = kb.generate_response_simple(
             user_msg,
             top_k=3,
             verbose=True,
-            similarity_threshold=0.5
+            similarity_threshold=0.5,
+            max_new_tokens=max_tokens,  # optional, capped at kb.max_new_tokens
+            timing=debug_timing
         )
         
         print(f"Assistant: {response_data['reply'][:100]}...")
         print(f"Type: {response_data['response_type']}, Needs feedback: {response_data['needs_feedback']}")
         print(f"{'='*60}\n")
         
-        return jsonify({
+        result = {
             'reply': response_data['reply'],
             'needs_feedback': response_data['needs_feedback'],
             'similarity': response_data['similarity'],
             'response_type': response_data['response_type']
-        })
+        }
+        if debug_timing:
+            result['timing'] = response_data['timing']
+        return jsonify(result)
         
     except Exception as e:
         print(f"Error: {e}")
@@ -4624,6 +4684,62 @@ def chatbot():
         traceback.print_exc()
         return jsonify({"reply": "Sorry, I encountered an error."}), 500
 
+@app.route('/api/chatbot/stream', methods=['GET', 'POST'])
+def chatbot_stream():
+    """Same as /api/chatbot but sends the reply as server-sent events while it decodes.
+    GET ?message=...&namespace=... (for EventSource) or POST {"message": ..., "namespace": ...}"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+    else:
+        data = request.args
+    user_msg = data.get("message", "")
+    regenerate = str(data.get("regenerate", "")).lower() in ("1", "true")
+    try:
+        kb = namespace_for(data)
+    except KeyError as e:
+        return jsonify({"reply": "Unknown knowledge base.", "error": str(e)}), 404
+    try:
+        max_tokens = max_tokens_for(data)
+    except ValueError as e:
+        return jsonify({"reply": "Invalid request.", "error": str(e)}), 400
+    
+    def events():
+        if not user_msg:
+            yield f"data: {json.dumps({'type': 'done', 'reply': 'Please enter a message.', 'needs_feedback': False})}\n\n"
+            return
+        try:
+            for event in kb.stream_response(user_msg, top_k=3, similarity_threshold=0.5,
+                                             regenerate=regenerate, max_new_tokens=max_tokens):
+                yield f"data: {json.dumps(event)}\n\n"
+                if event['type'] == 'done':
+                    print(f"Streamed {event['response_type']} reply, "
+                          f"ttft {event['ttft_ms']:.0f}ms, total {event['total_ms']:.0f}ms")
+        except Exception as e:
+            print(f"Error in streaming chatbot endpoint: {e}")
+            import traceback
+            traceback.print_exc()
+            yield f"data: {json.dumps({'type': 'error', 'reply': 'Sorry, I encountered an error.'})}\n\n"
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/chatbot/stats', methods=['GET'])
+def chatbot_stats():
+    """Cache hit/miss counters and kb size for the chatbot (?namespace=... for another kb)"""
+    try:
+        kb = namespace_for(request.args)
+    except KeyError as e:
+        return jsonify({"status": "error", "message": str(e)}), 404
+    return jsonify({"status": "success", "stats": kb.stats()})
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Latency histograms (ms) for each stage of the chatbot pipeline"""
+    return jsonify({"status": "success", "metrics": rag.metrics.snapshot()})
+
 @app.route('/api/chatbot/feedback', methods=['POST'])
 def chatbot_feedback():
     """Handle thumbs up/down feedback"""
@@ -4638,8 +4754,14 @@ def chatbot_feedback():
         print(f"Q: {question}")
         print(f"A: {answer[:100]}...")
         
+        # feedback goes to the journal of the kb that answered
+        try:
+            kb = namespace_for(data)
+        except KeyError as e:
+            return jsonify({'success': False, 'message': str(e)}), 404
+        
         if feedback == 'up':
-            success = rag.add_to_dataset(question, answer)
+            success = kb.add_to_dataset(question, answer)
             if success:
                 return jsonify({
                     'success': True,
@@ -4653,7 +4775,7 @@ def chatbot_feedback():
                 
         elif feedback == 'down':
             print("Regenerating response")
-            response_data = rag.generate_response_simple(
+            response_data = kb.generate_response_simple(
                 question,
                 top_k=3,
                 verbose=True,
@@ -4736,4 +4858,9 @@ if __name__ == '__main__':
     print("\nStarting Flask server on http://localhost:5001")
     print("Chat interface ready!")
     print("=" * 60)
-    app.run(debug=True, host='0.0.0.0', port=5001)
+    debug = True
+    # load distilgpt2 in the background while the server comes up, direct answers are
+    # served meanwhile. with the debug reloader only the serving child process needs it
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        rag.warm_generator()
+    app.run(debug=debug, host='0.0.0.0', port=5001)
@@ -0,0 +1,274 @@
+# chat/ann_index.py
+# nearest-neighbour index layer for the rag knowledge base
+# brute force is the default and is exact. ivf clusters the kb with spherical k-means
+# and only scores the rows in the nprobe closest clusters, which is what we need once
+# the kb gets to pubmed size. both read vectors straight from the kb GrowableMatrix,
+# the index itself only keeps ids (+ centroids for ivf).
+#
+# knobs (pass as index_params to WomensHealthRAG):
+#   ivf: nlist     number of clusters (default ~4*sqrt(n))
+#        nprobe    clusters scanned per query, higher = better recall, slower
+#        iters     k-means iterations when building
+#        min_rows  below this many rows ivf just scans everything
+
+import hashlib
+import json
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from chat.fileio import atomic_write
+from chat.vectors import GrowableMatrix, normalize, top_k
+
+
+def kb_fingerprint(keys: List[str], rows: int) -> str:
+    """Identifies the first `rows` kb rows (by text hash), saved with an index so it's
+    only reused for the kb it was built from."""
+    return hashlib.sha1("".join(keys[:rows]).encode('ascii')).hexdigest()
+
+
+class BruteForceIndex:
+    kind = 'brute'
+
+    def __init__(self, matrix: GrowableMatrix, **params):
+        self.matrix = matrix
+        self.params = params
+
+    def build(self):
+        pass
+
+    def clone(self, matrix: GrowableMatrix):
+        return BruteForceIndex(matrix, **self.params)
+
+    def add(self, ids: np.ndarray):
+        # vectors are already in the shared matrix, nothing else to track
+        pass
+
+    def truncate(self, rows: int):
+        pass
+
+    def search(self, queries: np.ndarray, k: int, limit: int = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Top-k (ids, scores) per query, only over the first `limit` rows if given.
+        Queries must already be normalized."""
+        scores = self.matrix.scores(queries, limit)
+        results = []
+        for query, row in zip(np.atleast_2d(queries), scores):
+            ids = top_k(row, self.matrix.candidates(k))
+            results.append(self.matrix.refine(query, ids, row[ids], k))
+        return results
+
+    def state(self) -> Dict:
+        return {}
+
+    def save(self, path: str, fingerprint: str):
+        pass
+
+    def load(self, path: str) -> Tuple[int, str]:
+        return 0, None
+
+
+class _IdList:
+    """Growable int64 array for one inverted list."""
+
+    def __init__(self, ids: np.ndarray = None):
+        ids = np.empty(0, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        self._buf = np.empty(max(len(ids), 8), dtype=np.int64)
+        self._buf[:len(ids)] = ids
+        self.size = len(ids)
+
+    @property
+    def view(self) -> np.ndarray:
+        return self._buf[:self.size]
+
+    def append(self, idx: int):
+        if self.size == len(self._buf):
+            buf = np.empty(2 * len(self._buf), dtype=np.int64)
+            buf[:self.size] = self._buf[:self.size]
+            self._buf = buf
+        self._buf[self.size] = idx
+        self.size += 1
+
+    def truncate(self, size: int):
+        self.size = min(self.size, size)
+
+
+def spherical_kmeans(vectors: np.ndarray, k: int, iters: int = 10,
+                     seed: int = 0) -> np.ndarray:
+    """Cluster normalized vectors by cosine, returns normalized centroids (k, dim)."""
+    rng = np.random.default_rng(seed)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+
+    for _ in range(iters):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=k)
+        # re-seed empty clusters with random points so nlist stays what was asked for
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))]
+        centroids = normalize(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    kind = 'ivf'
+
+    def __init__(self, matrix: GrowableMatrix, nlist: int = None, nprobe: int = 8,
+                 iters: int = 10, min_rows: int = 5000, train_size: int = 100000, seed: int = 0):
+        self.matrix = matrix
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iters = iters
+        self.min_rows = min_rows
+        self.train_size = train_size
+        self.seed = seed
+        # (centroids, inverted lists), or None until trained. readers don't lock, so a
+        # (re)build makes both off to the side and publishes them in one assignment
+        self._trained: Tuple[np.ndarray, List[_IdList]] = None
+
+    @property
+    def trained(self) -> bool:
+        return self._trained is not None
+
+    @property
+    def centroids(self) -> np.ndarray:
+        return None if self._trained is None else self._trained[0]
+
+    @property
+    def lists(self) -> List[_IdList]:
+        return [] if self._trained is None else self._trained[1]
+
+    def build(self):
+        vectors = self.matrix.rows(slice(None))
+        if len(vectors) < self.min_rows:
+            self._trained = None
+            return
+
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(vectors))))
+        rng = np.random.default_rng(self.seed)
+        train = vectors
+        if len(vectors) > self.train_size:
+            train = vectors[rng.choice(len(vectors), size=self.train_size, replace=False)]
+
+        print(f"Building IVF index: {len(vectors)} rows, {nlist} lists")
+        centroids = spherical_kmeans(train, nlist, iters=self.iters, seed=self.seed)
+        assign = self._assign(vectors, centroids)
+        order = np.argsort(assign, kind='stable')
+        bounds = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+        self._trained = (centroids, [_IdList(order[bounds[c]:bounds[c + 1]]) for c in range(len(centroids))])
+
+    def clone(self, matrix: GrowableMatrix):
+        """Index over a different matrix, reusing the trained centroids (no k-means)."""
+        index = IVFIndex(matrix, nlist=self.nlist, nprobe=self.nprobe, iters=self.iters,
+                         min_rows=self.min_rows, train_size=self.train_size, seed=self.seed)
+        if not self.trained:
+            index.build()
+            return index
+        index._trained = (self.centroids, [_IdList() for _ in range(len(self.centroids))])
+        index.add(np.arange(len(matrix)))
+        return index
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray, block: int = 65536) -> np.ndarray:
+        out = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block):
+            out[start:start + block] = np.argmax(vectors[start:start + block] @ centroids.T, axis=1)
+        return out
+
+    def add(self, ids: np.ndarray):
+        if not self.trained:
+            # small kb, train once it's big enough to be worth it
+            if len(self.matrix) >= self.min_rows:
+                self.build()
+            return
+        centroids, lists = self._trained
+        ids = np.asarray(ids, dtype=np.int64)
+        clusters = self._assign(self.matrix.rows(ids), centroids)
+        if len(ids) > 1000:
+            # bulk insert (reloads), group by cluster instead of appending one at a time
+            order = np.argsort(clusters, kind='stable')
+            bounds = np.searchsorted(clusters[order], np.arange(len(centroids) + 1))
+            for c in np.flatnonzero(np.diff(bounds)):
+                lists[c] = _IdList(np.concatenate([lists[c].view, ids[order[bounds[c]:bounds[c + 1]]]]))
+            return
+        for idx, cluster in zip(ids, clusters):
+            lists[cluster].append(int(idx))
+
+    def truncate(self, rows: int):
+        """Forget ids >= rows (undoing a failed add), lists are in id order."""
+        trained = self._trained
+        if trained is None:
+            return
+        for ids in trained[1]:
+            ids.truncate(int(np.searchsorted(ids.view, rows)))
+
+    def search(self, queries: np.ndarray, k: int, limit: int = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        queries = np.atleast_2d(queries)
+        trained = self._trained     # read once, a concurrent build swaps the whole pair
+        if trained is None:
+            return BruteForceIndex(self.matrix).search(queries, k, limit=limit)
+
+        centroids, lists = trained
+        results = []
+        probe_scores = queries @ centroids.T
+        for q, centroid_scores in zip(queries, probe_scores):
+            probes = top_k(centroid_scores, self.nprobe)
+            candidates = np.concatenate([lists[c].view for c in probes])
+            if limit is not None:
+                # rows appended after the caller's view of the kb
+                candidates = candidates[candidates < limit]
+            scores = self.matrix.rows(candidates) @ q
+            best = top_k(scores, self.matrix.candidates(k))
+            results.append(self.matrix.refine(q, candidates[best], scores[best], k))
+        return results
+
+    def state(self) -> Dict:
+        return {
+            'nlist': 0 if self.centroids is None else len(self.centroids),
+            'nprobe': self.nprobe
+        }
+
+    def save(self, path: str, fingerprint: str):
+        if not self.trained:
+            return
+        centroids, lists = self._trained
+        lists = [l.view for l in lists]
+        atomic_write(path, lambda f: np.savez(
+            f,
+            centroids=centroids,
+            ids=np.concatenate(lists),
+            offsets=np.cumsum([0] + [len(l) for l in lists]),
+            meta=np.array(json.dumps({
+                'kind': self.kind,
+                'rows': int(sum(len(l) for l in lists)),
+                'fingerprint': fingerprint
+            }))
+        ))
+
+    def load(self, path: str) -> Tuple[int, str]:
+        """Load a saved index, returning (rows covered, fingerprint of those rows)."""
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('kind') != self.kind:
+                return 0, None
+            centroids = data['centroids']
+            ids, offsets = data['ids'], data['offsets']
+        if centroids.shape[1] != self.matrix.dim:
+            return 0, None
+        self._trained = (centroids, [_IdList(ids[offsets[c]:offsets[c + 1]]) for c in range(len(centroids))])
+        return meta['rows'], meta['fingerprint']
+
+
+INDEX_TYPES = {
+    'brute': BruteForceIndex,
+    'ivf': IVFIndex
+}
+
+
+def make_index(kind: str, matrix: GrowableMatrix, **params):
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{kind}', expected one of {list(INDEX_TYPES)}")
+    return INDEX_TYPES[kind](matrix, **params)
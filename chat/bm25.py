@@ -0,0 +1,185 @@
+# chat/bm25.py
+# in-memory inverted index with bm25 scoring over kb instructions + outputs
+# MiniLM on its own is weak on short keyword queries ("PCOS metformin"), so retrieval
+# fuses these lexical ranks with the dense ranks (reciprocal rank fusion). on big
+# kbs the lexical hits are also used as the candidate set for dense scoring.
+
+import json
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from chat.fileio import atomic_write
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'do', 'does', 'for', 'from',
+    'how', 'i', 'if', 'in', 'is', 'it', 'my', 'of', 'on', 'or', 'should', 'that', 'the',
+    'this', 'to', 'what', 'when', 'which', 'who', 'why', 'with', 'you', 'your'
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in TOKEN_RE.findall(str(text).lower()) if t not in STOPWORDS]
+
+
+class _Growable:
+    """Append-only numpy buffer; a view taken earlier never sees rows written later."""
+
+    def __init__(self, dtype, values: np.ndarray = None):
+        if values is None:
+            self._buf = np.empty(4, dtype=dtype)
+            self.size = 0
+        else:
+            self._buf = np.array(values, dtype=dtype)
+            self.size = len(self._buf)
+
+    @property
+    def view(self) -> np.ndarray:
+        return self._buf[:self.size]
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self._buf.dtype)
+        end = self.size + len(values)
+        if end > len(self._buf):
+            buf = np.empty(max(end, 2 * len(self._buf)), dtype=self._buf.dtype)
+            buf[:self.size] = self._buf[:self.size]
+            self._buf = buf
+        self._buf[self.size:end] = values
+        self.size = end
+
+    def truncate(self, size: int):
+        self.size = min(self.size, size)
+
+
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._ids: Dict[str, _Growable] = {}
+        self._tfs: Dict[str, _Growable] = {}
+        self._doc_len = _Growable(np.float32)
+        self._total_len = 0.0
+
+    def __len__(self) -> int:
+        return self._doc_len.size
+
+    def add(self, texts: List[str]):
+        """Index texts as the next doc ids, in order."""
+        start = len(self)
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        lengths = []
+        for offset, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                ids, tfs = postings.setdefault(term, ([], []))
+                ids.append(start + offset)
+                tfs.append(tf)
+
+        # postings first, then doc lengths, so a doc id is only counted once it's searchable
+        for term, (ids, tfs) in postings.items():
+            if term not in self._ids:
+                self._ids[term] = _Growable(np.int64)
+                self._tfs[term] = _Growable(np.float32)
+            self._tfs[term].extend(tfs)
+            self._ids[term].extend(ids)
+        self._total_len += sum(lengths)
+        self._doc_len.extend(lengths)
+
+    def truncate(self, n_docs: int):
+        """Forget doc ids >= n_docs (undoing a failed add), so the next add reuses them."""
+        # postings are in doc id order, ids before tfs so a posting is never half there
+        for term, ids in self._ids.items():
+            size = int(np.searchsorted(ids.view, n_docs))
+            ids.truncate(size)
+            self._tfs[term].truncate(size)
+        self._doc_len.truncate(n_docs)
+        self._total_len = float(self._doc_len.view.sum())
+
+    def save(self, path: str):
+        """Postings as flat arrays (npz), so a built kb doesn't re-tokenize at boot."""
+        terms = sorted(self._ids)
+        counts = [self._ids[t].size for t in terms]
+        atomic_write(path, lambda f: np.savez(
+            f,
+            terms=np.array(terms, dtype=str),
+            offsets=np.cumsum([0] + counts),
+            ids=np.concatenate([self._ids[t].view for t in terms]) if terms else np.empty(0, np.int64),
+            tfs=np.concatenate([self._tfs[t].view for t in terms]) if terms else np.empty(0, np.float32),
+            doc_len=self._doc_len.view,
+            meta=np.array(json.dumps({'k1': self.k1, 'b': self.b, 'total_len': self._total_len}))
+        ))
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            terms, offsets = data['terms'].tolist(), data['offsets']
+            ids, tfs, doc_len = data['ids'], data['tfs'], data['doc_len']
+        index = cls(k1=meta['k1'], b=meta['b'])
+        for i, term in enumerate(terms):
+            index._ids[term] = _Growable(np.int64, ids[offsets[i]:offsets[i + 1]])
+            index._tfs[term] = _Growable(np.float32, tfs[offsets[i]:offsets[i + 1]])
+        index._doc_len = _Growable(np.float32, doc_len)
+        index._total_len = meta['total_len']
+        return index
+
+    def _idf(self, df: int, n_docs: int) -> float:
+        return math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, k: int, limit: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Top-k docs as (ids, bm25 scores, coverage), best first.
+
+        coverage is the idf-weighted share of the query terms found in the doc (0-1),
+        which unlike raw bm25 is comparable across queries.
+        """
+        n_docs = len(self) if limit is None else min(limit, len(self))
+        terms = list(dict.fromkeys(tokenize(query)))
+        empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), np.empty(0, dtype=np.float32)
+        if not terms or n_docs == 0:
+            return empty
+
+        doc_len = self._doc_len.view
+        avgdl = max(self._total_len / max(len(doc_len), 1), 1.0)
+        all_ids, all_scores, all_idf = [], [], []
+        total_idf = 0.0
+        for term in terms:
+            ids = self._ids[term].view if term in self._ids else np.empty(0, dtype=np.int64)
+            tfs = self._tfs[term].view[:len(ids)] if term in self._tfs else np.empty(0, dtype=np.float32)
+            keep = ids < n_docs
+            ids, tfs = ids[keep], tfs[keep]
+            idf = self._idf(len(ids), n_docs)
+            total_idf += idf
+            if not len(ids):
+                continue
+            norm = self.k1 * (1.0 - self.b + self.b * doc_len[ids] / avgdl)
+            all_ids.append(ids)
+            all_scores.append(idf * tfs * (self.k1 + 1.0) / (tfs + norm))
+            all_idf.append(np.full(len(ids), idf, dtype=np.float32))
+
+        if not all_ids:
+            return empty
+
+        # sum per doc over only the docs that matched something, not the whole kb
+        docs, inverse = np.unique(np.concatenate(all_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores)).astype(np.float32)
+        coverage = np.bincount(inverse, weights=np.concatenate(all_idf)).astype(np.float32) / total_idf
+
+        k = min(k, len(docs))
+        best = np.argpartition(scores, -k)[-k:] if k < len(docs) else np.arange(len(docs))
+        best = best[np.argsort(scores[best])[::-1]]
+        return docs[best], scores[best], coverage[best]
+
+
+def reciprocal_rank_fusion(rankings: List[np.ndarray], k: int = 60) -> np.ndarray:
+    """Fuse several best-first id lists, returns ids ordered by summed 1/(k + rank)."""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking, 1):
+            fused[int(idx)] = fused.get(int(idx), 0.0) + 1.0 / (k + rank)
+    return np.array(sorted(fused, key=fused.get, reverse=True), dtype=np.int64)
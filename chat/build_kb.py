@@ -0,0 +1,164 @@
+# chat/build_kb.py
+# offline knowledge base build: parse, validate, dedupe and embed the csv once and
+# write a versioned artifact (chat/kb_artifact.py) the app opens with mmap at boot.
+# paraphrased near-duplicates are collapsed into one row + aliases (chat/near_dupes.py)
+#
+#   python -m chat.build_kb --csv ./chat/data.csv --out ./chat/kb
+#   python -m chat.build_kb --csv ./chat/data.csv --out ./chat/kb --index ivf --nlist 256
+#   python -m chat.build_kb --verify ./chat/kb
+#
+# then point the app at it: WomensHealthRAG(knowledge_base_path="./chat/kb", ...)
+# thumbs-up feedback keeps going to the journal next to the artifact (chat/kb.journal.jsonl),
+# rebuild with --journal ./chat/kb.journal.jsonl to fold it in.
+
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+from chat.ann_index import kb_fingerprint, make_index
+from chat.bm25 import BM25Index
+from chat.caches import normalize_query
+from chat.embedding_cache import EmbeddingCache, text_hash
+from chat.feedback_journal import FeedbackJournal
+from chat.kb_artifact import KBArtifact, write_artifact
+from chat.near_dupes import DUPLICATE_THRESHOLD, AliasTable, collapse
+from chat.text_store import TextStore
+from chat.vectors import GrowableMatrix, normalize
+
+
+def validate(kb: pd.DataFrame, min_chars: int = 3, max_chars: int = 20000):
+    """Drop rows that can't be served: missing columns/values, too short or too long."""
+    missing = {'instruction', 'output'} - set(kb.columns)
+    if missing:
+        raise ValueError(f"kb is missing column(s): {sorted(missing)}")
+    # an optional topic column is kept for topic shards (chat/shards.py)
+    kb = kb[[c for c in ('instruction', 'output', 'topic') if c in kb.columns]].dropna(subset=['instruction', 'output'])
+    kb = kb.assign(instruction=kb['instruction'].astype(str).str.strip(),
+                   output=kb['output'].astype(str).str.strip())
+    lengths_ok = (
+        kb['instruction'].str.len().between(min_chars, max_chars)
+        & kb['output'].str.len().between(min_chars, max_chars)
+    )
+    return kb[lengths_ok].reset_index(drop=True), int((~lengths_ok).sum())
+
+
+def dedupe(kb: pd.DataFrame):
+    """Exact duplicates after normalizing case/punctuation/whitespace, first one wins."""
+    pairs = kb['instruction'].map(normalize_query) + "\x00" + kb['output'].map(normalize_query)
+    keep = ~pairs.duplicated()
+    return kb[keep].reset_index(drop=True), int((~keep).sum())
+
+
+def build(csv_path: str, out: str, model_name: str, index: str = 'brute',
+          index_params: dict = None, journal: str = None, batch_size: int = 32,
+          duplicate_threshold: float = DUPLICATE_THRESHOLD) -> str:
+    from sentence_transformers import SentenceTransformer
+    from chat.rag import _unseen_rows, load_kb_csv
+
+    start = time.perf_counter()
+    kb = load_kb_csv(csv_path)
+    rows_read = len(kb)
+    print(f"Read {rows_read} rows from {csv_path}")
+
+    replayed = 0
+    if journal:
+        if not journal.endswith(".journal.jsonl"):
+            raise ValueError(f"{journal} doesn't look like a feedback journal (*.journal.jsonl)")
+        records = _unseen_rows(kb, FeedbackJournal(journal[:-len(".journal.jsonl")]).replay())
+        kb = pd.concat([kb, pd.DataFrame({
+            'instruction': [r['instruction'] for r in records],
+            'output': [r['output'] for r in records]
+        })], ignore_index=True)
+        replayed = len(records)
+        print(f"Added {replayed} rows from {journal}")
+
+    kb, invalid = validate(kb)
+    kb, duplicates = dedupe(kb)
+    print(f"Dropped {invalid} invalid and {duplicates} duplicate rows, {len(kb)} left")
+    if not len(kb):
+        raise ValueError("nothing left to build")
+
+    questions = kb['instruction'].tolist()
+    keys = [text_hash(q) for q in questions]
+
+    # reuse the app's embedding cache for the csv, only new/changed rows are encoded
+    cache = EmbeddingCache(csv_path, model_name)
+    embeddings = normalize(cache.encode(SentenceTransformer(model_name), questions,
+                                        batch_size=batch_size, show_progress_bar=True))
+    try:
+        cache.save()
+    except OSError as e:
+        print(f"Could not save embedding cache: {e}")
+
+    aliases = AliasTable()
+    if duplicate_threshold is not None:
+        keep, dupes, rows = collapse(embeddings, kb['output'].tolist(), threshold=duplicate_threshold)
+        aliases.add(rows, [keys[i] for i in dupes], [questions[i] for i in dupes])
+        kb, keys, embeddings = kb.iloc[keep], [keys[i] for i in keep], embeddings[keep]
+        print(f"Collapsed {len(dupes)} near-duplicate rows into aliases, {len(keys)} left")
+    texts = TextStore.from_frame(kb)
+    topics = kb['topic'].fillna('').astype(str).tolist() if 'topic' in kb.columns else None
+
+    bm25 = BM25Index()
+    bm25.add(texts.documents())
+
+    ann = None
+    if index != 'brute':
+        ann = make_index(index, GrowableMatrix(embeddings), **(index_params or {}))
+        ann.build()
+
+    path = write_artifact(
+        out, texts, keys, embeddings, model_name, bm25,
+        index=ann, fingerprint=kb_fingerprint(keys, len(keys)), aliases=aliases, topics=topics,
+        report={
+            'source': os.path.abspath(csv_path),
+            'rows_read': rows_read,
+            'journal_rows': replayed,
+            'dropped_invalid': invalid,
+            'dropped_duplicates': duplicates,
+            'near_duplicate_aliases': len(aliases),
+            'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'build_seconds': round(time.perf_counter() - start, 2)
+        }
+    )
+    print(f"Wrote {len(keys)} rows to {path} in {time.perf_counter() - start:.1f}s")
+    return path
+
+
+def main():
+    from chat.rag import EMBEDDING_MODEL
+
+    parser = argparse.ArgumentParser(description="Build the chatbot knowledge base artifact")
+    parser.add_argument("--csv", default="./chat/data.csv")
+    parser.add_argument("--out", default="./chat/kb")
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--journal", default=None, help="also include rows from this feedback journal")
+    parser.add_argument("--index", default="brute", help="brute (no index file) or ivf")
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, default=None)
+    parser.add_argument("--duplicate-threshold", type=float, default=DUPLICATE_THRESHOLD,
+                        help="question cosine above which rows with the same answer are collapsed")
+    parser.add_argument("--keep-near-duplicates", action="store_true", help="don't collapse near-duplicates")
+    parser.add_argument("--verify", metavar="ARTIFACT", default=None,
+                        help="check an existing artifact's file hashes instead of building")
+    args = parser.parse_args()
+
+    if args.verify:
+        artifact = KBArtifact(args.verify)
+        bad = artifact.verify()
+        print(f"{artifact.path}: {len(artifact)} rows, model {artifact.model}, "
+              + ("ok" if not bad else f"hash mismatch in {bad}"))
+        return 1 if bad else 0
+
+    index_params = {k: v for k, v in (('nlist', args.nlist), ('nprobe', args.nprobe)) if v is not None}
+    build(args.csv, args.out, args.model, index=args.index, index_params=index_params,
+          journal=args.journal,
+          duplicate_threshold=None if args.keep_near_duplicates else args.duplicate_threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
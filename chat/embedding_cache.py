@@ -0,0 +1,158 @@
+# chat/embedding_cache.py
+# content-addressed cache for the knowledge base embeddings
+# every row is keyed by a hash of the exact text we encoded, so booting the app
+# (or reloading the csv) only has to run the embedder on rows that are new or changed
+#
+# files live next to the kb csv:
+#   data.emb.npy       float32 matrix, one row per cached text (opened with mmap)
+#   data.emb.keys.npy  sha1 hex digest of the text for each row
+#   data.emb.json      model name + shape, cache is thrown away if the model changes
+
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from chat.fileio import atomic_write
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, knowledge_base_path: str, model_name: str):
+        base = os.path.splitext(knowledge_base_path)[0]
+        self.matrix_path = base + ".emb.npy"
+        self.keys_path = base + ".emb.keys.npy"
+        self.meta_path = base + ".emb.json"
+        self.model_name = model_name
+
+        self.dim: Optional[int] = None
+        # (memmap of the rows saved on disk, hash -> row in it), swapped as one so
+        # readers never pair a new row map with the old file
+        self._disk = (None, {})
+        self._pending: Dict[str, np.ndarray] = {}  # encoded but not saved yet
+        # encode() runs outside the rag's write lock while save() runs under it, this
+        # keeps save() from dropping vectors put after it took its copy of _pending
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not all(os.path.exists(p) for p in (self.matrix_path, self.keys_path, self.meta_path)):
+            return
+        try:
+            with open(self.meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('model') != self.model_name:
+                print(f"Embedding cache was built with {meta.get('model')}, ignoring it")
+                return
+
+            matrix = np.load(self.matrix_path, mmap_mode='r')
+            keys = np.load(self.keys_path)
+            if matrix.ndim != 2 or len(keys) != len(matrix):
+                print("Embedding cache is inconsistent, ignoring it")
+                return
+
+            self._disk = (matrix, {k.decode('ascii'): i for i, k in enumerate(keys)})
+            self.dim = matrix.shape[1]
+            print(f"   Loaded embedding cache: {len(keys)} rows")
+        except Exception as e:
+            print(f"Could not read embedding cache, rebuilding: {e}")
+            self._disk = (None, {})
+
+    @property
+    def _rows(self) -> Dict[str, int]:
+        return self._disk[1]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._pending or key in self._rows
+
+    def __len__(self) -> int:
+        return len(self._rows) + sum(1 for k in self._pending if k not in self._rows)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        pending = self._pending.get(key)
+        if pending is not None:
+            return pending
+        matrix, rows = self._disk
+        row = rows.get(key)
+        if row is None:
+            return None
+        return np.asarray(matrix[row], dtype=np.float32)
+
+    def put(self, key: str, vector: np.ndarray):
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._pending[key] = vector
+            self.dim = vector.shape[0]
+
+    def encode(self, embedder, texts: List[str], batch_size: int = 32,
+               show_progress_bar: bool = False) -> np.ndarray:
+        """Embeddings for texts, running the embedder only on cache misses."""
+        keys = [text_hash(t) for t in texts]
+        vectors = [self.get(key) for key in keys]
+
+        missing = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None and key not in missing:
+                missing[key] = text
+
+        if missing:
+            print(f"Encoding {len(missing)} new/changed rows ({len(texts) - len(missing)} cached)")
+            encoded = embedder.encode(
+                list(missing.values()),
+                show_progress_bar=show_progress_bar,
+                batch_size=batch_size
+            )
+            fresh = {}
+            for key, vector in zip(missing, encoded):
+                fresh[key] = np.asarray(vector, dtype=np.float32)
+                self.put(key, fresh[key])
+            # the vectors just computed, not read back: a save() can run in between
+            vectors = [fresh[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+
+        if not vectors:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.stack(vectors)
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending)
+
+    def save(self, keep: Optional[Iterable[str]] = None):
+        """Write the cache to disk. If keep is given, rows for other texts are dropped."""
+        with self._lock:
+            pending = dict(self._pending)
+        disk, rows = self._disk
+        if keep is None:
+            keys = list(rows) + [k for k in pending if k not in rows]
+        else:
+            keys = [k for k in dict.fromkeys(keep) if k in pending or k in rows]
+
+        if not pending and len(keys) == len(rows):
+            return
+
+        matrix = np.empty((len(keys), self.dim or 0), dtype=np.float32)
+        for i, key in enumerate(keys):
+            matrix[i] = pending[key] if key in pending else disk[rows[key]]
+
+        atomic_write(self.matrix_path, lambda f: np.save(f, matrix))
+        atomic_write(self.keys_path, lambda f: np.save(f, np.array(keys, dtype='S40')))
+        atomic_write(self.meta_path, lambda f: f.write(json.dumps({
+            'model': self.model_name,
+            'rows': len(keys),
+            'dim': matrix.shape[1]
+        }).encode('utf-8')))
+
+        # new file first, then drop what it now holds from _pending, so a get() never
+        # misses; vectors put while this was writing stay pending
+        self._disk = (np.load(self.matrix_path, mmap_mode='r'), {k: i for i, k in enumerate(keys)})
+        with self._lock:
+            for key, vector in pending.items():
+                if self._pending.get(key) is vector:
+                    del self._pending[key]
+
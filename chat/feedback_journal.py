@@ -0,0 +1,113 @@
+# chat/feedback_journal.py
+# append-only journal for thumbs-up q&a pairs
+# add_to_dataset used to rewrite all of data.csv on every click, now each click is one
+# fsync'd line in data.journal.jsonl (with its embedding, so replaying it at startup
+# doesn't need the embedder). every so often the journal is compacted into the csv.
+# a lock file keeps several app workers from interleaving writes or compactions.
+# readers remember how far they got (read() positions), so picking up other workers'
+# feedback only decodes the lines written since.
+
+import base64
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from chat.fileio import atomic_write
+
+try:
+    import fcntl
+except ImportError:  # windows, fall back to the in-process lock only
+    fcntl = None
+
+
+def encode_vector(vector: np.ndarray) -> str:
+    return base64.b64encode(np.asarray(vector, dtype='<f4').tobytes()).decode('ascii')
+
+
+def decode_vector(data: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype='<f4').astype(np.float32)
+
+
+class FeedbackJournal:
+    def __init__(self, knowledge_base_path: str):
+        base = os.path.splitext(knowledge_base_path)[0]
+        self.path = base + ".journal.jsonl"
+        self.lock_path = base + ".lock"
+        self._thread_lock = threading.RLock()
+
+    @contextmanager
+    def lock(self):
+        """Exclusive lock across threads and processes sharing this kb."""
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def append(self, question: str, answer: str, key: str, embedding: np.ndarray):
+        record = {
+            'instruction': question,
+            'output': answer,
+            'key': key,
+            'embedding': encode_vector(embedding),
+            'ts': time.time()
+        }
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock():
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def replay(self) -> List[Dict]:
+        """All journaled records, oldest first. A torn last line is skipped."""
+        return self.read()[0]
+
+    def read(self, position: Tuple[int, int] = None) -> Tuple[List[Dict], Optional[Tuple[int, int]]]:
+        """Records after `position` (from an earlier read, None = the whole journal) and
+        the position to read from next time. truncate() swaps in a new file, so an old
+        position reads that one from the start. A torn last line is left for later."""
+        if not os.path.exists(self.path):
+            return [], None
+        records = []
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            offset = 0
+            if position is not None and position[0] == stat.st_ino and position[1] <= stat.st_size:
+                offset = position[1]
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # still being written (or cut off by a crash)
+                    break
+                offset += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    record['embedding'] = decode_vector(record['embedding'])
+                    records.append(record)
+                except (ValueError, KeyError) as e:
+                    print(f"Skipping bad journal line at byte {offset - len(line)}: {e}")
+        return records, (stat.st_ino, offset)
+
+    def __len__(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'rb') as f:
+            return sum(1 for line in f if line.strip())
+
+    def truncate(self):
+        # only call while holding lock(). a new empty file rather than truncating in
+        # place, so read() positions into the old one don't point into the new one
+        atomic_write(self.path, lambda f: None)
@@ -0,0 +1,30 @@
+# chat/fileio.py
+# crash-safe file writes for everything the rag keeps on disk (embedding cache, kb
+# artifacts, bm25/ivf files, the compacted csv): write a temp file next to the target,
+# fsync it, rename it over the target, then fsync the directory so the rename sticks.
+# a crash leaves either the old file or the complete new one, never half of either.
+
+import os
+
+
+def fsync_dir(path: str):
+    """fsync the directory holding `path`, so a rename into it survives power loss."""
+    if os.name != 'posix':
+        # no directory fds on windows, the rename is as durable as it gets
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: str, write, mode: str = 'wb', **open_kwargs):
+    """Call write(f) on a temp file and move it over `path` once it's on disk."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, mode, **open_kwargs) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(path)
@@ -0,0 +1,359 @@
+# chat/generation_pool.py
+# bounded pool of distilgpt2 worker processes (chat/generation_worker.py) so cpu
+# decoding never runs on a flask request thread. each worker loads the model once
+# and is fed by max_batch threads here that pull jobs off a shared queue.
+#
+#   admission control  the queue holds at most max_queue waiting jobs, submit()
+#                      raises PoolFull past that instead of piling up requests
+#   timeout            each job gets `timeout` seconds end to end, the worker is told
+#                      to stop decoding before then and GenerationTimeout is raised
+#                      if it still isn't back. callers fall back to a direct answer
+#   batching           each worker has max_batch jobs in flight and decodes the ones
+#                      that arrive together as one batch (Generator.enable_batching)
+#
+# workers are plain subprocesses (not multiprocessing) so they don't re-import app.py.
+
+import atexit
+import itertools
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class GenerationUnavailable(Exception):
+    """No generated reply for this request, answer some other way."""
+
+
+class PoolFull(GenerationUnavailable):
+    pass
+
+
+class GenerationTimeout(GenerationUnavailable):
+    pass
+
+
+class _Job:
+    def __init__(self, message: Dict, timeout: float):
+        self.message = message
+        self.submitted = time.monotonic()
+        self.deadline = self.submitted + timeout
+        self.events: "queue.Queue" = queue.Queue()
+        self.finished = threading.Event()
+        self.abandoned = False  # caller gave up, skip it if it's still queued
+
+
+class _Worker:
+    """One worker process. several feeder threads send it jobs, one reader thread
+    routes its output back to them by job id."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.proc = None
+        self.ready = False
+        self.failures = 0
+        self.error = None
+        self.jobs: Dict[int, _Job] = {}
+        self.start_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self, cmd: List[str], env: Dict):
+        self.ready = False
+        self.proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            bufsize=1,
+            env=env
+        )
+        line = self.proc.stdout.readline()
+        message = json.loads(line) if line else None
+        if message is None or message.get('event') != 'ready':
+            self.kill()
+            raise RuntimeError(message.get('message') if message else "worker exited while loading")
+        threading.Thread(target=self._read, args=(self.proc,),
+                         name=f"generation-reader-{self.index}", daemon=True).start()
+        self.ready = True
+        self.failures = 0
+        self.error = None
+        return message
+
+    def send(self, job_id: int, job: _Job, message: Dict):
+        self.jobs[job_id] = job
+        with self._send_lock:
+            self.proc.stdin.write(json.dumps(dict(message, id=job_id)) + "\n")
+            self.proc.stdin.flush()
+
+    def _read(self, proc):
+        for line in proc.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            job = self.jobs.get(message.get('id'))
+            if job is None:
+                continue
+            job.events.put(message)
+            if message['event'] in ('done', 'error'):
+                self.jobs.pop(message['id'], None)
+                job.finished.set()
+
+        # process exited, fail whatever it was working on
+        self.ready = False
+        for job_id in list(self.jobs):
+            job = self.jobs.pop(job_id, None)
+            if job is not None:
+                job.events.put({'event': 'error', 'message': f"generation worker {self.index} exited"})
+                job.finished.set()
+
+    def kill(self):
+        self.ready = False
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class GenerationPool:
+    def __init__(self, model_path: str, workers: int = 2, max_queue: int = 16,
+                 timeout: float = 30.0, device: str = "cpu", max_batch: int = 8,
+                 max_wait_ms: float = 10.0, inference: str = 'fp32', threads: int = None,
+                 metrics=None):
+        """max_batch is how many jobs each worker decodes together (1 = one at a time).
+        threads is torch threads per worker, default splits the cores between workers.
+        metrics: optional chat.metrics.Metrics for the workers' prompt/tokenize/decode spans"""
+        self.model_path = os.path.abspath(model_path)
+        self.device = device
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.max_batch = max(1, max_batch)
+        self.max_wait_ms = max_wait_ms
+        self.inference = inference
+        self.threads = threads or max(1, (os.cpu_count() or 1) // max(1, workers))
+        self.using_finetuned = False
+        self.metrics = metrics
+
+        self._workers = [_Worker(i) for i in range(workers)]
+        self._queue: "queue.Queue[_Job]" = queue.Queue(maxsize=max_queue)
+        self._stopped = threading.Event()
+        self._changed = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._ids = itertools.count()
+
+        # metrics
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.expired = 0
+        self.errors = 0
+        self.in_flight = 0
+        self._wait_ms = deque(maxlen=1000)
+        self._service_ms = deque(maxlen=1000)
+
+    def _command(self) -> List[str]:
+        return [sys.executable, "-m", "chat.generation_worker",
+                "--model-path", self.model_path, "--device", self.device,
+                "--max-batch", str(self.max_batch), "--max-wait-ms", str(self.max_wait_ms),
+                "--inference", self.inference,
+                "--threads", str(self.threads), "--interop-threads", "1"]
+
+    def _env(self) -> Dict:
+        path = os.environ.get('PYTHONPATH')
+        return dict(os.environ, PYTHONPATH=_ROOT + (os.pathsep + path if path else ""))
+
+    def start(self):
+        # max_batch feeders per worker, each keeps at most one job in flight
+        for worker in self._workers:
+            for slot in range(self.max_batch):
+                thread = threading.Thread(target=self._feed, args=(worker,),
+                                          name=f"generation-feeder-{worker.index}.{slot}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        atexit.register(self.stop)
+        return self
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        """Block until a worker has loaded the model. False if they all failed (or timeout)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            while not any(w.ready for w in self._workers):
+                if all(w.failures for w in self._workers):
+                    return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+    @property
+    def last_error(self) -> str:
+        return next((w.error for w in self._workers if w.error), None)
+
+    def stop(self):
+        self._stopped.set()
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        for worker in self._workers:
+            worker.kill()
+
+    def _ensure_started(self, worker: _Worker) -> bool:
+        with worker.start_lock:
+            if worker.alive:
+                return True
+            try:
+                ready = worker.start(self._command(), self._env())
+                self.using_finetuned = ready.get('using_finetuned', False)
+                print(f"Generation worker {worker.index} ready (pid {ready.get('pid')})")
+                return True
+            except Exception as e:
+                if self._stopped.is_set():
+                    return False
+                worker.failures += 1
+                worker.error = str(e)
+                print(f"Generation worker {worker.index} failed to start: {e}")
+                return False
+            finally:
+                with self._changed:
+                    self._changed.notify_all()
+
+    def _feed(self, worker: _Worker):
+        while not self._stopped.is_set():
+            if not self._ensure_started(worker):
+                # back off before trying again, the queue drains through other workers
+                self._stopped.wait(min(60.0, 2.0 ** worker.failures))
+                continue
+
+            job = self._queue.get()
+            if job is None:
+                break
+            self._run(worker, job)
+
+    def _run(self, worker: _Worker, job: _Job):
+        started = time.monotonic()
+        self._wait_ms.append((started - job.submitted) * 1000)
+        remaining = job.deadline - started
+        if job.abandoned or remaining <= 0:
+            with self._lock:
+                self.expired += 1
+            return
+
+        with self._lock:
+            self.in_flight += 1
+        try:
+            # leave a little of the budget for getting the reply back to the caller
+            job_id = next(self._ids)
+            worker.send(job_id, job, dict(job.message, max_time=0.9 * remaining))
+            # the caller stops waiting at the deadline, don't hold this slot much longer
+            job.finished.wait(max(job.deadline - time.monotonic(), 0.0) + 5.0)
+        except (OSError, ValueError) as e:
+            worker.jobs.pop(job_id, None)
+            with self._lock:
+                self.errors += 1
+            job.events.put({'event': 'error', 'message': str(e)})
+            worker.kill()
+        finally:
+            self._service_ms.append((time.monotonic() - started) * 1000)
+            with self._lock:
+                self.in_flight -= 1
+
+    def submit(self, prompt, temperature: float = 0.7, max_new_tokens: int = 100,
+               stream: bool = False) -> _Job:
+        job = _Job({
+            'prompt': prompt,
+            'temperature': temperature,
+            'max_new_tokens': max_new_tokens,
+            'stream': stream
+        }, self.timeout)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise PoolFull(f"generation queue is full ({self.max_queue} waiting)")
+        with self._lock:
+            self.submitted += 1
+        return job
+
+    def _events(self, job: _Job) -> Iterator[Dict]:
+        while True:
+            try:
+                message = job.events.get(timeout=max(job.deadline - time.monotonic(), 0.0))
+            except queue.Empty:
+                job.abandoned = True
+                with self._lock:
+                    self.timeouts += 1
+                raise GenerationTimeout(f"no reply within {self.timeout}s")
+            if message['event'] == 'error':
+                raise GenerationUnavailable(message.get('message'))
+            if message['event'] == 'done' and self.metrics is not None:
+                # timed in the worker, recorded here on the caller's thread so they
+                # also land in its request timer
+                for name, ms in message.get('timing', {}).items():
+                    self.metrics.observe(name, ms)
+            yield message
+            if message['event'] == 'done':
+                return
+
+    # same interface as chat.generator.Generator
+
+    def build_prompt(self, user_query: str, context: List[Dict]) -> Dict:
+        # assembled (and its kb blocks token-cached) in the worker, which has the tokenizer
+        return {'query': user_query,
+                'context': [{'question': c['question'], 'answer': c['answer']} for c in context[:2]]}
+
+    def generate(self, prompt, temperature: float = 0.7, max_new_tokens: int = 100) -> str:
+        for message in self._events(self.submit(prompt, temperature, max_new_tokens)):
+            if message['event'] == 'done':
+                return message['reply']
+
+    def stream(self, prompt, temperature: float = 0.7, max_new_tokens: int = 100) -> Iterator[str]:
+        job = self.submit(prompt, temperature, max_new_tokens, stream=True)
+        try:
+            for message in self._events(job):
+                if message['event'] == 'token':
+                    yield message['text']
+        finally:
+            job.abandoned = True
+
+    def stats(self) -> Dict:
+        def percentiles(values):
+            if not values:
+                return None
+            p50, p95 = np.percentile(values, [50, 95])
+            return {'p50': float(p50), 'p95': float(p95)}
+
+        return {
+            'workers': len(self._workers),
+            'inference': self.inference,
+            'threads_per_worker': self.threads,
+            'workers_ready': sum(w.ready for w in self._workers),
+            'queue_depth': self._queue.qsize(),
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'expired': self.expired,
+            'errors': self.errors,
+            'timeout': self.timeout,
+            'wait_ms': percentiles(list(self._wait_ms)),
+            'service_ms': percentiles(list(self._service_ms))
+        }
@@ -0,0 +1,97 @@
+# chat/generation_worker.py
+# one distilgpt2 process of the GenerationPool, started as
+#   python -m chat.generation_worker --model-path ./chat/distilgpt2-finetuned
+# it loads the model once and then takes jobs concurrently, blocking jobs that arrive
+# together are decoded as one batch. the protocol is json lines: jobs come in on
+# stdin, events go out on stdout, tagged with the job id
+#   -> {"id": 7, "prompt": ..., "temperature": 0.7, "max_new_tokens": 100, "max_time": 20.0, "stream": false}
+#      prompt is text, or {"query": ..., "context": [{"question", "answer"}]} to assemble here
+#   <- {"event": "ready", "using_finetuned": true, "pid": 123}   once, after loading
+#   <- {"id": 7, "event": "token", "text": ...}                   stream jobs only
+#   <- {"id": 7, "event": "done", "reply": ..., "timing": {"generator.decode": 812.5, ...}}
+#      or {"id": 7, "event": "error", "message": ...}
+#      timing is this job's prompt/tokenize/decode spans (ms), the pool records them
+# everything else the model code prints goes to stderr (the server log)
+
+import argparse
+import json
+import os
+import sys
+import threading
+
+
+def _send(out, message):
+    out.write(json.dumps(message) + "\n")
+    out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DistilGPT2 generation worker")
+    parser.add_argument("--model-path", required=True)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--max-batch", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0)
+    parser.add_argument("--inference", default="fp32", help="fp32 or int8")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--interop-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    protocol = sys.stdout
+    sys.stdout = sys.stderr
+
+    try:
+        from chat.generator import Generator, pin_threads
+        from chat.metrics import Metrics
+        pin_threads(args.threads, args.interop_threads)
+        # only used to collect each job's spans for its done message
+        metrics = Metrics()
+        generator = Generator(args.model_path, device=args.device, inference=args.inference,
+                              metrics=metrics)
+    except Exception as e:
+        _send(protocol, {"event": "error", "message": f"could not load model: {e}"})
+        return 1
+
+    if args.max_batch > 1:
+        generator.enable_batching(max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+
+    lock = threading.Lock()
+
+    def send(message):
+        with lock:
+            _send(protocol, message)
+
+    def run(job):
+        try:
+            with metrics.request() as timer:
+                prompt = job["prompt"]
+                if isinstance(prompt, dict):
+                    with metrics.span("generator.prompt"):
+                        prompt = generator.build_prompt(prompt["query"], prompt["context"])
+                kwargs = dict(
+                    temperature=job.get("temperature", 0.7),
+                    max_new_tokens=job.get("max_new_tokens", 100),
+                    max_time=job.get("max_time")
+                )
+                if job.get("stream"):
+                    chunks = []
+                    for text in generator.stream(prompt, **kwargs):
+                        chunks.append(text)
+                        send({"id": job["id"], "event": "token", "text": text})
+                    reply = "".join(chunks).strip()
+                else:
+                    reply = generator.generate(prompt, **kwargs)
+            send({"id": job["id"], "event": "done", "reply": reply, "timing": timer.spans})
+        except Exception as e:
+            send({"id": job["id"], "event": "error", "message": str(e)})
+
+    send({"event": "ready", "using_finetuned": generator.using_finetuned, "pid": os.getpid()})
+
+    # one thread per job, the pool never sends more than --max-batch at once
+    for line in sys.stdin:
+        if line.strip():
+            threading.Thread(target=run, args=(json.loads(line),), daemon=True).start()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
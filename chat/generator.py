@@ -0,0 +1,442 @@
+# chat/generator.py
+# distilgpt2 side of the rag: loading the fine-tuned model (or base distilgpt2 if it's
+# missing), building prompts and decoding replies, blocking or streamed.
+# imported lazily by WomensHealthRAG so the app can serve direct answers while this loads.
+# with enable_batching(), concurrent generate() calls are left padded into one
+# generate() batch; each row keeps its own temperature, token budget and stop point.
+# inference='int8' dynamically quantizes the linear layers for cpu-only nodes
+# (chat/utils/bench-generator.py compares it against fp32).
+# prompts are assembled as token ids: each kb q&a block is tokenized once and cached,
+# and blocks are added under a token budget that always leaves room for the question.
+
+import os
+import threading
+import time
+from contextlib import nullcontext
+from typing import Dict, Iterator, List, Tuple
+
+import torch
+from transformers import (AutoModelForCausalLM, AutoTokenizer, LogitsProcessor,
+                          LogitsProcessorList, StoppingCriteria, StoppingCriteriaList,
+                          TextIteratorStreamer)
+
+from chat.caches import LRUCache
+from chat.micro_batcher import MicroBatcher
+
+INFERENCE_MODES = ('fp32', 'int8')
+
+# generated replies end at the first of these, decoding stops as soon as one shows up
+STOP_SEQUENCES = ("\n\n", "<|user|>", "<|endoftext|>", "<|assistant|>")
+
+# prompt tokens (context + question), the rest of the 1024 positions is for the reply
+MAX_PROMPT_TOKENS = 512
+# a context block cut shorter than this isn't worth keeping
+MIN_CONTEXT_TOKENS = 32
+
+
+def _stream_prefix(text: str):
+    """(part of streamed text that's safe to send, whether a stop sequence was hit)"""
+    cuts = [text.find(stop) for stop in STOP_SEQUENCES if stop in text]
+    if cuts:
+        return text[:min(cuts)], True
+
+    # hold back a tail that could still turn into a stop sequence
+    hold = 0
+    for stop in STOP_SEQUENCES:
+        for n in range(min(len(stop) - 1, len(text)), hold, -1):
+            if text.endswith(stop[:n]):
+                hold = n
+                break
+    return text[:len(text) - hold], False
+
+
+class _StopOnSequences(StoppingCriteria):
+    """Stop a sequence once its generated text (after the prompt) contains a stop sequence."""
+
+    def __init__(self, tokenizer, prompt_length: int, stops=STOP_SEQUENCES):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stops = stops
+        # only the last few tokens can complete a stop sequence, but leading
+        # whitespace is stripped from replies so "\n\n" there doesn't count
+        self.window = 2 * max(len(tokenizer.tokenize(stop)) for stop in stops) + 2
+
+    def _done(self, generated) -> bool:
+        if not len(generated):
+            return False
+        tail = self.tokenizer.decode(generated[-self.window:], skip_special_tokens=False)
+        if not any(stop in tail for stop in self.stops):
+            return False
+        text = self.tokenizer.decode(generated, skip_special_tokens=False).lstrip()
+        return any(stop in text for stop in self.stops)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = [self._done(row) for row in input_ids[:, self.prompt_length:].tolist()]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class _Cancelled(StoppingCriteria):
+    # lets the streaming consumer stop generate() early
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool,
+                          device=input_ids.device)
+
+
+class _RowBudget(StoppingCriteria):
+    # per-row max_new_tokens when a batch mixes budgets (generate() only takes one)
+    def __init__(self, prompt_length: int, budgets: List[int]):
+        self.prompt_length = prompt_length
+        self.budgets = torch.tensor(budgets)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.prompt_length
+        return (self.budgets <= generated).to(input_ids.device)
+
+
+class _RowDeadline(StoppingCriteria):
+    # per-row wall clock budget (seconds, None = no limit) when a batch mixes them,
+    # so one short deadline doesn't cut off every other reply in the batch
+    def __init__(self, max_times: List[float]):
+        start = time.perf_counter()
+        self.deadlines = torch.tensor([start + t if t is not None else float('inf') for t in max_times],
+                                      dtype=torch.float64)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return (self.deadlines <= time.perf_counter()).to(input_ids.device)
+
+
+class _RowTemperature(LogitsProcessor):
+    # per-row sampling temperature (regenerate runs hotter), applied before top-k/top-p
+    def __init__(self, temperatures: List[float]):
+        self.temperatures = torch.tensor(temperatures, dtype=torch.float32)[:, None]
+
+    def __call__(self, input_ids, scores):
+        return scores / self.temperatures.to(scores.device, scores.dtype)
+
+
+def pin_threads(num_threads: int = None, interop_threads: int = None):
+    """Fix torch's intra-op / inter-op thread counts (call before the model runs),
+    so several workers on one node don't each grab every core."""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            # only allowed before torch has started any parallel work in this process
+            print(f"Could not set interop threads: {e}")
+
+
+def _conv1d_to_linear(model: torch.nn.Module):
+    # gpt2 layers are transformers' Conv1D (x @ W with W stored [in, out]), which
+    # quantize_dynamic doesn't know about, so swap them for equivalent nn.Linear
+    from transformers.pytorch_utils import Conv1D
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                n_in, n_out = child.weight.shape
+                linear = torch.nn.Linear(n_in, n_out)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, name, linear)
+
+
+def quantize_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """int8 weights for every linear layer (activations quantized on the fly), cpu only"""
+    _conv1d_to_linear(model)
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def build_prompt(user_query: str, context: List[Dict], using_finetuned: bool) -> str:
+    context_str = ""
+    for ctx in context[:2]:
+        context_str += f"Q: {ctx['question']}\nA: {ctx['answer']}\n\n"
+
+    if using_finetuned:
+        return f"<|user|>\n{user_query}\n<|assistant|>\n"
+    return f"Based on this information:\n\n{context_str}\nQuestion: {user_query}\nAnswer:"
+
+
+class Generator:
+    def __init__(self, model_path: str, device: str = "cpu", inference: str = 'fp32',
+                 metrics=None, max_prompt_tokens: int = MAX_PROMPT_TOKENS):
+        """metrics: optional chat.metrics.Metrics to record tokenize/decode spans in"""
+        if inference not in INFERENCE_MODES:
+            raise ValueError(f"Unknown inference mode '{inference}', expected one of {INFERENCE_MODES}")
+        self.model_path = model_path
+        self.device = device
+        self.metrics = metrics
+
+        # laod fine tuned distilgpt
+        print(f"Loading fine-tuned DistilGPT2 from {model_path}...")
+
+        if os.path.exists(model_path):
+            try:
+                self.tokenizer = AutoTokenizer.from_pretrained(
+                    model_path,
+                    local_files_only=True
+                )
+                if self.tokenizer.pad_token is None:
+                    self.tokenizer.pad_token = self.tokenizer.eos_token
+                self.model = AutoModelForCausalLM.from_pretrained(
+                    model_path,
+                    torch_dtype=torch.float32,
+                    local_files_only=True
+                )
+                self.model.to(self.device)
+                self.model.eval()
+                print("Fine-tuned DistilGPT2 loaded successfully!")
+                self.using_finetuned = True
+            except Exception as e:
+                print(f"Could not load fine-tuned model: {e}")
+                print("   Falling back to base DistilGPT2...")
+                self._load_base_model()
+        else:
+            print(f"Path {model_path} not found")
+            print("   Falling back to base DistilGPT2...")
+            self._load_base_model()
+
+        self.inference = inference
+        if inference == 'int8':
+            if self.device != "cpu":
+                print(f"int8 dynamic quantization is cpu only, keeping fp32 on {self.device}")
+                self.inference = 'fp32'
+            else:
+                self.model = quantize_int8(self.model)
+                print("   Quantized DistilGPT2 linear layers to int8")
+
+        # batched prompts are left padded so every row continues from the same position
+        self.tokenizer.padding_side = 'left'
+        self.max_prompt_tokens = max_prompt_tokens
+        # token ids of prompt pieces that repeat across requests (kb q&a blocks, headers)
+        self.token_cache = LRUCache(maxsize=8192)
+        self._batcher = None
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.tokens = 0
+        self.decode_seconds = 0.0
+
+    def _load_base_model(self):
+        self.tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
+        self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(
+            "distilgpt2",
+            torch_dtype=torch.float32
+        )
+        self.model.to(self.device)
+        self.model.eval()
+        self.using_finetuned = False
+
+    def _token_ids(self, text: str, cache: bool = True) -> List[int]:
+        if not cache:
+            return self.tokenizer(text)['input_ids']
+        ids = self.token_cache.get(text)
+        if ids is None:
+            ids = self.tokenizer(text)['input_ids']
+            self.token_cache.put(text, ids)
+        return ids
+
+    def build_prompt(self, user_query: str, context: List[Dict]) -> List[int]:
+        """Same prompt as build_prompt() below, as token ids within max_prompt_tokens.
+        the question is always kept whole; kb blocks are added best first while they fit
+        (the last one cut short), instead of truncating the end of the string."""
+        budget = self.max_prompt_tokens
+        if self.using_finetuned:
+            return self._token_ids(f"<|user|>\n{user_query}\n<|assistant|>\n", cache=False)[-budget:]
+
+        tail = self._token_ids(f"\nQuestion: {user_query}\nAnswer:", cache=False)
+        if len(tail) >= budget:
+            # nothing but the question fits, keep its end, next to where the reply starts
+            return tail[-budget:]
+
+        head = self._token_ids("Based on this information:\n\n")
+        room = budget - len(tail) - len(head)
+        blocks = []
+        for ctx in context[:2]:
+            block = self._token_ids(f"Q: {ctx['question']}\nA: {ctx['answer']}\n\n")
+            if len(block) > room:
+                if room >= MIN_CONTEXT_TOKENS:
+                    blocks.append(block[:room])
+                break
+            blocks.append(block)
+            room -= len(block)
+        if not blocks:
+            return tail
+        return head + [t for block in blocks for t in block] + tail
+
+    def _inputs(self, prompts: List, temperatures: List[float], max_new_tokens: List[int],
+                max_times: List[float] = None) -> Tuple[Dict, Dict]:
+        # (tokenized prompts, generate() kwargs), one row per prompt. prompts are token
+        # ids from build_prompt() or plain text, which only gets its end cut if too long
+        rows = [
+            self._token_ids(p, cache=False)[-self.max_prompt_tokens:] if isinstance(p, str) else list(p)
+            for p in prompts
+        ]
+        prompt_length = max(len(row) for row in rows)
+        input_ids = torch.full((len(rows), prompt_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), prompt_length), dtype=torch.long)
+        for i, row in enumerate(rows):
+            # left padded
+            input_ids[i, prompt_length - len(row):] = torch.tensor(row, dtype=torch.long)
+            attention_mask[i, prompt_length - len(row):] = 1
+        inputs = {'input_ids': input_ids.to(self.device), 'attention_mask': attention_mask.to(self.device)}
+
+        # never ask for more positions than the model has
+        n_positions = getattr(self.model.config, 'n_positions', None) or 1024
+        budgets = [max(1, min(n, n_positions - prompt_length)) for n in max_new_tokens]
+
+        # stop each row at the end of its reply instead of decoding tokens we'd split off
+        criteria = StoppingCriteriaList([_StopOnSequences(self.tokenizer, prompt_length)])
+        if len(set(budgets)) > 1:
+            criteria.append(_RowBudget(prompt_length, budgets))
+
+        generate_kwargs = dict(
+            max_new_tokens=max(budgets),
+            do_sample=True,
+            top_k=50,
+            top_p=0.9,
+            temperature=temperatures[0],
+            repetition_penalty=1.15,
+            pad_token_id=self.tokenizer.pad_token_id,
+            eos_token_id=self.tokenizer.eos_token_id,
+            stopping_criteria=criteria
+        )
+        if len(set(temperatures)) > 1:
+            generate_kwargs['temperature'] = 1.0
+            generate_kwargs['logits_processor'] = LogitsProcessorList([_RowTemperature(temperatures)])
+        # wall clock budget (seconds), whatever has decoded by then is the reply
+        max_times = list(max_times or [None] * len(rows))
+        if len(set(max_times)) > 1:
+            criteria.append(_RowDeadline(max_times))
+        if None not in max_times:
+            generate_kwargs['max_time'] = max(max_times)
+        return inputs, generate_kwargs
+
+    @staticmethod
+    def extract_reply(generated: str) -> str:
+        # generated = decoded tokens after the prompt, so the prompt never has to be
+        # decoded again; the reply ends at the first stop sequence
+        reply = generated.strip()
+        for stop in STOP_SEQUENCES[1:]:
+            reply = reply.split(stop)[0].strip()
+        return reply.split("\n\n")[0].strip()
+
+    def generate_batch(self, prompts: List, temperatures: List[float],
+                       max_new_tokens: List[int], max_times: List[float] = None) -> List[str]:
+        """One generate() call for several prompts, returns one reply per prompt."""
+        start = time.perf_counter()
+        inputs, generate_kwargs = self._inputs(prompts, temperatures, max_new_tokens, max_times)
+        tokenized = time.perf_counter()
+        with torch.no_grad():
+            output_ids = self.model.generate(**inputs, **generate_kwargs)
+        decoded = time.perf_counter()
+        elapsed = decoded - tokenized
+
+        # finished rows are filled with pad (= eos), which skip_special_tokens drops
+        new_tokens = output_ids[:, inputs['input_ids'].shape[1]:]
+        with self._stats_lock:
+            self.batches += 1
+            self.requests += len(prompts)
+            self.tokens += int((new_tokens != self.tokenizer.pad_token_id).sum())
+            self.decode_seconds += elapsed
+
+        replies = [
+            self.extract_reply(self.tokenizer.decode(row, skip_special_tokens=True))
+            for row in new_tokens
+        ]
+        if self.metrics is not None:
+            self.metrics.observe('generator.tokenize', (tokenized - start) * 1000)
+            self.metrics.observe('generator.decode', elapsed * 1000)
+            self.metrics.observe('generator.detokenize', (time.perf_counter() - decoded) * 1000)
+        return replies
+
+    def generate(self, prompt, temperature: float = 0.7, max_new_tokens: int = 100,
+                 max_time: float = None) -> str:
+        if self._batcher is not None:
+            reply, spans = self._batcher.submit((prompt, temperature, max_new_tokens, max_time))
+            if self.metrics is not None:
+                self.metrics.add_to_request(spans)
+            return reply
+        return self.generate_batch([prompt], [temperature], [max_new_tokens], [max_time])[0]
+
+    def enable_batching(self, max_batch: int = 8, max_wait_ms: float = 10.0):
+        """Batch generate() calls from concurrent threads into one generate() pass.
+        requests arriving while a batch decodes queue up and form the next batch."""
+        def handle(items):
+            prompts, temperatures, budgets, max_times = zip(*items)
+            # generator.* spans run on this thread, hand them back to every caller
+            with self.metrics.request() if self.metrics is not None else nullcontext() as timer:
+                replies = self.generate_batch(list(prompts), list(temperatures), list(budgets),
+                                              list(max_times))
+            spans = timer.spans if timer is not None else {}
+            return [(reply, spans) for reply in replies]
+
+        self._batcher = MicroBatcher(
+            handle,
+            max_batch=max_batch,
+            max_wait_ms=max_wait_ms,
+            name="generation-batcher"
+        )
+
+    def stats(self) -> Dict:
+        return {
+            'inference': self.inference,
+            'threads': torch.get_num_threads(),
+            'batching': self._batcher is not None,
+            'batches': self.batches,
+            'requests': self.requests,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'tokens': self.tokens,
+            'tokens_per_sec': self.tokens / self.decode_seconds if self.decode_seconds else 0.0,
+            'token_cache': self.token_cache.stats()
+        }
+
+    def stream(self, prompt, temperature: float = 0.7, max_new_tokens: int = 100,
+               max_time: float = None) -> Iterator[str]:
+        # runs generate() on a worker thread and yields reply text as it's decoded.
+        # text is cut at the first stop sequence, and a tail that might be the start
+        # of one is held back until the next token decides it
+        cancelled = threading.Event()
+        # streamed replies aren't batched, TextIteratorStreamer only takes one row
+        inputs, generate_kwargs = self._inputs([prompt], [temperature], [max_new_tokens], [max_time])
+        generate_kwargs['stopping_criteria'].append(_Cancelled(cancelled))
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True)
+        errors = []
+
+        def run():
+            try:
+                with torch.no_grad():
+                    self.model.generate(**inputs, **generate_kwargs, streamer=streamer)
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        worker = threading.Thread(target=run, name="rag-stream-generate", daemon=True)
+        worker.start()
+
+        text, sent = "", 0
+        try:
+            for piece in streamer:
+                text += piece
+                safe, stopped = _stream_prefix(text.lstrip())
+                if len(safe) > sent:
+                    yield safe[sent:]
+                    sent = len(safe)
+                if stopped:
+                    break
+            else:
+                safe = text.lstrip()
+                for stop in STOP_SEQUENCES:
+                    safe = safe.split(stop)[0]
+                if len(safe) > sent:
+                    yield safe[sent:]
+        finally:
+            # stop decoding once we have the reply (or nobody is listening any more)
+            cancelled.set()
+            worker.join()
+        if errors:
+            raise errors[0]
@@ -0,0 +1,171 @@
+# chat/kb_artifact.py
+# prebuilt knowledge base written by chat/build_kb.py and opened by WomensHealthRAG
+# (pass the artifact directory as knowledge_base_path). everything the rag would
+# otherwise compute at boot is on disk, and the big arrays are opened with mmap:
+#
+#   chat/kb/CURRENT                       name of the live version, swapped atomically
+#   chat/kb/<version>/manifest.json       model, dim, rows, sha256 of every file, build report
+#   chat/kb/<version>/embeddings.npy      normalized float32, one row per kb row
+#   chat/kb/<version>/keys.npy            sha1 of each question (same keys as the embedding cache)
+#   chat/kb/<version>/texts.*.npy         columnar questions/answers (chat/text_store.py)
+#   chat/kb/<version>/bm25.npz            lexical index postings
+#   chat/kb/<version>/aliases.*.npy       near-duplicate questions collapsed into a row (chat/near_dupes.py)
+#   chat/kb/<version>/topics.npy          topic of each row, only if the csv has a topic column (chat/shards.py)
+#   chat/kb/<version>/index.ivf.npz       ann index, only if built with --index ivf
+#
+# the version is a hash of the rows + model (+ index and topics, which decide what
+# files the dir holds), so rebuilding unchanged data is a no-op and a version dir is
+# never reused for a build that would leave a stale index or topics file behind.
+
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from chat.bm25 import BM25Index
+from chat.fileio import atomic_write
+from chat.near_dupes import AliasTable
+from chat.text_store import TextColumn, TextStore
+
+FORMAT = 1
+CURRENT = "CURRENT"
+MANIFEST = "manifest.json"
+
+
+def is_artifact(path: str) -> bool:
+    return os.path.isdir(path) and (
+        os.path.exists(os.path.join(path, CURRENT)) or os.path.exists(os.path.join(path, MANIFEST))
+    )
+
+
+def resolve(path: str) -> str:
+    """The version directory for an artifact root (follows CURRENT) or a version dir."""
+    current = os.path.join(path, CURRENT)
+    if os.path.exists(current):
+        with open(current, encoding='utf-8') as f:
+            return os.path.join(path, f.read().strip())
+    return path
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class KBArtifact:
+    def __init__(self, path: str, mmap: bool = True):
+        self.root = path
+        self.path = resolve(path)
+        with open(os.path.join(self.path, MANIFEST), encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format') != FORMAT:
+            raise ValueError(f"{self.path} is artifact format {self.manifest.get('format')}, expected {FORMAT}")
+        self.version = self.manifest['version']
+        self.model = self.manifest['model']
+        mode = 'r' if mmap else None
+
+        self.embeddings = np.load(os.path.join(self.path, "embeddings.npy"), mmap_mode=mode)
+        self.keys: List[str] = np.load(os.path.join(self.path, "keys.npy")).astype(str).tolist()
+        self.texts = TextStore.open(os.path.join(self.path, "texts"), mmap=mmap)
+        if not (len(self.embeddings) == len(self.keys) == len(self.texts) == self.manifest['rows']):
+            raise ValueError(f"{self.path} is inconsistent, rebuild it with chat/build_kb.py")
+
+        topics = os.path.join(self.path, "topics.npy")
+        self.topics: Optional[List[str]] = np.load(topics).tolist() if os.path.exists(topics) else None
+
+        self.aliases = AliasTable()
+        if os.path.exists(os.path.join(self.path, "aliases.rows.npy")):
+            self.aliases = AliasTable(
+                np.load(os.path.join(self.path, "aliases.rows.npy")).tolist(),
+                np.load(os.path.join(self.path, "aliases.keys.npy")).astype(str).tolist(),
+                TextColumn.open(os.path.join(self.path, "aliases.questions.npy"), mmap=mmap)
+            )
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def current_path(self) -> str:
+        # what a watcher should poll to notice a new build being published
+        return os.path.join(self.root, CURRENT)
+
+    def bm25(self) -> BM25Index:
+        return BM25Index.load(os.path.join(self.path, "bm25.npz"))
+
+    def index_path(self, kind: str) -> Optional[str]:
+        path = os.path.join(self.path, f"index.{kind}.npz")
+        return path if os.path.exists(path) else None
+
+    def verify(self) -> List[str]:
+        """Files whose sha256 doesn't match the manifest (empty list = ok)."""
+        return [
+            name for name, digest in self.manifest['files'].items()
+            if not os.path.exists(os.path.join(self.path, name))
+            or file_sha256(os.path.join(self.path, name)) != digest
+        ]
+
+
+def content_version(keys: List[str], answers: List[str], model: str, alias_keys: List[str] = (),
+                    index: Dict = None, topics: List[str] = None) -> str:
+    digest = hashlib.sha256(f"{FORMAT}\n{model}\n".encode('utf-8'))
+    for key, answer in zip(keys, answers):
+        digest.update(key.encode('ascii'))
+        digest.update(hashlib.sha1(answer.encode('utf-8')).digest())
+    for key in alias_keys:
+        digest.update(key.encode('ascii'))
+    # only hashed when there is one, so plain builds keep their version
+    if index is not None:
+        digest.update(b"\nindex\n" + json.dumps(index, sort_keys=True).encode('utf-8'))
+    if topics is not None:
+        digest.update(b"\ntopics\n")
+        for topic in topics:
+            digest.update(hashlib.sha1(topic.encode('utf-8')).digest())
+    return digest.hexdigest()[:16]
+
+
+def write_artifact(root: str, texts: TextStore, keys: List[str], embeddings: np.ndarray,
+                   model: str, bm25: BM25Index, index=None, fingerprint: str = None,
+                   report: Dict = None, aliases: AliasTable = None, topics: List[str] = None) -> str:
+    """Write a new version under root and point CURRENT at it. Returns the version dir."""
+    aliases = aliases if aliases is not None else AliasTable()
+    index_state = None if index is None else {'kind': index.kind, **index.state()}
+    version = content_version(keys, texts.answers.tolist(), model, aliases.keys, index_state, topics)
+    path = os.path.join(root, version)
+    os.makedirs(path, exist_ok=True)
+
+    texts.save(os.path.join(path, "texts"))
+    atomic_write(os.path.join(path, "embeddings.npy"),
+           lambda f: np.save(f, np.ascontiguousarray(embeddings, dtype=np.float32)))
+    atomic_write(os.path.join(path, "keys.npy"), lambda f: np.save(f, np.array(keys, dtype='S40')))
+    bm25.save(os.path.join(path, "bm25.npz"))
+    if index is not None:
+        index.save(os.path.join(path, f"index.{index.kind}.npz"), fingerprint)
+    if topics is not None:
+        atomic_write(os.path.join(path, "topics.npy"), lambda f: np.save(f, np.array(topics, dtype=str)))
+    if len(aliases):
+        aliases.questions.save(os.path.join(path, "aliases.questions.npy"))
+        atomic_write(os.path.join(path, "aliases.rows.npy"), lambda f: np.save(f, np.array(aliases.rows, dtype=np.int64)))
+        atomic_write(os.path.join(path, "aliases.keys.npy"), lambda f: np.save(f, np.array(aliases.keys, dtype='S40')))
+
+    files = sorted(name for name in os.listdir(path) if name != MANIFEST and not name.endswith(".tmp"))
+    manifest = {
+        'format': FORMAT,
+        'version': version,
+        'model': model,
+        'rows': len(keys),
+        'aliases': len(aliases),
+        'dim': int(embeddings.shape[1]),
+        'index': index_state,
+        'files': {name: file_sha256(os.path.join(path, name)) for name in files},
+        'build': report or {}
+    }
+    atomic_write(os.path.join(path, MANIFEST), lambda f: f.write(json.dumps(manifest, indent=2).encode('utf-8')))
+
+    # publish: readers (and the rag's watcher) only ever see a complete version
+    atomic_write(os.path.join(root, CURRENT), lambda f: f.write(version.encode('utf-8')))
+    return path
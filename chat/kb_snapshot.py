@@ -0,0 +1,68 @@
+# chat/kb_snapshot.py
+# immutable view of the knowledge base that retrieval reads from.
+# writers (feedback, reloads) build the next snapshot and publish it with a single
+# attribute assignment; readers take one reference per request and never lock.
+#
+# the texts, matrix, index, bm25, aliases and key list underneath are append-only and shared between
+# consecutive snapshots, a snapshot only ever looks at its first `size` rows of them,
+# so rows appended for a newer snapshot are invisible to requests on an older one.
+# anything that isn't append-only (a reload that drops/changes rows) gets brand new
+# structures instead.
+#
+# with topic shards on (chat/shards.py) search() goes through the shard router, which
+# falls back to the full index when it can't tell which shards a query belongs to.
+
+from typing import List
+
+import numpy as np
+
+from chat.near_dupes import AliasTable
+from chat.text_store import TextStore
+
+
+class KBSnapshot:
+    __slots__ = ('version', 'texts', 'matrix', 'index', 'bm25', 'aliases', 'shards', 'size',
+                 'alias_count', '_keys')
+
+    def __init__(self, version: int, texts: TextStore, keys: List[str], matrix, index, bm25,
+                 aliases: AliasTable, shards=None):
+        self.version = version     # bumped on every publish, part of every cache key
+        self.texts = texts         # question/answer columns (shared, may be longer than size)
+        self.matrix = matrix       # normalized embeddings (so norms are all 1, dot = cosine)
+        self.index = index
+        self.bm25 = bm25
+        self.aliases = aliases     # near-duplicate questions collapsed into a kb row (shared)
+        self.shards = shards       # ShardRouter or None (shared)
+        self.size = len(texts)
+        self.alias_count = len(aliases)
+        self._keys = keys          # text hash per row, may be longer than size (shared)
+
+    def __setattr__(self, name, value):
+        if hasattr(self, '_keys'):
+            raise AttributeError("KBSnapshot is immutable, publish a new one instead")
+        object.__setattr__(self, name, value)
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def keys(self) -> List[str]:
+        return self._keys[:self.size]
+
+    @property
+    def alias_keys(self) -> List[str]:
+        return self.aliases.keys[:self.alias_count]
+
+    def question(self, i: int) -> str:
+        return self.texts.question(i)
+
+    def answer(self, i: int) -> str:
+        return self.texts.answer(i)
+
+    def search(self, queries: np.ndarray, k: int):
+        if self.shards is not None:
+            return self.shards.search(queries, k, self.index, limit=self.size)
+        return self.index.search(queries, k, limit=self.size)
+
+    def lexical_search(self, query: str, k: int):
+        return self.bm25.search(query, k, limit=self.size)
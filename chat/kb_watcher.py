@@ -0,0 +1,50 @@
+# chat/kb_watcher.py
+# polls the kb files' mtimes and calls a reload callback with the paths that
+# changed. waits for one quiet interval after a change so a csv that's still
+# being written isn't picked up half way.
+
+import os
+import threading
+from typing import Callable, List
+
+
+class KBWatcher(threading.Thread):
+    def __init__(self, paths: List[str], on_change: Callable[[List[str]], object], interval: float = 5.0):
+        super().__init__(name="kb-watcher", daemon=True)
+        self.paths = paths
+        self.on_change = on_change
+        self.interval = interval
+        self._stop_event = threading.Event()
+        # taken here rather than in run() so changes right after start() aren't missed
+        self._seen = self._stamp()
+
+    def _stamp(self):
+        stamp = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        seen = self._seen
+        pending = None
+        while not self._stop_event.wait(self.interval):
+            current = self._stamp()
+            if current != seen:
+                # changed since last reload, wait until it stops changing
+                if current == pending:
+                    changed = [path for path, old, new in zip(self.paths, seen, current) if old != new]
+                    try:
+                        self.on_change(changed)
+                    except Exception as e:
+                        print(f"KB watcher reload failed: {e}")
+                    seen = current
+                    pending = None
+                else:
+                    pending = current
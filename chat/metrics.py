@@ -0,0 +1,136 @@
+# chat/metrics.py
+# per-stage latency for the rag pipeline. code wraps each stage in a span:
+#
+#     with self.metrics.span('retrieve.encode'):
+#         ...
+#
+# every span lands in a histogram (fixed ms buckets + p50/p95/p99 over recent
+# samples) that /api/metrics serves. spans opened on a thread that has a request
+# timer active (Metrics.request()) are also added to that request's timing block,
+# which /api/chatbot returns when the client sends X-Debug-Timing. stages that run
+# on another thread (micro-batchers) or process (generation workers) hand their spans
+# back with the result and the caller adds them with add_to_request().
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# upper bounds (ms) of the histogram buckets, anything slower goes in the +inf bucket
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS_MS, window: int = 1000):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, ms: float):
+        i = int(np.searchsorted(self.buckets, ms))
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+            self._recent.append(ms)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            counts, recent = list(self.counts), list(self._recent)
+            count, total_ms, max_ms = self.count, self.total_ms, self.max_ms
+        if recent:
+            p50, p95, p99 = (float(p) for p in np.percentile(recent, [50, 95, 99]))
+        else:
+            p50 = p95 = p99 = None
+        # cumulative like prometheus: how many observations were <= each bound
+        bounds = [str(b) for b in self.buckets] + ['+inf']
+        return {
+            'count': count,
+            'mean_ms': total_ms / count if count else None,
+            'max_ms': max_ms,
+            'p50_ms': p50,
+            'p95_ms': p95,
+            'p99_ms': p99,
+            'buckets': dict(zip(bounds, np.cumsum(counts).tolist()))
+        }
+
+
+class RequestTimer:
+    """Timing block for one request, span name -> ms (summed if a stage repeats)."""
+
+    def __init__(self):
+        self.spans: Dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    def add(self, name: str, ms: float):
+        self.spans[name] = self.spans.get(name, 0.0) + ms
+
+    def as_dict(self) -> Dict:
+        return dict({k: round(v, 3) for k, v in self.spans.items()},
+                    total=round((time.perf_counter() - self._start) * 1000, 3))
+
+
+class Metrics:
+    def __init__(self):
+        self._histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name: str, ms: float):
+        self.histogram(name).observe(ms)
+        timer = getattr(self._local, 'timer', None)
+        if timer is not None:
+            timer.add(name, ms)
+
+    def add_to_request(self, spans: Dict[str, float]):
+        """Add spans timed somewhere else (already in the histograms) to this thread's
+        request timer, if it has one."""
+        timer = getattr(self._local, 'timer', None)
+        if timer is not None:
+            for name, ms in spans.items():
+                timer.add(name, ms)
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000)
+
+    @contextmanager
+    def request(self, enabled: bool = True):
+        """Collect the spans this thread records into a RequestTimer (None if not enabled)."""
+        if not enabled:
+            yield None
+            return
+        outer = getattr(self._local, 'timer', None)
+        timer = self._local.timer = RequestTimer()
+        try:
+            yield timer
+        finally:
+            self._local.timer = outer
+
+    def snapshot(self, names: Optional[List[str]] = None) -> Dict:
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {
+            name: histograms[name].snapshot()
+            for name in sorted(names if names is not None else histograms)
+            if name in histograms
+        }
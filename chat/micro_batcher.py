@@ -0,0 +1,67 @@
+# chat/micro_batcher.py
+# collects calls from concurrent request threads for a few milliseconds and runs them
+# through one batched handler, then hands each caller back its own result.
+# used so N concurrent chatbot queries cost one embedder forward pass instead of N.
+
+import queue
+import threading
+import time
+from typing import Any, Callable, List
+
+
+class _Pending:
+    __slots__ = ('item', 'result', 'error', 'done')
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    def __init__(self, handler: Callable[[List[Any]], List[Any]], max_batch: int = 32,
+                 max_wait_ms: float = 5.0, name: str = "micro-batcher"):
+        """handler takes a list of items and must return one result per item, in order."""
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Any:
+        """Queue one item and block until its batch has been processed."""
+        pending = _Pending(item)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect(self) -> List[_Pending]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                results = self.handler([p.item for p in batch])
+                for pending, result in zip(batch, results):
+                    pending.result = result
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            finally:
+                for pending in batch:
+                    pending.done.set()
@@ -0,0 +1,125 @@
+# chat/near_dupes.py
+# near-duplicate collapse for the knowledge base. paraphrased copies of the same q&a
+# (data.csv has some, the thumbs-up loop keeps adding more) each take a matrix row and
+# fill the top-k with the same answer. rows with the same answer (after normalize_query)
+# whose questions embed within `threshold` cosine of each other are one cluster: the
+# first row stays in the kb, the others are kept as aliases of it.
+#
+# rows are only compared inside their answer group, with one blocked matrix product per
+# group, so the cost follows the group sizes instead of n^2. new rows (feedback, journal
+# replay) are checked against the kb through the nearest neighbour index.
+
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from chat.caches import normalize_query
+from chat.text_store import TextColumn
+from chat.vectors import normalize
+
+# MiniLM cosine between two phrasings of the same question is usually above this
+DUPLICATE_THRESHOLD = 0.9
+
+
+def _find(parent: np.ndarray, i: int) -> int:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def clusters(embeddings: np.ndarray, answers: List[str], threshold: float = DUPLICATE_THRESHOLD,
+             block: int = 1024) -> np.ndarray:
+    """Canonical row for every row: the first row of its cluster (itself if it's alone)."""
+    n = len(answers)
+    parent = np.arange(n)
+    groups = {}
+    for i, answer in enumerate(answers):
+        groups.setdefault(normalize_query(answer), []).append(i)
+
+    for ids in groups.values():
+        if len(ids) < 2:
+            continue
+        ids = np.array(ids)
+        vectors = normalize(np.asarray(embeddings[ids], dtype=np.float32))
+        # each row against the rows before it, a block x block tile at a time
+        for start in range(0, len(ids), block):
+            rows = vectors[start:start + block]
+            for col in range(0, start + len(rows), block):
+                r, c = np.nonzero(rows @ vectors[col:col + block].T >= threshold)
+                for a, b in zip(start + r, col + c):
+                    if b < a:
+                        ra, rb = _find(parent, ids[a]), _find(parent, ids[b])
+                        parent[max(ra, rb)] = min(ra, rb)
+
+    for i in np.flatnonzero(parent != np.arange(n)):
+        parent[i] = _find(parent, i)
+    return parent
+
+
+def match_existing(search: Callable, embeddings: np.ndarray, answers: List[str],
+                   answer_of: Callable, threshold: float = DUPLICATE_THRESHOLD, k: int = 5) -> np.ndarray:
+    """kb row each new row duplicates, -1 where there's none.
+    search(queries, k) -> [(ids, scores)] like KBSnapshot.search, answer_of(row) -> answer"""
+    matches = np.full(len(answers), -1, dtype=np.int64)
+    if not len(answers):
+        return matches
+    for i, (ids, scores) in enumerate(search(normalize(np.asarray(embeddings, dtype=np.float32)), k)):
+        answer = normalize_query(answers[i])
+        for idx, score in zip(ids, scores):
+            if score >= threshold and normalize_query(answer_of(int(idx))) == answer:
+                matches[i] = int(idx)
+                break
+    return matches
+
+
+def collapse(embeddings: np.ndarray, answers: List[str], start: int = 0, search: Callable = None,
+             answer_of: Callable = None, threshold: float = DUPLICATE_THRESHOLD
+             ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Split new rows into the ones to append and aliases.
+    returns (positions of rows to append, positions of aliases, kb row each alias points at),
+    where rows to append are assumed to land in order from kb row `start`. with search
+    given, new rows are also matched against the kb rows before `start`."""
+    embeddings = np.asarray(embeddings)
+    n = len(answers)
+    parent = clusters(embeddings, answers, threshold)
+    roots = np.flatnonzero(parent == np.arange(n))
+
+    row_of = np.full(n, -1, dtype=np.int64)
+    if search is not None and start:
+        row_of[roots] = match_existing(search, embeddings[roots], [answers[i] for i in roots],
+                                       answer_of, threshold)
+    keep = roots[row_of[roots] < 0]
+    row_of[keep] = start + np.arange(len(keep))
+
+    kept = np.zeros(n, dtype=bool)
+    kept[keep] = True
+    dupes = np.flatnonzero(~kept)
+    return keep, dupes, row_of[parent[dupes]]
+
+
+class AliasTable:
+    """Questions collapsed into another kb row: (canonical row, text hash, question) each.
+    append-only like the rest of the kb, a snapshot only reads its first `size` aliases."""
+
+    def __init__(self, rows: List[int] = None, keys: List[str] = None, questions: TextColumn = None):
+        self.rows: List[int] = [] if rows is None else list(rows)
+        self.keys: List[str] = [] if keys is None else list(keys)
+        self.questions = TextColumn() if questions is None else questions
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, rows, keys: List[str], questions: List[str]):
+        if not len(rows):
+            return
+        # text first, an alias only counts (len() is the row count) once it's all there
+        self.questions.extend(list(questions))
+        self.keys.extend(keys)
+        self.rows.extend(int(row) for row in rows)
+
+    def truncate(self, size: int):
+        """Drop aliases past `size` (undoing a failed add)."""
+        del self.rows[size:]
+        del self.keys[size:]
+        self.questions.truncate(size)
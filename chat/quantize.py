@@ -0,0 +1,154 @@
+# chat/quantize.py
+# quantized storage for the kb embedding matrix, for small containers
+#   int8:    one int8 code per dim + a float32 scale per row (~4x smaller than float32)
+#   float16: half precision rows (2x smaller)
+# scoring dequantizes a block of rows at a time so we never hold a full float copy.
+# with rerank on, the top candidates are re-scored with exact float32 vectors
+# fetched through `exact` (the rag points it at the on-disk embedding cache).
+
+from typing import Callable, Dict
+
+import numpy as np
+
+from chat.vectors import normalize, top_k
+
+MODES = ('int8', 'float16')
+
+
+class QuantizedMatrix:
+    def __init__(self, rows: np.ndarray, mode: str = 'int8', dim: int = None,
+                 exact: Callable[[np.ndarray], np.ndarray] = None,
+                 rerank: bool = True, rerank_factor: int = 4, block: int = 16384):
+        if mode not in MODES:
+            raise ValueError(f"Unknown quantization mode '{mode}', expected one of {MODES}")
+        rows = np.asarray(rows, dtype=np.float32)
+        if rows.ndim != 2:
+            rows = rows.reshape(0, dim or 0)
+        self.mode = mode
+        self.dim = rows.shape[1] or (dim or 0)
+        self.exact = exact
+        self.rerank = rerank
+        self.rerank_factor = rerank_factor
+        self.block = block
+
+        capacity = max(len(rows), 16)
+        self._codes = np.empty((capacity, self.dim), dtype=np.int8 if mode == 'int8' else np.float16)
+        self._scales = np.ones(capacity, dtype=np.float32)
+        self.size = 0
+        if len(rows):
+            self.append(rows)
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        return self._codes.nbytes + (self._scales.nbytes if self.mode == 'int8' else 0)
+
+    def _quantize(self, rows: np.ndarray):
+        if self.mode == 'float16':
+            return rows.astype(np.float16), np.ones(len(rows), dtype=np.float32)
+        scales = np.maximum(np.abs(rows).max(axis=1), 1e-12) / 127.0
+        codes = np.clip(np.rint(rows / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def append(self, rows: np.ndarray) -> np.ndarray:
+        """Normalize, quantize and append rows, returning their indices."""
+        codes, scales = self._quantize(normalize(np.atleast_2d(rows)))
+        start, end = self.size, self.size + len(codes)
+        if end > len(self._codes):
+            capacity = max(end, 2 * len(self._codes))
+            grown = np.empty((capacity, self.dim), dtype=self._codes.dtype)
+            grown[:start] = self._codes[:start]
+            grown_scales = np.ones(capacity, dtype=np.float32)
+            grown_scales[:start] = self._scales[:start]
+            self._codes, self._scales = grown, grown_scales
+        self._codes[start:end] = codes
+        self._scales[start:end] = scales
+        self.size = end
+        return np.arange(start, end)
+
+    def truncate(self, size: int):
+        # undo a failed append, the next one writes over the dropped rows
+        self.size = min(self.size, size)
+
+    def rows(self, ids) -> np.ndarray:
+        """Dequantized (approximate) float32 rows."""
+        codes = self._codes[:self.size][ids].astype(np.float32)
+        if self.mode == 'int8':
+            codes *= self._scales[:self.size][ids][..., None]
+        return codes
+
+    def exact_rows(self, ids) -> np.ndarray:
+        if self.exact is None:
+            return self.rows(ids)
+        try:
+            return normalize(self.exact(np.arange(self.size)[ids]))
+        except KeyError:
+            # the float source lost a row (kb reloaded under us), approximate is fine
+            return self.rows(ids)
+
+    def scores(self, queries: np.ndarray, limit: int = None) -> np.ndarray:
+        queries = np.atleast_2d(queries).astype(np.float32)
+        n = self.size if limit is None else min(limit, self.size)
+        out = np.empty((len(queries), n), dtype=np.float32)
+        for start in range(0, n, self.block):
+            end = min(start + self.block, n)
+            block = self._codes[start:end].astype(np.float32) @ queries.T
+            if self.mode == 'int8':
+                block *= self._scales[start:end, None]
+            out[:, start:end] = block.T
+        return out
+
+    def candidates(self, k: int) -> int:
+        return k * self.rerank_factor if self.rerank and self.exact is not None else k
+
+    def refine(self, query: np.ndarray, ids: np.ndarray, scores: np.ndarray, k: int):
+        if not (self.rerank and self.exact is not None) or not len(ids):
+            return ids[:k], scores[:k]
+        exact = self.exact_rows(ids) @ query
+        best = top_k(exact, k)
+        return ids[best], exact[best]
+
+
+def quantization_report(matrix: QuantizedMatrix, exact: np.ndarray, k: int = 10,
+                        n_queries: int = 200, sample_rows: int = 20000, seed: int = 0) -> Dict:
+    """Memory saved and recall@k lost vs exact float32 search.
+
+    Queries are perturbed kb rows, so this measures ranking agreement on
+    realistic directions without needing a labelled query set. Recall is measured
+    over a sample of sample_rows kb rows, this runs at every boot and mustn't cost
+    a float copy of the whole matrix.
+    """
+    n, dim = len(exact), matrix.dim
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(n, size=min(sample_rows, n), replace=False))
+    sample = normalize(np.asarray(exact[rows], dtype=np.float32))
+    approx = matrix.rows(rows)
+    picked = rng.choice(len(rows), size=min(n_queries, len(rows)), replace=False)
+    noise = rng.standard_normal((len(picked), dim)).astype(np.float32)
+    queries = normalize(sample[picked] + 0.3 * normalize(noise))
+
+    recall_approx, recall_rerank = [], []
+    for q in queries:
+        expected = set(rows[top_k(sample @ q, k)].tolist())
+        row = approx @ q
+        recall_approx.append(len(expected & set(rows[top_k(row, k)].tolist())) / len(expected))
+        best = top_k(row, matrix.candidates(k))
+        refined, _ = matrix.refine(q, rows[best], row[best], k)
+        recall_rerank.append(len(expected & set(refined.tolist())) / len(expected))
+
+    float_bytes = n * dim * 4
+    quant_bytes = matrix.size * matrix.dim * matrix._codes.itemsize + (
+        matrix.size * 4 if matrix.mode == 'int8' else 0)
+    return {
+        'mode': matrix.mode,
+        'rows': n,
+        'sampled_rows': len(rows),
+        'float32_bytes': int(float_bytes),
+        'quantized_bytes': int(quant_bytes),
+        'bytes_saved': int(float_bytes - quant_bytes),
+        f'recall@{k}': float(np.mean(recall_approx)),
+        f'recall@{k}_reranked': float(np.mean(recall_rerank)),
+        'rerank': bool(matrix.rerank and matrix.exact is not None)
+    }
@@ -6,263 +6,1216 @@
 # chat/rag.py
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
 from sentence_transformers import SentenceTransformer
 import numpy as np
 import pandas as pd
-from typing import List, Dict
+from typing import List, Dict, Iterator
+from collections import Counter, deque
 import csv
 import os
+import re
+import threading
+import time
+
+from chat.embedding_cache import EmbeddingCache, text_hash
+from chat.fileio import atomic_write
+from chat.vectors import GrowableMatrix, normalize, top_k as top_k_indices
+from chat.ann_index import make_index, kb_fingerprint
+from chat.micro_batcher import MicroBatcher
+from chat.feedback_journal import FeedbackJournal
+from chat.kb_watcher import KBWatcher
+from chat.bm25 import BM25Index, reciprocal_rank_fusion
+from chat.caches import LRUCache, normalize_query
+from chat.quantize import QuantizedMatrix, quantization_report
+from chat.generation_pool import GenerationUnavailable
+from chat.kb_snapshot import KBSnapshot
+from chat.text_store import TextStore
+from chat.metrics import Metrics
+from chat.kb_artifact import KBArtifact, is_artifact
+from chat.near_dupes import DUPLICATE_THRESHOLD, AliasTable, collapse
+from chat.shards import DEFAULT_SHARDS, ShardRouter
+
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+# name of the kb a WomensHealthRAG is created with, others are added with add_namespace()
+DEFAULT_NAMESPACE = 'default'
+NAMESPACE_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def load_kb_csv(path: str) -> pd.DataFrame:
+    try:
+        kb = pd.read_csv(
+            path,
+            quoting=csv.QUOTE_ALL,
+            escapechar='\\',
+            encoding='utf-8'
+        )
+    except Exception as e:
+        print(f"Error with strict parsing, trying lenient mode: {e}")
+        kb = pd.read_csv(
+            path,
+            on_bad_lines='skip',
+            engine='python',
+            encoding='utf-8'
+        )
+    
+    kb.columns = [c.strip().lower().replace("\ufeff", "") for c in kb.columns]
+    return kb.dropna(subset=['instruction', 'output'])
+
+
+def _unseen_rows(kb: pd.DataFrame, records: List[Dict]) -> List[Dict]:
+    # journal rows that aren't in the csv yet (a compaction can die before truncating)
+    seen = set(zip(kb['instruction'], kb['output']))
+    rows = []
+    for record in records:
+        pair = (record['instruction'], record['output'])
+        if pair not in seen:
+            seen.add(pair)
+            rows.append(record)
+    return rows
+
 
 class WomensHealthRAG:
     def __init__(self, knowledge_base_path: str, 
-                 generation_model_path: str = "./chat/distilgpt2-finetuned"):
+                 generation_model_path: str = "./chat/distilgpt2-finetuned",
+                 index: str = 'brute', index_params: Dict = None,
+                 journal_compact_every: int = 100, hybrid: bool = True,
+                 answer_cache_size: int = 1024, answer_cache_ttl: float = 3600,
+                 query_cache_bytes: int = 32 * 1024 * 1024, quantization: str = None,
+                 max_new_tokens: int = 100, generation_workers: int = 0,
+                 generation_queue_size: int = 16, generation_timeout: float = 30.0,
+                 generation_batch_size: int = 8, generation_inference: str = 'fp32',
+                 generation_threads: int = None, duplicate_threshold: float = DUPLICATE_THRESHOLD,
+                 shards=None, shard_probe: int = 2, shard_min_margin: float = 0.05,
+                 namespace: str = DEFAULT_NAMESPACE, host: "WomensHealthRAG" = None):
 
         self.device = "mps" if torch.backends.mps.is_available() else "cpu"
         self.knowledge_base_path = knowledge_base_path
         print(f"Using device: {self.device}")
         
-        # csv data
-        try:
-            self.kb = pd.read_csv(
-                knowledge_base_path,
-                quoting=csv.QUOTE_ALL,
-                escapechar='\\',
-                encoding='utf-8',
-                engine='python'
-            )
-        except Exception as e:
-            print(f"Error with strict parsing, trying lenient mode: {e}")
-            self.kb = pd.read_csv(
-                knowledge_base_path,
-                on_bad_lines='skip',
-                engine='python',
-                encoding='utf-8'
-            )
+        # several clinics' kbs can live in one process (add_namespace()): each namespace
+        # is a WomensHealthRAG with its own snapshot, caches and journal, and the embedder,
+        # query cache, metrics and generator all belong to the host (the first one)
+        self._host = host if host is not None else self
+        self.namespace_name = namespace
+        self.namespaces: Dict[str, "WomensHealthRAG"] = {namespace: self} if host is None else host.namespaces
+        self._namespace_lock = threading.Lock() if host is None else host._namespace_lock
+        
+        # knowledge_base_path can also be an artifact from chat/build_kb.py, then texts,
+        # embeddings and indexes are opened with mmap instead of computed at boot
+        self.artifact = None
+        if is_artifact(knowledge_base_path):
+            self.knowledge_base_path = knowledge_base_path = os.path.normpath(knowledge_base_path)
+            self.artifact = KBArtifact(knowledge_base_path)
         
-        self.kb.columns = [c.strip().lower().replace("\ufeff", "") for c in self.kb.columns]
-        self.kb = self.kb.dropna(subset=['instruction', 'output'])
-        print(f"   Loaded {len(self.kb)} Q&A pairs")
+        # thumbs-up rows are journaled and folded into the csv every journal_compact_every rows
+        self.journal = FeedbackJournal(knowledge_base_path)
+        self.journal_compact_every = journal_compact_every
         
         # embedding model
-        self.embedder = SentenceTransformer('all-MiniLM-L6-v2')
+        self.embedder = SentenceTransformer(EMBEDDING_MODEL) if host is None else host.embedder
+        self.embedding_cache = EmbeddingCache(knowledge_base_path, EMBEDDING_MODEL)
+        
+        # writers (feedback, reloads) take _write_lock and publish a new KBSnapshot,
+        # readers grab self._snapshot once per request and never take a lock
+        self._write_lock = threading.RLock()
+        self._snapshot = None
+        
+        # per-stage latency histograms (/api/metrics)
+        self.metrics = Metrics() if host is None else host.metrics
+        
+        # direct answers keyed on the normalized question, dropped whenever the kb changes
+        self.answer_cache = LRUCache(maxsize=answer_cache_size, ttl=answer_cache_ttl)
+
+        # normalized query embeddings (exact query text -> vector), bounded by bytes.
+        # they don't depend on the kb, so namespaces share the host's
+        self.query_cache = LRUCache(
+            maxsize=1_000_000,
+            max_bytes=query_cache_bytes,
+            sizeof=lambda v: v.nbytes + 100  # + key/entry overhead, roughly
+        ) if host is None else host.query_cache
+
+        # retrieval context of recent generated answers so a thumbs-down regenerate
+        # only pays for the generation step
+        self.context_cache = LRUCache(maxsize=1024, ttl=answer_cache_ttl)
+
+        # None (float32), 'int8' or 'float16' storage for the kb matrix
+        self.quantization = quantization
+        self.quantization_stats = None
+        
+        # rows with the same answer and a question this close to an earlier row's become
+        # aliases of that row instead of rows of their own (None keeps every row)
+        self.duplicate_threshold = duplicate_threshold
+        # (key, answer) of every csv + journal row read, aliases included, in file order;
+        # reload_dataset compares the file against it (None for artifacts)
+        self._source = None
+        # how far the journal has been read (FeedbackJournal.read), and the (key, answer)
+        # pairs this process journaled since, which are in the kb already
+        self._journal_position = None
+        self._own_journaled = Counter()
+        
+        # nearest-neighbour index over the kb matrix (brute force unless asked otherwise)
+        self.index_type = index
+        self.index_params = index_params or {}
+        
+        # topic shards (chat/shards.py): 'topic' = one per value of the kb's topic column,
+        # a number = that many k-means shards, None = every query scans the whole kb.
+        # queries search their shard_probe closest shards at most
+        self.sharding = shards
+        self.shard_probe = shard_probe
+        self.shard_min_margin = shard_min_margin
         
-        # embeddings
+        # csv data + journal, embeddings only computed for rows missing from the cache
+        texts, keys, matrix, bm25, aliases, shards = self._load_kb(show_progress_bar=True)
+        self._publish(texts, keys, matrix, self._open_index(matrix, keys), bm25, aliases, shards)
+        self._watcher = None
+
+        # hybrid retrieval: bm25 ranks fused with dense ranks by reciprocal rank fusion
+        self.hybrid = hybrid
+        self.rrf_k = 60                     # rrf damping constant
+        self.rrf_depth = 50                 # how deep each ranking goes into the fusion
+        self.lexical_weight = 0.6           # keyword coverage counts as at most this much similarity
+        self.prefilter_min_rows = 50000     # kb size where dense scoring only runs on lexical hits
+        self.prefilter_candidates = 2000
+
+        # set by enable_micro_batching(), otherwise every query encodes on its own
+        self._retrieval_batcher = None
+
+        # default (and upper bound) for the per-request generation token budget
+        self.max_new_tokens = max_new_tokens
+
+        # time to first token / total time of recent /api/chatbot/stream requests
+        self.stream_timings = deque(maxlen=1000)
+        
+        # distilgpt2 is loaded on first use, or in the background by warm_generator();
+        # until it's ready the generated path answers with the best direct match
+        self.generation_model_path = generation_model_path
+        self._generator = None
+        self._generator_lock = threading.Lock()   # held while loading
+        self._warmup_lock = threading.Lock()
+        self._generator_thread = None
+        self.generator_state = 'not_loaded'  # -> 'loading' -> 'ready' (or 'failed')
+        self.generator_error = None
+        self.generator_load_seconds = None
+
+        # generation_workers > 0 runs distilgpt2 in that many worker processes instead
+        # of on the calling thread, see chat/generation_pool.py
+        self.generation_workers = generation_workers
+        self.generation_queue_size = generation_queue_size
+        self.generation_timeout = generation_timeout
+        # concurrent generations are decoded together in batches of up to this many
+        self.generation_batch_size = generation_batch_size
+        # 'int8' = dynamic int8 linear layers (cpu), threads = torch threads per worker
+        # (in-process, only changed if given since the embedder shares them)
+        self.generation_inference = generation_inference
+        self.generation_threads = generation_threads
+
+    def add_namespace(self, name: str, knowledge_base_path: str, **options) -> "WomensHealthRAG":
+        """Host another kb (csv or artifact) in this process under `name`. It gets its own
+        snapshot, answer/context caches, journal and embedding cache; options are the kb
+        ones of __init__ (index, hybrid, quantization, shards, ...). Generation settings
+        are the host's."""
+        host = self._host
+        if not NAMESPACE_PATTERN.match(name):
+            raise ValueError(f"Invalid namespace name '{name}', use letters, digits, '-' and '_'")
+        with self._namespace_lock:
+            if name in host.namespaces:
+                raise ValueError(f"Namespace '{name}' already exists")
+            path = os.path.normpath(knowledge_base_path)
+            if any(os.path.normpath(ns.knowledge_base_path) == path for ns in host.namespaces.values()):
+                # they'd share (and fight over) the journal and embedding cache files
+                raise ValueError(f"{knowledge_base_path} is already served by another namespace")
+            print(f"Adding kb namespace '{name}' from {knowledge_base_path}")
+            namespace = WomensHealthRAG(knowledge_base_path, namespace=name, host=host, **options)
+            host.namespaces[name] = namespace
+        return namespace
+
+    def namespace(self, name: str = None) -> "WomensHealthRAG":
+        """The WomensHealthRAG serving namespace `name` (the host's own kb for None)."""
+        if name is None:
+            return self._host
+        namespace = self.namespaces.get(name)
+        if namespace is None:
+            raise KeyError(f"Unknown kb namespace '{name}'")
+        return namespace
+
+    def load_generator(self):
+        """Load distilgpt2 if it isn't yet (blocking, only ever once at a time).
+        Returns the Generator, or None if loading failed."""
+        if self._host is not self:
+            return self._host.load_generator()
+        if self._generator is not None:
+            return self._generator
+        with self._generator_lock:
+            if self._generator is None:
+                self.generator_state = 'loading'
+                start = time.perf_counter()
+                try:
+                    self._generator = self._new_generator()
+                    self.generator_load_seconds = time.perf_counter() - start
+                    self.generator_error = None
+                    self.generator_state = 'ready'
+                except Exception as e:
+                    print(f"Could not load generation model: {e}")
+                    self.generator_error = str(e)
+                    self.generator_state = 'failed'
+        return self._generator
+
+    def _new_generator(self):
+        if self.generation_workers > 0:
+            from chat.generation_pool import GenerationPool
+            pool = GenerationPool(
+                self.generation_model_path,
+                workers=self.generation_workers,
+                max_queue=self.generation_queue_size,
+                timeout=self.generation_timeout,
+                device=self.device,
+                max_batch=self.generation_batch_size,
+                inference=self.generation_inference,
+                threads=self.generation_threads,
+                metrics=self.metrics
+            ).start()
+            if not pool.wait_ready():
+                pool.stop()
+                raise RuntimeError(pool.last_error or "no generation worker started")
+            return pool
+        
+        # transformers + the model weights only get pulled in here
+        from chat.generator import Generator, pin_threads
+        pin_threads(self.generation_threads)
+        generator = Generator(self.generation_model_path, device=self.device,
+                              inference=self.generation_inference, metrics=self.metrics)
+        if self.generation_batch_size > 1:
+            generator.enable_batching(max_batch=self.generation_batch_size)
+        return generator
+
+    def warm_generator(self) -> threading.Thread:
+        """Start loading distilgpt2 on a background thread, if nothing has started it yet"""
+        if self._host is not self:
+            return self._host.warm_generator()
+        with self._warmup_lock:
+            if self._generator_thread is None and self._generator is None:
+                self.generator_state = 'loading'
+                self._generator_thread = threading.Thread(
+                    target=self.load_generator,
+                    name="rag-generator-warmup",
+                    daemon=True
+                )
+                self._generator_thread.start()
+            return self._generator_thread
+
+    @property
+    def generator_ready(self) -> bool:
+        return self._host._generator is not None
+
+    @property
+    def using_finetuned(self) -> bool:
+        generator = self._host._generator
+        return bool(generator and generator.using_finetuned)
+
+    def generator_status(self) -> Dict:
+        if self._host is not self:
+            return self._host.generator_status()
+        return {
+            'state': self.generator_state,
+            'ready': self.generator_ready,
+            'model_path': self.generation_model_path,
+            'using_finetuned': self.using_finetuned,
+            'device': self.device,
+            'load_seconds': self.generator_load_seconds,
+            'error': self.generator_error,
+            'stats': self._generator.stats() if self._generator is not None else None
+        }
+
+    def _read_kb(self) -> pd.DataFrame:
+        kb = load_kb_csv(self.knowledge_base_path)
+        print(f"   Loaded {len(kb)} Q&A pairs")
+        
+        # replay feedback that hasn't been compacted into the csv yet
+        records, self._journal_position = self.journal.read()
+        self._own_journaled.clear()
+        journaled = _unseen_rows(kb, records)
+        if journaled:
+            for record in journaled:
+                if record['key'] not in self.embedding_cache:
+                    self.embedding_cache.put(record['key'], record['embedding'])
+            kb = pd.concat([kb, pd.DataFrame({
+                'instruction': [r['instruction'] for r in journaled],
+                'output': [r['output'] for r in journaled]
+            })], ignore_index=True)
+            print(f"   Replayed {len(journaled)} Q&A pairs from {self.journal.path}")
+        return kb
+
+    def _load_kb(self, show_progress_bar: bool = False):
+        if self.artifact is not None:
+            return self._load_artifact(self.artifact)
+        
+        # pandas stops here, everything after ingest reads the columnar TextStore
+        kb = self._read_kb()
+        questions, answers = kb['instruction'].astype(str).tolist(), kb['output'].astype(str).tolist()
+        topics = kb['topic'].fillna('').astype(str).tolist() if 'topic' in kb.columns else None
         print("Creating knowledge base embeddings...")
-        self.kb_embeddings = self.embedder.encode(
-            self.kb['instruction'].tolist(),
-            show_progress_bar=True,
-            batch_size=32
+        keys, embeddings = self._embed(questions, show_progress_bar=show_progress_bar)
+        self._source = (list(keys), list(answers))
+        self._save_embedding_cache(keys)
+        
+        texts, aliases = TextStore(), AliasTable()
+        keep = self._collapse(questions, answers, keys, embeddings, aliases)
+        keys = [keys[i] for i in keep]
+        texts.extend([questions[i] for i in keep], [answers[i] for i in keep])
+        embeddings = embeddings[keep]
+        
+        matrix = self._new_matrix(embeddings, keys)
+        if self.quantization:
+            self.quantization_stats = quantization_report(matrix, embeddings)
+            print(f"   Quantized kb matrix: {self.quantization_stats}")
+        bm25 = BM25Index()
+        bm25.add(texts.documents())
+        shards = self._new_shards(matrix, None if topics is None else [topics[i] for i in keep])
+        return texts, keys, matrix, bm25, aliases, shards
+
+    def _load_artifact(self, artifact: KBArtifact):
+        if artifact.model != EMBEDDING_MODEL:
+            raise ValueError(f"{artifact.path} was built with {artifact.model}, this app embeds "
+                             f"queries with {EMBEDDING_MODEL}, rebuild it with chat/build_kb.py")
+        texts, keys, aliases = artifact.texts, list(artifact.keys), artifact.aliases
+        matrix = self._new_matrix(artifact.embeddings, keys, normalized=True)
+        if self.quantization:
+            self.quantization_stats = quantization_report(matrix, artifact.embeddings)
+        bm25 = artifact.bm25()
+        print(f"   Opened kb artifact {artifact.version}: {len(keys)} Q&A pairs, {len(aliases)} aliases")
+        
+        # feedback journaled since the build
+        self._replay_journal(texts, keys, matrix, bm25, aliases)
+        return texts, keys, matrix, bm25, aliases, self._new_shards(matrix, artifact.topics)
+
+    def _new_shards(self, matrix, topics: List[str] = None):
+        # ShardRouter over the kb matrix, or None when sharding is off
+        if not self.sharding:
+            return None
+        router = ShardRouter(matrix, self.index_type, self.index_params,
+                             probe=self.shard_probe, min_margin=self.shard_min_margin)
+        if self.sharding == 'topic':
+            return router.build(labels=topics if topics is not None else [])
+        return router.build(n_shards=DEFAULT_SHARDS if self.sharding is True else int(self.sharding))
+
+    def _unseen_journal(self, texts: TextStore, keys: List[str], aliases: AliasTable) -> List[Dict]:
+        # journal records not in the kb yet, matched by question hash then answer text
+        # (a record that was collapsed into an alias matches its canonical row). reads
+        # the whole journal, _journal_tail() only reads what was added since
+        records, self._journal_position = self.journal.read()
+        self._own_journaled.clear()
+        rows: Dict[str, List[int]] = {}
+        for i, key in enumerate(keys):
+            rows.setdefault(key, []).append(i)
+        for key, row in zip(aliases.keys, aliases.rows):
+            rows.setdefault(key, []).append(row)
+        unseen, seen = [], set()
+        for record in records:
+            pair = (record['instruction'], record['output'])
+            answer = normalize_query(record['output'])
+            if pair in seen or any(normalize_query(texts.answer(i)) == answer for i in rows.get(record['key'], ())):
+                continue
+            seen.add(pair)
+            unseen.append(record)
+        return unseen
+
+    def _journal_tail(self) -> List[Dict]:
+        # records journaled since the last read, minus this process's own (already in
+        # the kb). only the new lines are decoded, nothing is compared against the kb
+        records, self._journal_position = self.journal.read(self._journal_position)
+        tail = []
+        for record in records:
+            pair = (record['key'], record['output'])
+            if self._own_journaled[pair]:
+                self._own_journaled[pair] -= 1
+                continue
+            tail.append(record)
+        return tail
+
+    def _replay_journal(self, texts: TextStore, keys: List[str], matrix, bm25, aliases: AliasTable,
+                        index=None, shards=None, tail: bool = False) -> List[Dict]:
+        # journal records that aren't in the kb yet, appended past its end. returns them
+        records = self._journal_tail() if tail else self._unseen_journal(texts, keys, aliases)
+        if not records:
+            return records
+        for record in records:
+            if record['key'] not in self.embedding_cache:
+                self.embedding_cache.put(record['key'], record['embedding'])
+        self._append_rows(texts, keys, matrix, bm25, aliases,
+                          [r['instruction'] for r in records], [r['output'] for r in records],
+                          [r['key'] for r in records], np.stack([r['embedding'] for r in records]),
+                          index=index, shards=shards)
+        print(f"   Replayed {len(records)} Q&A pairs from {self.journal.path}")
+        return records
+
+    def _collapse(self, questions: List[str], answers: List[str], keys: List[str], embeddings,
+                  aliases: AliasTable, kb: KBSnapshot = None) -> np.ndarray:
+        # positions of the new rows that need a kb row of their own; the others are
+        # near-duplicates of an earlier new row (or of a row in kb) and go into aliases
+        if self.duplicate_threshold is None:
+            return np.arange(len(keys))
+        start = kb.size if kb is not None else 0
+        keep, dupes, rows = collapse(
+            embeddings, answers, start=start,
+            search=kb.search if kb is not None else None,
+            answer_of=kb.answer if kb is not None else None,
+            threshold=self.duplicate_threshold
         )
+        if len(dupes):
+            aliases.add(rows, [keys[i] for i in dupes], [questions[i] for i in dupes])
+            print(f"   Collapsed {len(dupes)} near-duplicate Q&A pairs into aliases")
+        return keep
+
+    def _append_rows(self, texts: TextStore, keys: List[str], matrix, bm25, aliases: AliasTable,
+                     questions: List[str], answers: List[str], new_keys: List[str], embeddings,
+                     index=None, shards=None) -> int:
+        # new rows past the end of the (shared, append-only) kb structures, near-duplicates
+        # go into aliases instead. returns how many rows were appended
+        kb = KBSnapshot(-1, texts, keys, matrix, index if index is not None else make_index('brute', matrix),
+                        bm25, aliases)
+        start, alias_start = len(keys), len(aliases)
+        try:
+            keep = self._collapse(questions, answers, new_keys, embeddings, aliases, kb)
+            if not len(keep):
+                return 0
+            ids = matrix.append(np.asarray(embeddings)[keep])
+            if index is not None:
+                index.add(ids)
+            if shards is not None:
+                shards.add(ids)
+            keys.extend(new_keys[i] for i in keep)
+            texts.extend([questions[i] for i in keep], [answers[i] for i in keep])
+            bm25.add(texts.documents(start, len(keys)))
+        except Exception:
+            # roll every structure back to `start` rows, a half-done append would put the
+            # next rows at different ids in each of them. nothing was published, so no
+            # snapshot has seen the dropped rows
+            texts.truncate(start)
+            del keys[start:]
+            bm25.truncate(start)
+            if shards is not None:
+                shards.truncate(start)
+            if index is not None:
+                index.truncate(start)
+            matrix.truncate(start)
+            aliases.truncate(alias_start)
+            raise
+        return len(keep)
+
+    def _publish(self, texts: TextStore, keys: List[str], matrix, index, bm25, aliases: AliasTable,
+                 shards=None):
+        # single reference swap, requests already running keep the snapshot they took
+        version = 0 if self._snapshot is None else self._snapshot.version + 1
+        self._snapshot = KBSnapshot(version, texts, keys, matrix, index, bm25, aliases, shards)
+        # cached answers were built from the old kb
+        self.answer_cache.clear()
+        self.context_cache.clear()
+
+    @property
+    def snapshot(self) -> KBSnapshot:
+        return self._snapshot
+
+    # read-only views of the current snapshot
+    @property
+    def texts(self) -> TextStore:
+        return self._snapshot.texts
+
+    @property
+    def index(self):
+        return self._snapshot.index
+
+    @property
+    def bm25(self) -> BM25Index:
+        return self._snapshot.bm25
+
+    @property
+    def kb_version(self) -> int:
+        return self._snapshot.version
+
+    def _new_matrix(self, embeddings: np.ndarray, keys: List[str], normalized: bool = False):
+        # normalized=True: rows are already unit length (a built artifact), use them as is
+        if not self.quantization:
+            return GrowableMatrix.wrap(embeddings) if normalized else GrowableMatrix(embeddings)
         
-        # laod fine tuned distilgpt 
-        print(f"Loading fine-tuned DistilGPT2 from {generation_model_path}...")
+        cache = self.embedding_cache
+        base = embeddings if normalized else None
+        def exact(ids):
+            # exact float32 rows for re-ranking, read from the artifact / embedding cache mmap
+            rows = [np.asarray(base[i]) if base is not None and i < len(base) else cache.get(keys[i])
+                    for i in ids]
+            if any(row is None for row in rows):
+                raise KeyError("row missing from embedding cache")
+            return np.stack(rows)
         
-        if os.path.exists(generation_model_path):
+        return QuantizedMatrix(embeddings, mode=self.quantization, dim=embeddings.shape[1], exact=exact)
+
+    def _embed(self, instructions: List[str], show_progress_bar: bool = False):
+        embeddings = self.embedding_cache.encode(
+            self.embedder,
+            instructions,
+            show_progress_bar=show_progress_bar,
+            batch_size=32
+        )
+        return [text_hash(t) for t in instructions], embeddings
+
+    def _save_embedding_cache(self, keys: List[str]):
+        try:
+            self.embedding_cache.save(keep=keys)
+        except OSError as e:
+            print(f"Could not save embedding cache: {e}")
+
+    def _index_path(self) -> str:
+        # an index shipped in the artifact is loaded from there (and never written to)
+        if self.artifact is not None and self.artifact.index_path(self.index_type):
+            return self.artifact.index_path(self.index_type)
+        return os.path.splitext(self.knowledge_base_path)[0] + f".{self.index_type}.npz"
+
+    def _open_index(self, matrix: GrowableMatrix, keys: List[str]):
+        index = make_index(self.index_type, matrix, **self.index_params)
+        path = self._index_path()
+
+        # reuse the saved index if it was built from a prefix of the current kb
+        if os.path.exists(path):
             try:
-                self.gen_tokenizer = AutoTokenizer.from_pretrained(
-                    generation_model_path,
-                    local_files_only=True
-                )
-                if self.gen_tokenizer.pad_token is None:
-                    self.gen_tokenizer.pad_token = self.gen_tokenizer.eos_token
-                
-                self.gen_model = AutoModelForCausalLM.from_pretrained(
-                    generation_model_path,
-                    torch_dtype=torch.float32,
-                    local_files_only=True
-                )
-                self.gen_model.to(self.device)
-                self.gen_model.eval()
-                print("Fine-tuned DistilGPT2 loaded successfully!")
-                self.using_finetuned = True
+                rows, fingerprint = index.load(path)
+                if 0 < rows <= len(keys) and fingerprint == kb_fingerprint(keys, rows):
+                    index.add(np.arange(rows, len(matrix)))
+                    print(f"   Loaded {self.index_type} index ({rows} rows) from {path}")
+                    return index
             except Exception as e:
-                print(f"Could not load fine-tuned model: {e}")
-                print("   Falling back to base DistilGPT2...")
-                self._load_base_model()
-        else:
-            print(f"Path {generation_model_path} not found")
-            print("   Falling back to base DistilGPT2...")
-            self._load_base_model()
-        
-    
-    def _load_base_model(self):
-        self.gen_tokenizer = AutoTokenizer.from_pretrained("distilgpt2")
-        self.gen_tokenizer.pad_token = self.gen_tokenizer.eos_token
-        self.gen_model = AutoModelForCausalLM.from_pretrained(
-            "distilgpt2",
-            torch_dtype=torch.float32
-        )
-        self.gen_model.to(self.device)
-        self.gen_model.eval()
-        self.using_finetuned = False
-    
+                print(f"Could not load saved index, rebuilding: {e}")
+
+        index = make_index(self.index_type, matrix, **self.index_params)
+        index.build()
+        self._save_index(index, keys)
+        return index
+
+    def _save_index(self, index, keys: List[str]):
+        if self.artifact is not None and self._index_path().startswith(self.artifact.path):
+            return
+        try:
+            index.save(self._index_path(), kb_fingerprint(keys, len(keys)))
+        except OSError as e:
+            print(f"Could not save {self.index_type} index: {e}")
+
+    def save_index(self):
+        with self._write_lock:
+            snap = self._snapshot
+            self._save_index(snap.index, snap.keys)
+
     def retrieve_context(self, query: str, top_k: int = 3) -> List[Dict]:
-        query_embedding = self.embedder.encode([query])[0]
+        # includes time spent waiting for the micro-batcher
+        with self.metrics.span('retrieve'):
+            if self._retrieval_batcher is not None:
+                context, spans = self._retrieval_batcher.submit((query, top_k))
+                self.metrics.add_to_request(spans)
+                return context
+            return self.retrieve_context_batch([query], top_k=top_k)[0]
+
+    def _encode_queries(self, queries: List[str]) -> np.ndarray:
+        # one encode() call for every query that isn't in the query cache
+        cached = [self.query_cache.get(q) for q in queries]
+        missing = list(dict.fromkeys(q for q, v in zip(queries, cached) if v is None))
+        if missing:
+            fresh = dict(zip(missing, normalize(self.embedder.encode(missing, batch_size=32))))
+            for query, embedding in fresh.items():
+                self.query_cache.put(query, embedding)
+            cached = [v if v is not None else fresh[q] for q, v in zip(queries, cached)]
+        return np.stack(cached)
+
+    def retrieve_context_batch(self, queries: List[str], top_k=3) -> List[List[Dict]]:
+        # one encode() call for all queries, and one matrix-matrix product per distinct
+        # top_k (one k for every query or one per query)
+        with self.metrics.span('retrieve.encode'):
+            query_embeddings = self._encode_queries(queries)
         
-        similarities = np.dot(self.kb_embeddings, query_embedding) / (
-            np.linalg.norm(self.kb_embeddings, axis=1) * np.linalg.norm(query_embedding)
-        )
+        # one snapshot for the whole batch, rows added after this are not seen
+        snap = self._snapshot
+        top_ks = [top_k] * len(queries) if isinstance(top_k, int) else list(top_k)
+        
+        # k changes which rows get fused, so a query is only searched with others
+        # asking for the same k and never depends on its batch-mates
+        results = [None] * len(queries)
+        for k in dict.fromkeys(top_ks):
+            rows = [i for i, query_k in enumerate(top_ks) if query_k == k]
+            contexts = self._retrieve(snap, [queries[i] for i in rows], query_embeddings[rows], k)
+            for i, context in zip(rows, contexts):
+                results[i] = context
+        return results
+
+    def _retrieve(self, snap: KBSnapshot, queries: List[str], query_embeddings: np.ndarray,
+                  top_k: int) -> List[List[Dict]]:
+        # rows are pre-normalized so index scores are already cosine similarity
+        if not self.hybrid:
+            with self.metrics.span('retrieve.dense'):
+                hits = snap.search(query_embeddings, top_k)
+            with self.metrics.span('retrieve.context'):
+                return [self._build_context(snap, ids, similarities) for ids, similarities in hits]
         
-        top_indices = np.argsort(similarities)[-top_k:][::-1]
+        depth = max(top_k, self.rrf_depth)
+        prefilter = snap.size >= self.prefilter_min_rows
+        with self.metrics.span('retrieve.lexical'):
+            lexical = [
+                snap.lexical_search(query, self.prefilter_candidates if prefilter else depth)
+                for query in queries
+            ]
         
-        relevant_context = []
-        for idx in top_indices:
-            relevant_context.append({
-                'question': self.kb.iloc[idx]['instruction'],
-                'answer': self.kb.iloc[idx]['output'],
-                'similarity': float(similarities[idx])
-            })
+        # on big kbs only score the lexical candidates densely, unless there are too few
+        needs_full_scan = [not prefilter or len(ids) < top_k for ids, _, _ in lexical]
+        with self.metrics.span('retrieve.dense'):
+            full_scan = snap.search(query_embeddings, depth) if any(needs_full_scan) else None
+        
+        with self.metrics.span('retrieve.fuse'):
+            return self._fuse(snap, query_embeddings, lexical, needs_full_scan, full_scan, top_k, depth)
+
+    def _fuse(self, snap: KBSnapshot, query_embeddings, lexical, needs_full_scan, full_scan,
+              top_k: int, depth: int) -> List[List[Dict]]:
+        matrix = snap.matrix
+        results = []
+        for i, query_embedding in enumerate(query_embeddings):
+            lexical_ids, _, coverage = lexical[i]
+            if needs_full_scan[i]:
+                dense_ids = full_scan[i][0]
+            else:
+                if snap.shards is not None:
+                    # same routing as snap.search: only the candidates in the query's shards
+                    keep = snap.shards.restrict(query_embedding, lexical_ids, top_k)
+                    if keep is not None:
+                        lexical_ids, coverage = lexical_ids[keep], coverage[keep]
+                candidate_scores = matrix.rows(lexical_ids) @ query_embedding
+                dense_ids = lexical_ids[top_k_indices(candidate_scores, depth)]
+            
+            fused = reciprocal_rank_fusion([dense_ids, lexical_ids[:depth]], k=self.rrf_k)[:top_k]
+            dense = matrix.exact_rows(fused) @ query_embedding
+            coverage_by_id = dict(zip(lexical_ids.tolist(), coverage.tolist()))
+            lexical_scores = np.array([coverage_by_id.get(int(idx), 0.0) for idx in fused])
+            
+            # keyword matches can lift a row over the generate threshold, never to a direct answer
+            similarities = np.maximum(dense, self.lexical_weight * lexical_scores)
+            # rrf only picks the candidates: callers decide direct/generate/fallback on
+            # context[0], so a strong dense row must not sit behind a keyword hit
+            order = np.argsort(-similarities, kind='stable')
+            fused, similarities = fused[order], similarities[order]
+            dense, lexical_scores = dense[order], lexical_scores[order]
+            results.append(self._build_context(snap, fused, similarities, dense, lexical_scores))
         
+        return results
+
+    @staticmethod
+    def _build_context(snap: KBSnapshot, ids, similarities, dense=None, lexical=None) -> List[Dict]:
+        relevant_context = []
+        for i, idx in enumerate(ids):
+            ctx = {
+                'id': int(idx),
+                'question': snap.question(idx),
+                'answer': snap.answer(idx),
+                'similarity': float(similarities[i])
+            }
+            if dense is not None:
+                ctx['dense'] = float(dense[i])
+                ctx['lexical'] = float(lexical[i])
+            relevant_context.append(ctx)
         return relevant_context
+
+    def enable_micro_batching(self, max_batch: int = 32, max_wait_ms: float = 5.0):
+        """Batch retrieve_context calls from concurrent threads into one encode() call."""
+        def handle(items):
+            queries = [query for query, _ in items]
+            # the retrieve.* spans run on this thread, every caller gets the batch's
+            # timings back for its own X-Debug-Timing block
+            with self.metrics.request() as timer:
+                contexts = self.retrieve_context_batch(queries, top_k=[k for _, k in items])
+            return [(context, timer.spans) for context in contexts]
+
+        self._retrieval_batcher = MicroBatcher(
+            handle,
+            max_batch=max_batch,
+            max_wait_ms=max_wait_ms,
+            name="rag-retrieval-batcher"
+        )
     
-    def generate_response_simple(self, user_query: str, top_k: int = 3, verbose: bool = False, 
-                                similarity_threshold: float = 0.5, regenerate: bool = False) -> Dict:
+    def _prepare_response(self, user_query: str, top_k: int, verbose: bool, regenerate: bool):
+        # (cache key, cached answer or None, retrieval context)
+        snap = self._snapshot
+        cache_key = (snap.version, top_k, normalize_query(user_query))
+        if not regenerate:
+            with self.metrics.span('response.cache'):
+                cached = self.answer_cache.get(cache_key)
+            if cached is not None:
+                if verbose:
+                    print("Answer cache hit - returning direct answer")
+                return cache_key, self._cached_response(snap, cached), None
 
-        context = self.retrieve_context(user_query, top_k=top_k)
-        max_similarity = context[0]['similarity']
+        # regenerating the answer we just gave: reuse its retrieval
+        context = self.context_cache.get(cache_key) if regenerate else None
+        if context is None:
+            context = self.retrieve_context(user_query, top_k=top_k)
+        elif verbose:
+            print("Reusing cached retrieval context for regeneration")
         
         if verbose:
             print(f"Retrieved {len(context)} relevant examples:")
             for i, ctx in enumerate(context, 1):
                 print(f"   {i}. {ctx['question'][:50]}... (similarity: {ctx['similarity']:.3f})")
-            print(f"Max similarity: {max_similarity:.3f}")
+            print(f"Max similarity: {context[0]['similarity']:.3f}")
+        return cache_key, None, context
+
+    def _direct_response(self, context: List[Dict], cache_key, verbose: bool = False) -> Dict:
+        if verbose:
+            print("✨ High similarity - using direct answer with context")
         
-        # high similarity - direct answer
-        if max_similarity > 0.75:
-            if verbose:
-                print("✨ High similarity - using direct answer with context")
-            
-            base_answer = context[0]['answer']
-            additional_info = []
-            for ctx in context[1:]:
-                if ctx['similarity'] > 0.7 and ctx['answer'] != context[0]['answer']:
-                    additional_info.append(ctx['answer'])
-            
-            reply = f"{base_answer}\n\nAdditionally, {additional_info[0]}" if additional_info else base_answer
-            
+        base = context[0]
+        used = [base]
+        for ctx in context[1:]:
+            if ctx['similarity'] > 0.7 and ctx['answer'] != base['answer']:
+                used.append(ctx)
+                break
+        
+        # the cache only keeps row ids, on a hit the text is read back from the snapshot
+        self.answer_cache.put(cache_key, {
+            'rows': [ctx['id'] for ctx in used],
+            'similarity': base['similarity']
+        })
+        return self._direct_reply([ctx['answer'] for ctx in used], base['similarity'])
+
+    @staticmethod
+    def _direct_reply(answers: List[str], similarity: float) -> Dict:
+        reply = f"{answers[0]}\n\nAdditionally, {answers[1]}" if len(answers) > 1 else answers[0]
+        return {
+            'reply': reply,
+            'needs_feedback': False,
+            'similarity': similarity,
+            'response_type': 'direct'
+        }
+
+    def _cached_response(self, snap: KBSnapshot, cached: Dict) -> Dict:
+        # cache keys carry snap.version and every publish clears the cache, so the
+        # ids still point at the rows they were cached for
+        return self._direct_reply([snap.answer(i) for i in cached['rows']], cached['similarity'])
+
+    def _token_budget(self, max_new_tokens: int = None) -> int:
+        if max_new_tokens is None:
+            return self.max_new_tokens
+        return max(1, min(int(max_new_tokens), self.max_new_tokens))
+
+    def _degraded_response(self, context: List[Dict], reason: str, verbose: bool = False) -> Dict:
+        # no generation right now (model still loading, queue full, timed out), best
+        # direct match instead. not cached, the same question can be generated later
+        if verbose:
+            print(f"No generation ({reason}) - using direct answer")
+        return {
+            'reply': context[0]['answer'],
+            'needs_feedback': False,
+            'similarity': context[0]['similarity'],
+            'response_type': 'direct'
+        }
+
+    def _generated_response(self, reply: str, context: List[Dict], cache_key,
+                            verbose: bool = False) -> Dict:
+        # None when the generation was too poor and there's no good direct answer either
+        max_similarity = context[0]['similarity']
+        if reply and len(reply) > 20:
+            self.context_cache.put(cache_key, context)
             return {
                 'reply': reply,
+                'needs_feedback': True,
+                'similarity': max_similarity,
+                'response_type': 'generated'
+            }
+        
+        if verbose:
+            print("Generation produced poor output - falling back")
+        if max_similarity > 0.6:
+            return {
+                'reply': context[0]['answer'],
                 'needs_feedback': False,
                 'similarity': max_similarity,
                 'response_type': 'direct'
             }
+        return None
+
+    def _fallback_response(self, max_similarity: float, verbose: bool = False) -> Dict:
+        # Strategy 3: Low similarity - resources message
+        if verbose:
+            print("Low similarity - providing Resources tab message")
+        
+        return {
+            'reply': "I'm sorry, I can't provide an answer to that. Please see the resources tab for more information!",
+            'needs_feedback': False,
+            'similarity': max_similarity,
+            'response_type': 'fallback'
+        }
+
+    def generate_response_simple(self, user_query: str, top_k: int = 3, verbose: bool = False, 
+                                similarity_threshold: float = 0.5, regenerate: bool = False,
+                                max_new_tokens: int = None, timing: bool = False) -> Dict:
+        """timing=True adds a 'timing' block (span name -> ms) for this request"""
+        with self.metrics.request(timing) as timer:
+            start = time.perf_counter()
+            response = self._respond(user_query, top_k, verbose, similarity_threshold,
+                                     regenerate, max_new_tokens)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.metrics.observe('response', elapsed_ms)
+            # also split by outcome, a cached direct answer and a generation aren't comparable
+            self.metrics.histogram(f"response.{response['response_type']}").observe(elapsed_ms)
+        if timer is not None:
+            response['timing'] = timer.as_dict()
+        return response
+
+    def _respond(self, user_query: str, top_k: int, verbose: bool, similarity_threshold: float,
+                 regenerate: bool, max_new_tokens: int) -> Dict:
+        cache_key, cached, context = self._prepare_response(user_query, top_k, verbose, regenerate)
+        if cached is not None:
+            return cached
+        max_similarity = context[0]['similarity']
+        
+        # high similarity - direct answer
+        if max_similarity > 0.75:
+            return self._direct_response(context, cache_key, verbose)
         
         # medium similarity - generate answer
         elif max_similarity > similarity_threshold:
+            generator = self._host._generator
+            if generator is None:
+                self.warm_generator()
+                return self._degraded_response(context, f"model {self._host.generator_state}", verbose)
+            
             if verbose:
-                model_type = "fine-tuned DistilGPT2" if self.using_finetuned else "base DistilGPT2"
+                model_type = "fine-tuned DistilGPT2" if generator.using_finetuned else "base DistilGPT2"
                 print(f"Medium similarity - using {model_type} for generation")
             
-            context_str = ""
-            for ctx in context[:2]:
-                context_str += f"Q: {ctx['question']}\nA: {ctx['answer']}\n\n"
-            
-            if self.using_finetuned:
-                prompt = f"<|user|>\n{user_query}\n<|assistant|>\n"
-            else:
-                prompt = f"Based on this information:\n\n{context_str}\nQuestion: {user_query}\nAnswer:"
-            
-            inputs = self.gen_tokenizer(
-                prompt,
-                return_tensors="pt",
-                truncation=True,
-                max_length=512
-            ).to(self.device)
-            
-            # adjust temperature for regeneration
-            temperature = 0.9 if regenerate else 0.7
+            try:
+                with self.metrics.span('generate.prompt'):
+                    prompt = generator.build_prompt(user_query, context)
+                # adjust temperature for regeneration
+                with self.metrics.span('generate'):
+                    reply = generator.generate(
+                        prompt,
+                        temperature=0.9 if regenerate else 0.7,
+                        max_new_tokens=self._token_budget(max_new_tokens)
+                    )
+            except GenerationUnavailable as e:
+                return self._degraded_response(context, str(e), verbose)
             
-            with torch.no_grad():
-                output_ids = self.gen_model.generate(
-                    **inputs,
-                    max_new_tokens=100,
-                    do_sample=True,
-                    top_k=50,
-                    top_p=0.9,
-                    temperature=temperature,
-                    repetition_penalty=1.15,
-                    pad_token_id=self.gen_tokenizer.pad_token_id,
-                    eos_token_id=self.gen_tokenizer.eos_token_id
-                )
+            if verbose:
+                print(f"Generated: {reply[:100]}...")
             
-            full_output = self.gen_tokenizer.decode(output_ids[0], skip_special_tokens=True)
+            with self.metrics.span('generate.postprocess'):
+                response = self._generated_response(reply, context, cache_key, verbose)
+            if response is not None:
+                return response
+        
+        return self._fallback_response(max_similarity, verbose)
+
+    def stream_response(self, user_query: str, top_k: int = 3, similarity_threshold: float = 0.5,
+                        regenerate: bool = False, max_new_tokens: int = None) -> Iterator[Dict]:
+        """Same answer as generate_response_simple, as events for /api/chatbot/stream:
+
+            {'type': 'token', 'text': ...}    reply text as it decodes
+            {'type': 'done', 'reply': ..., 'needs_feedback': ..., 'similarity': ...,
+             'response_type': ..., 'ttft_ms': ..., 'total_ms': ...}
+
+        the 'done' reply is the final one; a poor generation is replaced by the
+        direct/fallback answer there, so clients should render it over the tokens.
+        """
+        start = time.perf_counter()
+        first_token = None
+        response = None
+        try:
+            cache_key, response, context = self._prepare_response(user_query, top_k, False, regenerate)
+            if response is None:
+                max_similarity = context[0]['similarity']
+                if max_similarity > 0.75:
+                    response = self._direct_response(context, cache_key)
+                elif max_similarity > similarity_threshold and self._host._generator is None:
+                    self.warm_generator()
+                    response = self._degraded_response(context, f"model {self._host.generator_state}")
+                elif max_similarity > similarity_threshold:
+                    generator = self._host._generator
+                    chunks = []
+                    try:
+                        for text in generator.stream(generator.build_prompt(user_query, context),
+                                                     temperature=0.9 if regenerate else 0.7,
+                                                     max_new_tokens=self._token_budget(max_new_tokens)):
+                            if first_token is None:
+                                first_token = time.perf_counter()
+                            chunks.append(text)
+                            yield {'type': 'token', 'text': text}
+                        response = self._generated_response("".join(chunks).strip(), context, cache_key)
+                    except GenerationUnavailable as e:
+                        # the done event carries the direct answer in place of what streamed so far
+                        response = self._degraded_response(context, str(e))
+                if response is None:
+                    response = self._fallback_response(max_similarity)
             
-            if self.using_finetuned and "<|assistant|>" in full_output:
-                reply = full_output.split("<|assistant|>")[-1].strip()
-                reply = reply.split("<|user|>")[0].strip()
-                reply = reply.split("<|endoftext|>")[0].strip()
-            elif "Answer:" in full_output:
-                reply = full_output.split("Answer:")[-1].strip()
-            else:
-                reply = full_output[len(prompt):].strip()
+            if first_token is None:
+                # direct answers arrive in one piece
+                first_token = time.perf_counter()
+                yield {'type': 'token', 'text': response['reply']}
+        finally:
+            # also runs when the client disconnects mid-stream
+            end = time.perf_counter()
+            timing = {
+                'ttft_ms': None if first_token is None else (first_token - start) * 1000,
+                'total_ms': (end - start) * 1000,
+                'response_type': response['response_type'] if response else None
+            }
+            self.stream_timings.append(timing)
+        
+        yield dict(response, type='done', ttft_ms=timing['ttft_ms'], total_ms=timing['total_ms'])
+
+    def add_to_dataset(self, question: str, answer: str) -> bool:
+
+        try:
+            with self.metrics.span('add_to_dataset'):
+                self._add(question.strip(), answer.strip())
+            return True
+        except Exception as e:
+            print(f"Error adding to dataset: {e}")
+            return False
+
+    def _add(self, question: str, answer: str):
+        key = text_hash(question)
+        with self.metrics.span('add_to_dataset.embed'):
+            new_embedding = self.embedding_cache.encode(self.embedder, [question])
+        if not np.isfinite(new_embedding).all():
+            # a nan row would be journaled for good and rank first in every top-k
+            raise ValueError(f"non-finite embedding for {question[:50]!r}")
+        
+        with self.metrics.span('add_to_dataset.lock_wait'):
+            self._write_lock.acquire()
+        try:
+            # durable first: one fsync'd journal line instead of rewriting the csv
+            with self.metrics.span('add_to_dataset.journal'):
+                self.journal.append(question, answer, key, new_embedding[0])
             
-            reply = reply.split("\n\n")[0].strip()
+            # append past the end of the live snapshot (its readers stop at snap.size),
+            # then publish a snapshot that includes the new row (or the new alias, when
+            # it's a paraphrase of a row with the same answer)
+            with self.metrics.span('add_to_dataset.index'):
+                snap = self._snapshot
+                appended = self._append_rows(snap.texts, snap._keys, snap.matrix, snap.bm25, snap.aliases,
+                                             [question], [answer], [key], new_embedding, index=snap.index,
+                                             shards=snap.shards)
+                self._publish(snap.texts, snap._keys, snap.matrix, snap.index, snap.bm25, snap.aliases, snap.shards)
+                if self._source is not None:
+                    self._source[0].append(key)
+                    self._source[1].append(answer)
+                self._own_journaled[(key, answer)] += 1
             
-            if verbose:
-                print(f"Generated: {reply[:100]}...")
+            print(f"Added to dataset{'' if appended else ' as an alias'}: {question[:50]}...")
             
-            if reply and len(reply) > 20:
-                return {
-                    'reply': reply,
-                    'needs_feedback': True,
-                    'similarity': max_similarity,
-                    'response_type': 'generated'
-                }
-            else:
-                if verbose:
-                    print("Generation produced poor output - falling back")
-                if max_similarity > 0.6:
-                    return {
-                        'reply': context[0]['answer'],
-                        'needs_feedback': False,
-                        'similarity': max_similarity,
-                        'response_type': 'direct'
-                    }
+            if self.artifact is None and len(self.journal) >= self.journal_compact_every:
+                with self.metrics.span('add_to_dataset.compact'):
+                    self.compact_journal()
+        finally:
+            self._write_lock.release()
+
+    def stats(self) -> Dict:
+        snap = self._snapshot
+        return {
+            'namespace': self.namespace_name,
+            'namespaces': sorted(self.namespaces),
+            'kb_rows': snap.size,
+            'kb_aliases': snap.alias_count,
+            'kb_version': snap.version,
+            'kb_matrix_bytes': snap.matrix.nbytes,
+            'kb_text_bytes': snap.texts.nbytes,
+            'kb_artifact': None if self.artifact is None else self.artifact.version,
+            'quantization': self.quantization_stats,
+            'shards': None if snap.shards is None else snap.shards.stats(),
+            'answer_cache': self.answer_cache.stats(),
+            'query_cache': self.query_cache.stats(),
+            'context_cache': self.context_cache.stats(),
+            'streaming': self._stream_stats(),
+            'generator': self.generator_status()
+        }
+
+    def _stream_stats(self) -> Dict:
+        timings = list(self.stream_timings)
+        ttft = [t['ttft_ms'] for t in timings if t['ttft_ms'] is not None]
+        total = [t['total_ms'] for t in timings]
         
-        # Strategy 3: Low similarity - resources message
-        if verbose:
-            print("Low similarity - providing Resources tab message")
+        def percentiles(values):
+            if not values:
+                return None
+            p50, p95 = np.percentile(values, [50, 95])
+            return {'p50': float(p50), 'p95': float(p95)}
         
         return {
-            'reply': "I'm sorry, I can't provide an answer to that. Please see the resources tab for more information!",
-            'needs_feedback': False,
-            'similarity': max_similarity,
-            'response_type': 'fallback'
+            'requests': len(timings),
+            'ttft_ms': percentiles(ttft),
+            'total_ms': percentiles(total)
         }
-    
-    def add_to_dataset(self, question: str, answer: str) -> bool:
 
-        try:
-
-            new_row = pd.DataFrame({
-                'instruction': [question.strip()],
-                'output': [answer.strip()]
-            })
-            self.kb = pd.concat([self.kb, new_row], ignore_index=True)
+    def compact_journal(self) -> int:
+        """Fold journaled feedback into the csv and embedding cache, then clear the journal"""
+        if self.artifact is not None:
+            print(f"Not compacting {self.journal.path}, rebuild the kb with chat/build_kb.py --journal")
+            return 0
+        with self._write_lock, self.journal.lock():
+            records = self.journal.replay()
+            if not records:
+                return 0
             
-            # Save to CSV
-            self.kb.to_csv(self.knowledge_base_path, index=False, quoting=csv.QUOTE_ALL)
+            # re-read from disk so rows journaled by other workers are kept too
+            kb = load_kb_csv(self.knowledge_base_path)
+            rows = _unseen_rows(kb, records)
+            kb = pd.concat([kb, pd.DataFrame({
+                'instruction': [r['instruction'] for r in rows],
+                'output': [r['output'] for r in rows]
+            })], ignore_index=True)
             
-            # Update embeddings for the new entry
-            new_embedding = self.embedder.encode([question.strip()])
-            self.kb_embeddings = np.vstack([self.kb_embeddings, new_embedding])
+            # the csv has to be on disk (file and rename) before the journal is emptied,
+            # or a crash in between loses the journaled feedback
+            atomic_write(self.knowledge_base_path,
+                         lambda f: kb.to_csv(f, index=False, quoting=csv.QUOTE_ALL),
+                         mode='w', encoding='utf-8', newline='')
+            self.journal.truncate()
+            self._journal_position = None
+            self._own_journaled.clear()
             
-            print(f"Added to dataset: {question[:50]}...")
+            for record in records:
+                if record['key'] not in self.embedding_cache:
+                    self.embedding_cache.put(record['key'], record['embedding'])
+            snap = self._snapshot
+            self.embedding_cache.save(keep=snap.keys + snap.alias_keys)
+        
+        print(f"Compacted {len(rows)} journaled Q&A pairs into {self.knowledge_base_path}")
+        return len(rows)
+    
+    def reload_dataset(self):
+        """Reload dataset after external updates, only re-embedding rows that changed"""
+        if self.artifact is not None:
+            return self._reload_artifact()
+        try:
+            with self._write_lock:
+                kb = self._read_kb()
+                questions = kb['instruction'].astype(str).tolist()
+                outputs = kb['output'].astype(str).tolist()
+                keys = [text_hash(t) for t in questions]
+                snap = self._snapshot
+                old_keys, old_outputs = self._source
+                n_old = len(old_keys)
+                
+                if keys == old_keys and outputs == old_outputs:
+                    print("Dataset unchanged")
+                    return True
+                
+                if keys[:n_old] == old_keys and outputs[:n_old] == old_outputs:
+                    # rows were only appended, grow the shared matrix/index past the live
+                    # snapshot's size and publish one that covers them
+                    new_keys, embeddings = self._embed(questions[n_old:])
+                    appended = self._append_rows(snap.texts, snap._keys, snap.matrix, snap.bm25, snap.aliases,
+                                                 questions[n_old:], outputs[n_old:], new_keys, embeddings,
+                                                 index=snap.index, shards=snap.shards)
+                    self._publish(snap.texts, snap._keys, snap.matrix, snap.index, snap.bm25, snap.aliases, snap.shards)
+                    print(f"Dataset reloaded: {appended} rows appended, {len(snap._keys)} Q&A pairs")
+                else:
+                    # reuse embeddings for instructions we already have, encode the rest
+                    # (aliases come out of the embedding cache), rows that disappeared
+                    # from the file are simply not copied over
+                    old_rows = {}
+                    for i, key in enumerate(snap.keys):
+                        old_rows.setdefault(key, i)
+                    reused = [i for i, key in enumerate(keys) if key in old_rows]
+                    fresh = [i for i, key in enumerate(keys) if key not in old_rows]
+                    # aliases aren't kb rows, theirs come back out of the embedding cache
+                    encoded = len({keys[i] for i in fresh if keys[i] not in self.embedding_cache})
+                    
+                    embeddings = np.empty((len(keys), snap.matrix.dim), dtype=np.float32)
+                    embeddings[reused] = snap.matrix.exact_rows([old_rows[keys[i]] for i in reused])
+                    if fresh:
+                        _, fresh_embeddings = self._embed([questions[i] for i in fresh])
+                        embeddings[fresh] = fresh_embeddings
+                    
+                    # build everything off to the side, then publish it at once
+                    texts, aliases = TextStore(), AliasTable()
+                    keep = self._collapse(questions, outputs, keys, embeddings, aliases)
+                    kept_keys = [keys[i] for i in keep]
+                    texts.extend([questions[i] for i in keep], [outputs[i] for i in keep])
+                    matrix = self._new_matrix(embeddings[keep], kept_keys)
+                    index = snap.index.clone(matrix)
+                    bm25 = BM25Index()
+                    bm25.add(texts.documents())
+                    topics = kb['topic'].fillna('').astype(str).tolist() if 'topic' in kb.columns else None
+                    shards = self._new_shards(matrix, None if topics is None else [topics[i] for i in keep])
+                    self._publish(texts, kept_keys, matrix, index, bm25, aliases, shards)
+                    
+                    # a row whose question or answer changed is one gone pair + one new pair
+                    old_pairs, new_pairs = Counter(zip(old_keys, old_outputs)), Counter(zip(keys, outputs))
+                    gone = sum((old_pairs - new_pairs).values())
+                    added = sum((new_pairs - old_pairs).values())
+                    edited = min(gone, added)
+                    print(f"Dataset reloaded: {encoded} rows embedded, {edited} edited, {added - edited} added, "
+                          f"{gone - edited} removed, {len(keep)} Q&A pairs")
+                    self._save_index(index, kept_keys)
+                
+                self._source = (keys, outputs)
+                self._save_embedding_cache(keys)
             return True
         except Exception as e:
-            print(f"Error adding to dataset: {e}")
+            print(f"Error reloading dataset: {e}")
             return False
-    
-    def reload_dataset(self):
-        """Reload dataset and embeddings after external updates"""
+
+    def _reload_artifact(self):
+        # a new build was published (CURRENT changed) or other workers journaled feedback
         try:
-            self.kb = pd.read_csv(self.knowledge_base_path, on_bad_lines='skip', engine='python')
-            self.kb.columns = [c.strip().lower().replace("\ufeff", "") for c in self.kb.columns]
-            self.kb = self.kb.dropna(subset=['instruction', 'output'])
-            self.kb_embeddings = self.embedder.encode(self.kb['instruction'].tolist(), batch_size=32)
-            print(f"Dataset reloaded: {len(self.kb)} Q&A pairs")
+            with self._write_lock:
+                artifact = KBArtifact(self.knowledge_base_path)
+                if artifact.version != self.artifact.version:
+                    texts, keys, matrix, bm25, aliases, shards = self._load_artifact(artifact)
+                    self.artifact = artifact
+                    self._publish(texts, keys, matrix, self._open_index(matrix, keys), bm25, aliases, shards)
+                    print(f"Dataset reloaded: kb artifact {artifact.version}, {len(keys)} Q&A pairs")
+                    return True
+                
+                snap = self._snapshot
+                if not self._replay_journal(snap.texts, snap._keys, snap.matrix, snap.bm25, snap.aliases,
+                                            index=snap.index, shards=snap.shards, tail=True):
+                    print("Dataset unchanged")
+                    return True
+                self._publish(snap.texts, snap._keys, snap.matrix, snap.index, snap.bm25, snap.aliases, snap.shards)
             return True
         except Exception as e:
             print(f"Error reloading dataset: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    def _on_kb_change(self, changed: List[str]):
+        # the watcher also sees this process's own thumbs-up appends. when only the
+        # journal changed there's nothing to re-read but the journal itself
+        if changed == [self.journal.path]:
+            return self.reload_journal()
+        return self.reload_dataset()
+
+    def reload_journal(self):
+        """Add journal rows (from other workers) the kb doesn't have yet, without
+        re-reading the csv/artifact. Rows this process journaled are already in it."""
+        try:
+            with self._write_lock:
+                snap = self._snapshot
+                records = self._replay_journal(snap.texts, snap._keys, snap.matrix, snap.bm25, snap.aliases,
+                                               index=snap.index, shards=snap.shards, tail=True)
+                if not records:
+                    return True
+                self._publish(snap.texts, snap._keys, snap.matrix, snap.index, snap.bm25, snap.aliases, snap.shards)
+                if self._source is not None:
+                    self._source[0].extend(r['key'] for r in records)
+                    self._source[1].extend(r['output'] for r in records)
+            return True
+        except Exception as e:
+            print(f"Error reloading journal: {e}")
+            return False
+
+    def start_watcher(self, interval: float = 5.0):
+        """Reload automatically when the csv (or artifact) or journal changes on disk"""
+        if self._watcher is None:
+            source = self.knowledge_base_path if self.artifact is None else self.artifact.current_path
+            self._watcher = KBWatcher(
+                [source, self.journal.path],
+                self._on_kb_change,
+                interval=interval
+            )
+            self._watcher.start()
+        return self._watcher
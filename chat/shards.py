@@ -0,0 +1,232 @@
+# chat/shards.py
+# topic shards for the knowledge base. every shard has its own embedding matrix (its
+# rows copied out of the kb matrix, so scanning a shard is one contiguous product),
+# its own index and a centroid. the router scores a query against the centroids and
+# only searches the best shard, or the best two when the top ones are close. when it
+# isn't confident (even the two best shards don't beat the rest by min_margin) or
+# the shards come back with fewer than k rows, the query goes to the full kb index.
+#
+# shards come from a `topic` column in the kb (menopause, fertility, nutrition, ...)
+# when there is one, otherwise from spherical k-means over the embeddings. rows added
+# later (feedback, reloads) go to the shard with the closest centroid.
+#
+# on big hybrid kbs dense scoring only runs on the bm25 candidates (no index search),
+# there restrict() keeps the candidates that fall in the query's routed shards.
+#
+# the kb matrix stays as it is (exact rows, the fallback scan), so shard matrices are
+# extra memory on top of it. like the rest of the kb they are append-only: shard ids
+# grow in kb order, so a snapshot's `limit` is a prefix of every shard.
+
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from chat.ann_index import _IdList, make_index, spherical_kmeans
+from chat.quantize import QuantizedMatrix
+from chat.vectors import GrowableMatrix, normalize, top_k
+
+DEFAULT_SHARDS = 8
+
+
+class Shard:
+    def __init__(self, name: str, ids: np.ndarray, rows: np.ndarray, kb_matrix,
+                 index_kind: str = 'brute', index_params: Dict = None):
+        self.name = name
+        self.ids = _IdList(ids)     # kb row of every shard row, ascending
+        if isinstance(kb_matrix, QuantizedMatrix):
+            # same storage as the kb, exact rows for re-ranking come from the kb matrix
+            self.matrix = QuantizedMatrix(rows, mode=kb_matrix.mode, dim=kb_matrix.dim,
+                                          exact=lambda local: kb_matrix.exact_rows(self.ids.view[local]))
+        else:
+            self.matrix = GrowableMatrix(rows, dim=kb_matrix.dim)
+        self.index = make_index(index_kind, self.matrix, **(index_params or {}))
+        self.index.build()
+        # running sum of the (normalized) rows, the centroid is its direction
+        self.total = np.asarray(rows, dtype=np.float32).reshape(-1, kb_matrix.dim).sum(axis=0)
+
+    def __len__(self) -> int:
+        return self.ids.size
+
+    def add(self, ids: np.ndarray, rows: np.ndarray):
+        # matrix + index first, the rows only become reachable once their ids are in
+        self.index.add(self.matrix.append(rows))
+        for idx in ids:
+            self.ids.append(int(idx))
+        self.total = self.total + rows.sum(axis=0)
+
+    def truncate(self, size: int):
+        # undo a failed add: ids first, so the dropped rows are unreachable before they go
+        self.ids.truncate(size)
+        self.index.truncate(size)
+        self.matrix.truncate(size)
+        self.total = self.matrix.rows(slice(0, size)).sum(axis=0)
+
+    def contains(self, ids: np.ndarray) -> np.ndarray:
+        """Mask of which kb rows in ids are in this shard."""
+        view = self.ids.view
+        if not len(view):
+            return np.zeros(len(ids), dtype=bool)
+        pos = np.minimum(np.searchsorted(view, ids), len(view) - 1)
+        return view[pos] == ids
+
+    def search(self, query: np.ndarray, k: int, limit: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        ids = self.ids.view
+        local_limit = len(ids) if limit is None else int(np.searchsorted(ids, limit))
+        local, scores = self.index.search(query, k, limit=local_limit)[0]
+        return ids[local], scores
+
+
+class ShardRouter:
+    """Routes each query to its one or two closest shards, or to the full index."""
+
+    def __init__(self, kb_matrix, index_kind: str = 'brute', index_params: Dict = None,
+                 probe: int = 2, min_margin: float = 0.05):
+        self.kb_matrix = kb_matrix
+        self.index_kind = index_kind
+        self.index_params = index_params or {}
+        self.probe = probe
+        self.min_margin = min_margin
+        self.shards: List[Shard] = []
+        self.centroids = None
+        self._lock = threading.Lock()   # counters only
+        self.routed = 0
+        self.fallbacks = 0
+        self.shards_scanned = 0
+
+    def _rows(self, block: int = 65536):
+        # (start, normalized float32 rows) over the whole kb matrix
+        for start in range(0, len(self.kb_matrix), block):
+            yield start, self.kb_matrix.rows(slice(start, start + block))
+
+    def build(self, labels: Optional[List[str]] = None, n_shards: int = DEFAULT_SHARDS,
+              train_size: int = 100000, seed: int = 0) -> "ShardRouter":
+        n = len(self.kb_matrix)
+        labels = None if labels is None else [str(l or '') for l in labels] + [''] * (n - len(labels))
+        names = sorted({l for l in labels if l}) if labels else []
+
+        if names:
+            # one shard per topic, centroid = mean of its rows
+            shard_of = {name: c for c, name in enumerate(names)}
+            label_ids = np.array([shard_of.get(l, -1) for l in labels], dtype=np.int64)
+            sums = np.zeros((len(names), self.kb_matrix.dim), dtype=np.float32)
+            for start, rows in self._rows():
+                chunk = label_ids[start:start + len(rows)]
+                np.add.at(sums, chunk[chunk >= 0], rows[chunk >= 0])
+            centroids = normalize(sums)
+        else:
+            if labels is not None:
+                print("   No topic labels in the kb, clustering it into shards instead")
+            rng = np.random.default_rng(seed)
+            sample = np.sort(rng.choice(n, size=min(n, train_size), replace=False))
+            centroids = spherical_kmeans(self.kb_matrix.rows(sample), n_shards, seed=seed)
+            names = [f"shard-{c}" for c in range(len(centroids))]
+            label_ids = np.full(n, -1, dtype=np.int64)
+
+        # unlabeled rows (or all of them with k-means) go to the closest centroid
+        assign = label_ids.copy()
+        for start, rows in self._rows():
+            chunk = assign[start:start + len(rows)]
+            missing = chunk < 0
+            if missing.any():
+                chunk[missing] = np.argmax(rows[missing] @ centroids.T, axis=1)
+
+        self.shards = []
+        for c, name in enumerate(names):
+            ids = np.flatnonzero(assign == c)
+            self.shards.append(Shard(name, ids, self.kb_matrix.rows(ids), self.kb_matrix,
+                                     self.index_kind, self.index_params))
+        self.centroids = centroids
+        print(f"   Split kb into {len(self.shards)} shards: "
+              + ", ".join(f"{s.name} ({len(s)})" for s in self.shards))
+        return self
+
+    def add(self, ids: np.ndarray):
+        """New kb rows (already in the kb matrix) go to the shard with the closest centroid."""
+        # callers hold the rag's write lock, readers never wait on this
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        rows = self.kb_matrix.rows(ids)
+        assign = np.argmax(rows @ self.centroids.T, axis=1)
+        for c in np.unique(assign):
+            self.shards[c].add(ids[assign == c], rows[assign == c])
+        # centroids follow the rows, readers pick up the new array on their next query
+        self.centroids = normalize(np.stack([shard.total for shard in self.shards]))
+
+    def truncate(self, rows: int):
+        """Forget kb rows >= rows (undoing a failed add)."""
+        for shard in self.shards:
+            shard.truncate(int(np.searchsorted(shard.ids.view, rows)))
+        self.centroids = normalize(np.stack([shard.total for shard in self.shards]))
+
+    def route(self, centroid_scores: np.ndarray) -> Optional[np.ndarray]:
+        """Shards to search (best first), None when the query should scan everything."""
+        order = top_k(centroid_scores, self.probe + 1)
+        for n in range(1, min(self.probe, len(order) - 1) + 1):
+            # the first n shards are clearly ahead of everything after them
+            if centroid_scores[order[0]] - centroid_scores[order[n]] >= self.min_margin:
+                return order[:n]
+        return None
+
+    def search(self, queries: np.ndarray, k: int, full_index, limit: int = None
+               ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Same as index.search: top-k (ids, scores) per query over the first `limit` kb rows."""
+        queries = np.atleast_2d(queries)
+        results = [None] * len(queries)
+        shards, centroids = self.shards, self.centroids
+        scanned = 0
+        for i, (query, centroid_scores) in enumerate(zip(queries, queries @ centroids.T)):
+            probes = self.route(centroid_scores)
+            if probes is None:
+                continue
+            hits = [shards[c].search(query, k, limit) for c in probes]
+            ids = np.concatenate([h[0] for h in hits])
+            if len(ids) < k:
+                continue
+            scores = np.concatenate([h[1] for h in hits])
+            best = top_k(scores, k)
+            results[i] = (ids[best], scores[best])
+            scanned += len(probes)
+
+        fallback = [i for i, result in enumerate(results) if result is None]
+        if fallback:
+            for i, result in zip(fallback, full_index.search(queries[fallback], k, limit=limit)):
+                results[i] = result
+        self._count(len(queries) - len(fallback), len(fallback), scanned)
+        return results
+
+    def restrict(self, query: np.ndarray, ids: np.ndarray, k: int) -> Optional[np.ndarray]:
+        """Mask over candidate kb rows (bm25 hits) keeping the ones in the query's routed
+        shards, None when it isn't routed or fewer than k candidates would be left."""
+        shards, centroids = self.shards, self.centroids
+        probes = self.route(query @ centroids.T)
+        keep = None
+        if probes is not None:
+            keep = np.zeros(len(ids), dtype=bool)
+            for c in probes:
+                keep |= shards[c].contains(ids)
+            if keep.sum() < k:
+                keep = None
+        if keep is None:
+            self._count(0, 1, 0)
+        else:
+            self._count(1, 0, len(probes))
+        return keep
+
+    def _count(self, routed: int, fallbacks: int, scanned: int):
+        with self._lock:
+            self.routed += routed
+            self.fallbacks += fallbacks
+            self.shards_scanned += scanned
+
+    def stats(self) -> Dict:
+        queries = self.routed + self.fallbacks
+        return {
+            'shards': {shard.name: len(shard) for shard in self.shards},
+            'routed': self.routed,
+            'fallbacks': self.fallbacks,
+            'fallback_rate': self.fallbacks / queries if queries else 0.0,
+            'mean_shards_scanned': self.shards_scanned / self.routed if self.routed else 0.0,
+            'matrix_bytes': sum(shard.matrix.nbytes for shard in self.shards)
+        }
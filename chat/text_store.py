@@ -0,0 +1,140 @@
+# chat/text_store.py
+# kb questions/answers as columns instead of a DataFrame: each column is one utf-8
+# byte buffer plus an int64 offsets array (row i is data[offsets[i]:offsets[i + 1]]).
+# reading a row is two array lookups and a decode, no pandas on the request path,
+# and the arrays can be saved as .npy files and opened with mmap.
+#
+# like GrowableMatrix the columns are append-only: bytes and offsets are written
+# before `size` is bumped, so a snapshot holding an older size never sees half a row.
+#
+# files for TextStore.save('chat/data') / TextStore.open('chat/data'):
+#   data.questions.npy  data.questions.offsets.npy
+#   data.answers.npy    data.answers.offsets.npy
+
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from chat.fileio import atomic_write
+
+
+class TextColumn:
+    """Append-only list of strings stored as one utf-8 buffer + row offsets."""
+
+    def __init__(self, data: np.ndarray = None, offsets: np.ndarray = None):
+        if offsets is None:
+            data, offsets = np.empty(1024, dtype=np.uint8), np.zeros(64, dtype=np.int64)
+            self.size = 0
+        else:
+            self.size = len(offsets) - 1
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, i: int) -> str:
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return self._data[start:end].tobytes().decode('utf-8')
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.nbytes + self._offsets.nbytes
+
+    def tolist(self, start: int = 0, end: int = None) -> List[str]:
+        end = self.size if end is None else end
+        data, offsets = self._data, self._offsets[start:end + 1]
+        return [data[a:b].tobytes().decode('utf-8') for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def extend(self, texts: List[str]):
+        if not texts:
+            return
+        encoded = [t.encode('utf-8') for t in texts]
+        lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=len(encoded))
+        used = int(self._offsets[self.size])
+        data_end, rows_end = used + int(lengths.sum()), self.size + len(encoded)
+
+        # grow by copying, a view taken before this keeps the old (still valid) buffer
+        if data_end > len(self._data):
+            data = np.empty(max(data_end, 2 * len(self._data)), dtype=np.uint8)
+            data[:used] = self._data[:used]
+            self._data = data
+        if rows_end + 1 > len(self._offsets):
+            offsets = np.empty(max(rows_end + 1, 2 * len(self._offsets)), dtype=np.int64)
+            offsets[:self.size + 1] = self._offsets[:self.size + 1]
+            self._offsets = offsets
+
+        self._data[used:data_end] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        self._offsets[self.size + 1:rows_end + 1] = used + np.cumsum(lengths)
+        self.size = rows_end
+
+    def truncate(self, size: int):
+        # undo a failed extend, the next one writes over the dropped text
+        self.size = min(self.size, size)
+
+    def save(self, path: str):
+        _save_npy(path, self._data[:self._offsets[self.size]])
+        _save_npy(path[:-len(".npy")] + ".offsets.npy", self._offsets[:self.size + 1])
+
+    @classmethod
+    def open(cls, path: str, mmap: bool = True) -> "TextColumn":
+        mode = 'r' if mmap else None
+        offsets = np.load(path[:-len(".npy")] + ".offsets.npy", mmap_mode=mode)
+        return cls(np.load(path, mmap_mode=mode), offsets)
+
+
+def _save_npy(path: str, array: np.ndarray):
+    atomic_write(path, lambda f: np.save(f, np.ascontiguousarray(array)))
+
+
+class TextStore:
+    """Question/answer text for every kb row, aligned with the kb matrix."""
+
+    def __init__(self, questions: TextColumn = None, answers: TextColumn = None):
+        self.questions = TextColumn() if questions is None else questions
+        self.answers = TextColumn() if answers is None else answers
+
+    @classmethod
+    def from_frame(cls, kb: pd.DataFrame) -> "TextStore":
+        # the only place a DataFrame is read, at ingest
+        store = cls()
+        store.extend(kb['instruction'].astype(str).tolist(), kb['output'].astype(str).tolist())
+        return store
+
+    def __len__(self) -> int:
+        return len(self.questions)
+
+    @property
+    def nbytes(self) -> int:
+        return self.questions.nbytes + self.answers.nbytes
+
+    def question(self, i: int) -> str:
+        return self.questions[i]
+
+    def answer(self, i: int) -> str:
+        return self.answers[i]
+
+    def extend(self, questions: List[str], answers: List[str]):
+        # answers first, a row only counts (len() is the question count) once both exist
+        self.answers.extend(answers)
+        self.questions.extend(questions)
+
+    def truncate(self, size: int):
+        # questions first, same as extend
+        self.questions.truncate(size)
+        self.answers.truncate(size)
+
+    def documents(self, start: int = 0, end: int = None) -> List[str]:
+        """question + answer per row, what bm25 indexes"""
+        questions, answers = self.questions.tolist(start, end), self.answers.tolist(start, end)
+        return [f"{q}\n{a}" for q, a in zip(questions, answers)]
+
+    def save(self, prefix: str):
+        self.questions.save(prefix + ".questions.npy")
+        self.answers.save(prefix + ".answers.npy")
+
+    @classmethod
+    def open(cls, prefix: str, mmap: bool = True) -> "TextStore":
+        return cls(TextColumn.open(prefix + ".questions.npy", mmap),
+                   TextColumn.open(prefix + ".answers.npy", mmap))
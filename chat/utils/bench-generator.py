@@ -0,0 +1,133 @@
+# chat/utils/bench-generator.py
+"""
+Benchmark DistilGPT2 inference modes (fp32 vs int8 dynamic quantization) on a fixed
+prompt set from chat/data_fixed.csv: latency, tokens/sec, model memory and how close
+the replies stay to the kb answers / to the fp32 replies.
+
+    python chat/utils/bench-generator.py --model-path ./chat/fine-tune-attempts/distilgpt2-finetuned
+"""
+
+import argparse
+import io
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from chat.generator import INFERENCE_MODES, Generator, pin_threads
+
+
+def token_f1(a, b):
+    """Bag-of-words F1 between two strings, 0-1"""
+    a, b = re.findall(r"\w+", a.lower()), re.findall(r"\w+", b.lower())
+    common = sum((Counter(a) & Counter(b)).values())
+    if not a or not b or not common:
+        return 0.0
+    precision, recall = common / len(a), common / len(b)
+    return 2 * precision * recall / (precision + recall)
+
+
+def rss_bytes():
+    # current resident memory (linux), None elsewhere
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def model_bytes(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def load_prompts(path, n, seed):
+    kb = pd.read_csv(path).dropna(subset=["instruction", "output"])
+    kb = kb.sample(n=min(n, len(kb)), random_state=seed)
+    return kb["instruction"].tolist(), kb["output"].tolist()
+
+
+def run_mode(mode, args, questions, answers):
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    generator = Generator(args.model_path, inference=mode)
+    load_seconds = time.perf_counter() - start
+    rss_after = rss_bytes()
+
+    replies, latencies = [], []
+    for i, (question, answer) in enumerate(zip(questions, answers)):
+        prompt = generator.build_prompt(question, [{"question": question, "answer": answer}])
+        torch.manual_seed(args.seed + i)  # same sampling noise for every mode
+        start = time.perf_counter()
+        replies.append(generator.generate(prompt, temperature=0.7, max_new_tokens=args.max_new_tokens))
+        latencies.append(time.perf_counter() - start)
+
+    stats = generator.stats()
+    return replies, {
+        "mode": generator.inference,
+        "load_seconds": load_seconds,
+        "model_bytes": model_bytes(generator.model),
+        "rss_delta_bytes": None if rss_before is None else rss_after - rss_before,
+        "latency_ms_p50": float(np.percentile(latencies, 50) * 1000),
+        "latency_ms_p95": float(np.percentile(latencies, 95) * 1000),
+        "latency_ms_mean": float(np.mean(latencies) * 1000),
+        "tokens_per_sec": stats["tokens_per_sec"],
+        "f1_vs_kb_answer": float(np.mean([token_f1(r, a) for r, a in zip(replies, answers)])),
+        "poor_replies": sum(len(r) <= 20 for r in replies)  # the rag falls back on these
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DistilGPT2 inference modes")
+    parser.add_argument("--model-path", default="./chat/fine-tune-attempts/distilgpt2-finetuned")
+    parser.add_argument("--data", default="./chat/data_fixed.csv")
+    parser.add_argument("--prompts", type=int, default=50)
+    parser.add_argument("--max-new-tokens", type=int, default=100)
+    parser.add_argument("--modes", nargs="+", default=list(INFERENCE_MODES), choices=INFERENCE_MODES)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="also write the results as json here")
+    args = parser.parse_args()
+
+    pin_threads(args.threads, 1)
+    questions, answers = load_prompts(args.data, args.prompts, args.seed)
+    print(f"Benchmarking {args.modes} on {len(questions)} prompts from {args.data}")
+
+    results, replies = [], {}
+    for mode in args.modes:
+        replies[mode], result = run_mode(mode, args, questions, answers)
+        results.append(result)
+
+    # how far each mode drifts from fp32 on the same prompts + seeds
+    if "fp32" in replies:
+        for result, mode in zip(results, args.modes):
+            result["f1_vs_fp32"] = float(np.mean([
+                token_f1(r, ref) for r, ref in zip(replies[mode], replies["fp32"])
+            ]))
+
+    print(f"\n{'mode':<6} {'p50 ms':>8} {'p95 ms':>8} {'tok/s':>8} {'model MB':>9} {'f1 kb':>6} {'f1 fp32':>8} {'poor':>5}")
+    for r in results:
+        print(f"{r['mode']:<6} {r['latency_ms_p50']:>8.1f} {r['latency_ms_p95']:>8.1f} "
+              f"{r['tokens_per_sec']:>8.1f} {r['model_bytes'] / 1e6:>9.1f} {r['f1_vs_kb_answer']:>6.3f} "
+              f"{r.get('f1_vs_fp32', float('nan')):>8.3f} {r['poor_replies']:>5}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"prompts": len(questions), "threads": torch.get_num_threads(), "results": results}, f, indent=2)
+        print(f"\nWrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+# chat/utils/bench-retrieval.py
+"""
+Retrieval quality + latency benchmark for WomensHealthRAG.
+
+Held-out queries are paraphrases of kb questions (or your own --queries csv with
+query,instruction columns), so the right answer is known. Each kb size gets its own
+kb artifact (chat/build_kb.py): the real rows plus synthetic filler rows whose
+embeddings are mixed from real ones, so 100k / 1M rows don't need the embedder.
+
+Reports recall@1/3/10 and MRR for retrieve_context, the direct/generated/fallback mix
+of generate_response_simple, p50/p95/p99 latency of both and peak RSS, as json.
+Each size is loaded and queried in its own process, so peak RSS is the rag's alone
+(not the artifact build's or an earlier size's).
+
+    python chat/utils/bench-retrieval.py --sizes 1000 100000 1000000 --out bench.json
+    python chat/utils/bench-retrieval.py --generation real --model-path ./chat/fine-tune-attempts/distilgpt2-finetuned
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from chat.bm25 import BM25Index
+from chat.build_kb import build
+from chat.kb_artifact import KBArtifact, write_artifact
+from chat.text_store import TextStore
+from chat.vectors import normalize
+
+# cheap rewrites so the query isn't the kb question verbatim
+PREFIXES = ["", "can you tell me ", "i was wondering ", "quick question, ", "please explain "]
+SYNONYMS = {
+    'period': 'menstruation', 'periods': 'menstrual cycles', 'doctor': 'physician',
+    'pain': 'discomfort', 'normal': 'typical', 'cause': 'lead to', 'causes': 'leads to',
+    'symptoms': 'signs', 'help': 'assist', 'pregnant': 'expecting', 'woman': 'female',
+    'women': 'females', 'treat': 'manage', 'treatment': 'therapy', 'how': 'in what way'
+}
+
+
+def paraphrase(question, rng):
+    words = re.findall(r"[\w']+", question.lower())
+    words = [SYNONYMS[w] if w in SYNONYMS and rng.random() < 0.7 else w for w in words]
+    return rng.choice(PREFIXES) + " ".join(words)
+
+
+class StubGenerator:
+    """Stands in for distilgpt2: fixed reply after a fixed delay."""
+    using_finetuned = False
+
+    def __init__(self, delay_ms):
+        self.delay = delay_ms / 1000.0
+
+    def build_prompt(self, user_query, context):
+        return user_query
+
+    def generate(self, prompt, temperature=0.7, max_new_tokens=100):
+        time.sleep(self.delay)
+        return "This is a stubbed generated reply that is long enough to be kept."
+
+    def stats(self):
+        return {'stub': True}
+
+
+def percentiles(values):
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'mean': float(np.mean(values))}
+
+
+def peak_rss_mb():
+    # ru_maxrss is kB on linux, bytes on mac
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def scaled_artifact(base, size, gold, out, seed):
+    """kb artifact with `size` rows: every gold row, then real rows, then filler."""
+    rng = np.random.default_rng(seed)
+    n_real = len(base)
+    others = [i for i in rng.permutation(n_real) if i not in gold]
+    real = sorted(gold) + others[:max(0, size - len(gold))]
+
+    questions = [base.texts.question(i) for i in real]
+    answers = [base.texts.answer(i) for i in real]
+    keys = [base.keys[i] for i in real]
+    n_filler = max(0, size - len(real))
+    dim = base.embeddings.shape[1]
+
+    # filler: made-up text from the kb vocabulary, embedding = blend of two real rows + noise
+    vocab = sorted({w for q in questions for w in re.findall(r"[a-z]+", q.lower())})
+    embeddings = np.lib.format.open_memmap(os.path.join(out, "embeddings.tmp.npy"), mode='w+',
+                                           dtype=np.float32, shape=(len(real) + n_filler, dim))
+    embeddings[:len(real)] = base.embeddings[real]
+    for start in range(0, n_filler, 50000):
+        n = min(50000, n_filler - start)
+        a, b = rng.integers(0, n_real, n), rng.integers(0, n_real, n)
+        mix = rng.uniform(0.3, 0.7, (n, 1)).astype(np.float32)
+        rows = mix * base.embeddings[a] + (1 - mix) * base.embeddings[b]
+        rows += rng.normal(0, 0.05, rows.shape).astype(np.float32)
+        embeddings[len(real) + start:len(real) + start + n] = normalize(rows)
+        for i, words in enumerate(rng.integers(0, len(vocab), (n, 8)).tolist(), start):
+            questions.append(f"synthetic {i} " + " ".join(vocab[w] for w in words[:5]))
+            answers.append("filler answer " + " ".join(vocab[w] for w in words[3:]))
+            keys.append(f"{i:040x}")
+
+    texts = TextStore()
+    texts.extend(questions, answers)
+    bm25 = BM25Index()
+    bm25.add(texts.documents())
+    write_artifact(out, texts, keys, embeddings, base.model, bm25)
+    del embeddings
+    os.remove(os.path.join(out, "embeddings.tmp.npy"))
+    # gold ids in the new kb: gold rows were written first, in sorted order
+    return {old: new for new, old in enumerate(sorted(gold))}
+
+
+def run_size(args, base, queries, size, workdir):
+    """Build the artifact for one size here, load + query it in a child process."""
+    gold_rows = sorted({g for _, golds in queries for g in golds})
+    out = os.path.join(workdir, f"kb-{size}")
+    os.makedirs(out, exist_ok=True)
+    start = time.perf_counter()
+    remap = scaled_artifact(base, size, set(gold_rows), out, args.seed)
+    build_seconds = time.perf_counter() - start
+
+    job = os.path.join(workdir, f"job-{size}.json")
+    with open(job, "w") as f:
+        json.dump({
+            'kb': out,
+            'queries': [[query, sorted(remap[g] for g in golds)] for query, golds in queries],
+            'result': os.path.join(workdir, f"result-{size}.json")
+        }, f)
+    subprocess.run([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--worker", job], check=True)
+    with open(os.path.join(workdir, f"result-{size}.json")) as f:
+        return dict(json.load(f), artifact_build_seconds=build_seconds)
+
+
+def query_size(args, job):
+    """--worker: load one kb artifact and run the queries against it."""
+    from chat.rag import WomensHealthRAG
+
+    start = time.perf_counter()
+    rag = WomensHealthRAG(job['kb'], generation_model_path=args.model_path, index=args.index,
+                          hybrid=not args.dense_only, quantization=args.quantization,
+                          shards=args.shards)
+    load_seconds = time.perf_counter() - start
+    if args.generation == 'stub':
+        rag._new_generator = lambda: StubGenerator(args.stub_ms)
+    if rag.load_generator() is None:
+        raise RuntimeError(f"generator failed to load: {rag.generator_error}")
+
+    hits = {1: 0, 3: 0, 10: 0}
+    reciprocal_ranks, retrieve_ms, response_ms, types = [], [], [], Counter()
+    queries = job['queries']
+    for query, golds in queries:
+        golds = set(golds)
+        # both timings include embedding the query, like a query the app hasn't seen
+        rag.query_cache.clear()
+        t = time.perf_counter()
+        context = rag.retrieve_context(query, top_k=10)
+        retrieve_ms.append((time.perf_counter() - t) * 1000)
+        ranked = [ctx['id'] for ctx in context]
+        rank = next((r for r, idx in enumerate(ranked, 1) if idx in golds), None)
+        for k in hits:
+            hits[k] += rank is not None and rank <= k
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+
+        rag.query_cache.clear()
+        t = time.perf_counter()
+        response = rag.generate_response_simple(query, similarity_threshold=args.threshold)
+        response_ms.append((time.perf_counter() - t) * 1000)
+        types[response['response_type']] += 1
+
+    n = len(queries)
+    return {
+        'kb_rows': rag.snapshot.size,
+        'queries': n,
+        'recall@1': hits[1] / n,
+        'recall@3': hits[3] / n,
+        'recall@10': hits[10] / n,
+        'mrr': float(np.mean(reciprocal_ranks)),
+        'response_types': {t: types.get(t, 0) / n for t in ('direct', 'generated', 'fallback')},
+        'retrieve_ms': percentiles(retrieve_ms),
+        'response_ms': percentiles(response_ms),
+        'load_seconds': load_seconds,
+        'shards': None if rag.snapshot.shards is None else rag.snapshot.shards.stats(),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+def load_queries(args, base, rng):
+    # (query, set of kb rows that answer it); duplicates of a question all count as hits
+    rows_by_question = {}
+    for i in range(len(base)):
+        rows_by_question.setdefault(base.texts.question(i).strip().lower(), []).append(i)
+
+    if args.queries:
+        df = pd.read_csv(args.queries)
+        out = []
+        for query, instruction in zip(df['query'], df['instruction']):
+            rows = rows_by_question.get(str(instruction).strip().lower())
+            if rows:
+                out.append((str(query), set(rows)))
+        return out
+
+    picked = rng.sample(range(len(base)), min(args.n_queries, len(base)))
+    return [
+        (paraphrase(base.texts.question(i), rng), set(rows_by_question[base.texts.question(i).strip().lower()]))
+        for i in picked
+    ]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark WomensHealthRAG retrieval quality and latency")
+    parser.add_argument("--data", default="./chat/data_fixed.csv")
+    parser.add_argument("--queries", default=None, help="csv with query,instruction columns (default: paraphrases)")
+    parser.add_argument("--n-queries", type=int, default=200)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--index", default="brute")
+    parser.add_argument("--quantization", default=None)
+    parser.add_argument("--dense-only", action="store_true", help="turn hybrid bm25 fusion off")
+    parser.add_argument("--shards", type=int, default=None, help="route queries over this many k-means topic shards")
+    parser.add_argument("--threshold", type=float, default=0.5, help="similarity_threshold for generation")
+    parser.add_argument("--generation", choices=("stub", "real"), default="stub")
+    parser.add_argument("--stub-ms", type=float, default=0.0, help="latency of the stub generator")
+    parser.add_argument("--model-path", default="./chat/fine-tune-attempts/distilgpt2-finetuned")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None, help="where to write the kb artifacts (default: temp dir)")
+    parser.add_argument("--out", default=None, help="also write the results as json here")
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)  # one size's job file
+    args = parser.parse_args()
+
+    if args.worker:
+        with open(args.worker) as f:
+            job = json.load(f)
+        result = query_size(args, job)
+        with open(job['result'], "w") as f:
+            json.dump(result, f)
+        return
+
+    from chat.rag import EMBEDDING_MODEL
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench-retrieval-")
+    base = KBArtifact(build(args.data, os.path.join(workdir, "base"), EMBEDDING_MODEL))
+    queries = load_queries(args, base, random.Random(args.seed))
+    print(f"Benchmarking {len(queries)} queries against kb sizes {args.sizes}")
+
+    # artifacts are built here, each size is queried in a fresh process (run_size)
+    results = []
+    for size in sorted(args.sizes):
+        results.append(dict(run_size(args, base, queries, size, workdir), size=size))
+
+    print(f"\n{'rows':>9} {'r@1':>6} {'r@3':>6} {'r@10':>6} {'mrr':>6} {'direct':>7} {'gen':>6} {'fallbk':>7} "
+          f"{'ret p50':>8} {'ret p99':>8} {'resp p99':>9} {'rss MB':>8}")
+    for r in results:
+        mix = r['response_types']
+        print(f"{r['kb_rows']:>9} {r['recall@1']:>6.3f} {r['recall@3']:>6.3f} {r['recall@10']:>6.3f} "
+              f"{r['mrr']:>6.3f} {mix['direct']:>7.2f} {mix['generated']:>6.2f} {mix['fallback']:>7.2f} "
+              f"{r['retrieve_ms']['p50']:>8.2f} {r['retrieve_ms']['p99']:>8.2f} "
+              f"{r['response_ms']['p99']:>9.2f} {r['peak_rss_mb']:>8.0f}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({
+                'commit': git_commit(),
+                'config': {k: v for k, v in vars(args).items() if k not in ('out', 'workdir', 'worker')},
+                'results': results
+            }, f, indent=2)
+        print(f"\nWrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
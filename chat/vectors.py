@@ -0,0 +1,100 @@
+# chat/vectors.py
+# small numpy helpers for the embedding matrix used by retrieval
+# the kb matrix is kept L2-normalized in float32 so cosine similarity is a single
+# matrix-vector product instead of a norm pass over the whole kb on every query
+
+import numpy as np
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize rows (or a single vector) as contiguous float32."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.ascontiguousarray(vectors / np.maximum(norms, 1e-12), dtype=np.float32)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, without sorting everything."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        idx = np.argpartition(scores, -k)[-k:]
+    else:
+        idx = np.arange(len(scores))
+    return idx[np.argsort(scores[idx])[::-1]]
+
+
+class GrowableMatrix:
+    """Normalized float32 rows with spare capacity so appends are amortized O(1).
+
+    Rows past `size` are written before `size` is bumped, so anything holding an
+    older view never sees a partially written row.
+    """
+
+    def __init__(self, rows: np.ndarray, dim: int = None):
+        rows = np.asarray(rows, dtype=np.float32)
+        if rows.ndim != 2:
+            rows = rows.reshape(0, dim or 0)
+        self.dim = rows.shape[1] or (dim or 0)
+        self._buf = np.empty((max(len(rows), 16), self.dim), dtype=np.float32)
+        self._buf[:len(rows)] = normalize(rows) if len(rows) else rows
+        self.size = len(rows)
+
+    @classmethod
+    def wrap(cls, rows: np.ndarray) -> "GrowableMatrix":
+        """Use already normalized float32 rows as they are (e.g. an mmapped .npy from
+        chat/build_kb.py) instead of copying them, the first append() makes the copy."""
+        matrix = cls.__new__(cls)
+        matrix.dim = rows.shape[1]
+        matrix._buf = rows
+        matrix.size = len(rows)
+        return matrix
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def view(self) -> np.ndarray:
+        return self._buf[:self.size]
+
+    @property
+    def nbytes(self) -> int:
+        return self._buf.nbytes
+
+    def append(self, rows: np.ndarray) -> np.ndarray:
+        """Normalize and append rows, returning their indices."""
+        rows = normalize(np.atleast_2d(rows))
+        start, end = self.size, self.size + len(rows)
+        if end > len(self._buf):
+            buf = np.empty((max(end, 2 * len(self._buf)), self.dim), dtype=np.float32)
+            buf[:start] = self._buf[:start]
+            self._buf = buf
+        self._buf[start:end] = rows
+        self.size = end
+        return np.arange(start, end)
+
+    def truncate(self, size: int):
+        # undo a failed append, the next one writes over the dropped rows
+        self.size = min(self.size, size)
+
+    # interface shared with chat.quantize.QuantizedMatrix, which the indexes use
+    # so they don't care how the rows are stored
+
+    def rows(self, ids) -> np.ndarray:
+        return self._buf[:self.size][ids]
+
+    def exact_rows(self, ids) -> np.ndarray:
+        return self.rows(ids)
+
+    def scores(self, queries: np.ndarray, limit: int = None) -> np.ndarray:
+        """(n_queries, rows) cosine scores against the first `limit` rows."""
+        return np.atleast_2d(queries) @ self.view[:limit].T
+
+    def candidates(self, k: int) -> int:
+        # how many approximate hits to pass to refine() for a final top-k
+        return k
+
+    def refine(self, query: np.ndarray, ids: np.ndarray, scores: np.ndarray, k: int):
+        # scores are already exact
+        return ids[:k], scores[:k]
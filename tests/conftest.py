@@ -0,0 +1,51 @@
+# tests/conftest.py
+# shared fixtures: a deterministic stand-in for MiniLM (hashed bag of words, so
+# questions that share words are close) and helpers to write a kb csv
+
+import csv
+import hashlib
+import os
+import re
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+rag_module = pytest.importorskip("chat.rag")
+
+
+class HashEmbedder:
+    dim = 64
+
+    def __init__(self, *args, **kwargs):
+        self.calls = 0
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, **kwargs):
+        self.calls += 1
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                h = int(hashlib.md5(word.encode()).hexdigest(), 16)
+                out[i, h % self.dim] += 1.0
+                out[i, (h >> 8) % self.dim] += 0.5
+            out[i] += 0.01
+        return out
+
+
+def write_kb(path, rows, columns=("instruction", "output")):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    return str(path)
+
+
+@pytest.fixture
+def stub_embedder(monkeypatch):
+    monkeypatch.setattr(rag_module, "SentenceTransformer", HashEmbedder)
+    return HashEmbedder
@@ -0,0 +1,39 @@
+# tests/test_append_rows.py
+# the kb structures are shared and append-only, so an append that fails half way has
+# to be rolled back, or every later row lands at a different id in each of them
+
+import pytest
+
+from conftest import rag_module, write_kb
+
+ROWS = [
+    ("pcos insulin ovary cyst question 1", "pcos answer 1", "pcos"),
+    ("pcos androgen cyst question 2", "pcos answer 2", "pcos"),
+    ("menopause hot flashes question 1", "menopause answer 1", "menopause"),
+    ("menopause night sweats question 2", "menopause answer 2", "menopause"),
+]
+
+
+@pytest.fixture
+def rag(stub_embedder, tmp_path):
+    path = write_kb(tmp_path / "data.csv", ROWS, columns=("instruction", "output", "topic"))
+    return rag_module.WomensHealthRAG(path, shards='topic', duplicate_threshold=None)
+
+
+def test_failed_append_leaves_kb_aligned(rag, monkeypatch):
+    snap = rag.snapshot
+    with monkeypatch.context() as m:
+        m.setattr(snap.bm25, 'add', lambda texts: 1 / 0)
+        assert not rag.add_to_dataset("estrogen patch dosage question", "patch answer")
+
+    assert rag.snapshot.version == snap.version
+    assert len(snap.matrix) == len(snap._keys) == len(snap.texts) == len(snap.bm25) == len(ROWS)
+    assert sum(len(shard) for shard in snap.shards.shards) == len(ROWS)
+
+    assert rag.add_to_dataset("iron rich foods spinach lentils question", "iron answer")
+    snap = rag.snapshot
+    assert snap.size == len(ROWS) + 1
+    assert snap.keys[-1] == rag_module.text_hash("iron rich foods spinach lentils question")
+    context = rag.retrieve_context("iron rich foods spinach lentils question", top_k=1)
+    assert context[0]['answer'] == "iron answer"
+    assert context[0]['id'] == len(ROWS)
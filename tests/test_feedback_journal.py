@@ -0,0 +1,165 @@
+# tests/test_feedback_journal.py
+# thumbs-up feedback goes to an fsync'd journal first and into the csv on compaction,
+# nothing may be lost or duplicated by a crash in between, by several workers writing
+# at once, or by a reload that edits/drops rows
+
+import csv
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from conftest import rag_module, write_kb
+from chat.feedback_journal import FeedbackJournal, fcntl
+
+ROWS = [
+    ("What is pcos?", "A hormonal disorder of the ovaries."),
+    ("What causes hot flashes?", "Falling estrogen during menopause."),
+    ("Which foods are high in iron?", "Spinach, lentils and red meat."),
+]
+NEW = ("Can stress delay my period?", "Yes, stress can delay ovulation.")
+
+
+@pytest.fixture
+def kb_path(tmp_path):
+    return write_kb(tmp_path / "data.csv", ROWS)
+
+
+def make_rag(path, **options):
+    options.setdefault('duplicate_threshold', None)
+    options.setdefault('journal_compact_every', 1000)
+    return rag_module.WomensHealthRAG(path, **options)
+
+
+def read_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return [(row['instruction'], row['output']) for row in csv.DictReader(f)]
+
+
+def pairs(rag):
+    snap = rag.snapshot
+    return [(snap.question(i), snap.answer(i)) for i in range(snap.size)]
+
+
+def test_journaled_feedback_survives_a_crash(stub_embedder, kb_path):
+    rag = make_rag(kb_path)
+    assert rag.add_to_dataset(*NEW)
+    # "crash": the process goes away without compacting, the csv never saw the row
+    del rag
+    assert read_csv(kb_path) == ROWS
+
+    restarted = make_rag(kb_path)
+    assert pairs(restarted) == ROWS + [NEW]
+    assert restarted.retrieve_context(NEW[0], top_k=1)[0]['answer'] == NEW[1]
+
+
+def test_crash_between_csv_replace_and_journal_truncate(stub_embedder, kb_path, monkeypatch):
+    rag = make_rag(kb_path)
+    assert rag.add_to_dataset(*NEW)
+
+    def crash():
+        raise OSError("killed before the journal was emptied")
+    with monkeypatch.context() as m, pytest.raises(OSError):
+        m.setattr(rag.journal, 'truncate', crash)
+        rag.compact_journal()
+    # the csv already has the row and the journal still has it too
+    assert read_csv(kb_path) == ROWS + [NEW]
+    assert len(rag.journal) == 1
+
+    # neither a restart nor the next compaction may add it twice
+    restarted = make_rag(kb_path)
+    assert pairs(restarted) == ROWS + [NEW]
+    assert restarted.compact_journal() == 0
+    assert read_csv(kb_path) == ROWS + [NEW]
+    assert len(restarted.journal) == 0
+
+
+def _append_records(path, worker, count):
+    journal = FeedbackJournal(path)
+    for i in range(count):
+        journal.append(f"question {worker}-{i} " + "x" * 4000, f"answer {worker}-{i}",
+                       f"key-{worker}-{i}", np.full(8, worker, dtype=np.float32))
+
+
+def _append_one(path):
+    _append_records(path, 99, 1)
+
+
+needs_fork = pytest.mark.skipif(fcntl is None or 'fork' not in multiprocessing.get_all_start_methods(),
+                                reason="needs fcntl and fork")
+
+
+@needs_fork
+def test_workers_appending_at_once_never_interleave(tmp_path):
+    path = str(tmp_path / "data.csv")
+    ctx = multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=_append_records, args=(path, w, 50)) for w in range(4)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join(30)
+        assert p.exitcode == 0
+
+    records = FeedbackJournal(path).replay()
+    assert len(records) == 200
+    assert {r['key'] for r in records} == {f"key-{w}-{i}" for w in range(4) for i in range(50)}
+    for record in records:
+        worker = int(record['key'].split('-')[1])
+        assert np.array_equal(record['embedding'], np.full(8, worker, dtype=np.float32))
+
+
+@needs_fork
+def test_journal_lock_is_held_across_processes(tmp_path):
+    path = str(tmp_path / "data.csv")
+    journal = FeedbackJournal(path)
+    child = multiprocessing.get_context('fork').Process(target=_append_one, args=(path,))
+    with journal.lock():
+        # e.g. a compaction in this worker: the other worker's append has to wait
+        child.start()
+        child.join(0.5)
+        assert child.is_alive()
+        assert len(journal) == 0
+    child.join(30)
+    assert child.exitcode == 0
+    assert len(journal) == 1
+
+
+def test_reload_applies_edits_and_deletes_without_re_embedding(stub_embedder, kb_path):
+    rag = make_rag(kb_path)
+    calls = rag.embedder.calls
+    edited = (ROWS[0][0], "An endocrine condition with irregular periods.")
+    write_kb(kb_path, [edited, ROWS[2], NEW])
+
+    assert rag.reload_dataset()
+    assert pairs(rag) == [edited, ROWS[2], NEW]
+    assert rag_module.text_hash(ROWS[1][0]) not in rag.snapshot.keys
+    # only the new question is encoded, the edited row keeps its embedding
+    assert rag.embedder.calls == calls + 1
+    assert rag.retrieve_context(ROWS[0][0], top_k=1)[0]['answer'] == edited[1]
+    assert all(ctx['answer'] != ROWS[1][1] for ctx in rag.retrieve_context(ROWS[1][0], top_k=3))
+
+
+def test_reload_journal_only_decodes_new_lines(stub_embedder, kb_path, monkeypatch):
+    # two app workers on one kb, each picks up the other's feedback from the journal
+    worker_a, worker_b = make_rag(kb_path), make_rag(kb_path)
+    assert worker_a.add_to_dataset(*NEW)
+    assert worker_b.reload_journal()
+    assert pairs(worker_b) == ROWS + [NEW]
+
+    other = ("Is spotting between periods normal?", "Light spotting is common.")
+    assert worker_b.add_to_dataset(*other)
+    decoded = []
+    read = worker_b.journal.read
+
+    def counting_read(position=None):
+        records, end = read(position)
+        decoded.append(len(records))
+        return records, end
+    monkeypatch.setattr(worker_b.journal, 'read', counting_read)
+
+    # worker b only decodes its own new line (and doesn't add it twice)
+    assert worker_b.reload_journal()
+    assert decoded == [1]
+    assert pairs(worker_b) == ROWS + [NEW, other]
+    assert worker_a.reload_journal()
+    assert pairs(worker_a) == ROWS + [NEW, other]
@@ -0,0 +1,84 @@
+# tests/test_hybrid_ranking.py
+# hybrid retrieval: rrf picks the candidates, but the context comes back ordered by
+# final similarity, so a paraphrase with no keyword overlap still gets its direct answer
+#
+#   python -m pytest -q tests
+
+import csv
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+rag_module = pytest.importorskip("chat.rag")
+
+QUERY = "how long is my period"
+ROWS = [
+    ("What is the usual menses duration?", "Most periods last three to seven days."),
+    ("Can exercise affect my period?", "Intense training can delay or stop periods."),
+    ("Is spotting between period days normal?", "Light spotting is common and usually harmless."),
+    ("What foods are high in iron?", "Spinach, lentils and red meat are good sources."),
+]
+
+
+class StubEmbedder:
+    """Fixed vectors: the query is e0, the menses row is 0.95 cosine from it and the
+    keyword rows are far away, everything else is orthogonal to all of them."""
+    dim = 8
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def _vector(self, text):
+        v = np.zeros(self.dim, dtype=np.float32)
+        if text == QUERY:
+            v[0] = 1.0
+        elif text == ROWS[0][0]:
+            v[0], v[1] = 0.95, np.sqrt(1 - 0.95 ** 2)
+        elif text == ROWS[1][0]:
+            v[0], v[2] = 0.3, np.sqrt(1 - 0.3 ** 2)
+        elif text == ROWS[2][0]:
+            v[0], v[3] = 0.2, np.sqrt(1 - 0.2 ** 2)
+        else:
+            v[4 + len(text) % 4] = 1.0
+        return v
+
+    def encode(self, texts, **kwargs):
+        return np.stack([self._vector(t) for t in texts])
+
+
+@pytest.fixture
+def rag(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_module, "SentenceTransformer", StubEmbedder)
+    path = tmp_path / "data.csv"
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(["instruction", "output"])
+        writer.writerows(ROWS)
+    return rag_module.WomensHealthRAG(str(path), hybrid=True)
+
+
+def test_dense_match_without_keywords_is_ranked_first(rag):
+    context = rag.retrieve_context(QUERY, top_k=3)
+    assert context[0]['question'] == ROWS[0][0]
+    assert context[0]['similarity'] == pytest.approx(0.95, abs=1e-3)
+    assert [ctx['similarity'] for ctx in context] == sorted((ctx['similarity'] for ctx in context), reverse=True)
+
+
+def test_dense_match_without_keywords_answers_directly(rag):
+    response = rag.generate_response_simple(QUERY, top_k=3)
+    assert response['response_type'] == 'direct'
+    assert response['reply'].startswith(ROWS[0][1])
+    assert response['similarity'] == pytest.approx(0.95, abs=1e-3)
+
+
+def test_batched_query_does_not_depend_on_batch_mates_k(rag):
+    # the micro-batcher hands every caller's own k to retrieve_context_batch
+    alone = [rag.retrieve_context(QUERY, top_k=k) for k in (1, 3)]
+    assert rag.retrieve_context_batch([QUERY, QUERY], top_k=[1, 3]) == alone
@@ -0,0 +1,48 @@
+# tests/test_kb_artifact.py
+# a rebuild of the same rows with a different index or without topics must not land
+# in the old version dir, where the previous build's index/topics files still are
+
+from conftest import HashEmbedder
+from chat.ann_index import IVFIndex
+from chat.bm25 import BM25Index
+from chat.kb_artifact import KBArtifact, write_artifact
+from chat.text_store import TextStore
+from chat.vectors import GrowableMatrix
+
+QUESTIONS = [f"question about topic {i}" for i in range(40)]
+ANSWERS = [f"answer {i}" for i in range(40)]
+
+
+def build(root, index=False, topics=None):
+    texts = TextStore()
+    texts.extend(QUESTIONS, ANSWERS)
+    embeddings = GrowableMatrix(HashEmbedder().encode(QUESTIONS)).view
+    bm25 = BM25Index()
+    bm25.add(texts.documents())
+    ivf = None
+    if index:
+        ivf = IVFIndex(GrowableMatrix(embeddings), nlist=4, min_rows=0)
+        ivf.build()
+    keys = [f"{i:040d}" for i in range(len(QUESTIONS))]
+    return write_artifact(str(root), texts, keys, embeddings, "stub", bm25, index=ivf,
+                          fingerprint="fp", topics=topics)
+
+
+def test_rebuild_without_index_or_topics_drops_them(tmp_path):
+    with_extras = build(tmp_path, index=True, topics=['pcos', 'menopause'] * 20)
+    artifact = KBArtifact(str(tmp_path))
+    assert artifact.index_path('ivf') is not None
+    assert artifact.topics is not None
+
+    plain = build(tmp_path)
+    assert plain != with_extras
+    artifact = KBArtifact(str(tmp_path))
+    assert artifact.index_path('ivf') is None
+    assert artifact.topics is None
+    assert artifact.verify() == []
+
+
+def test_unchanged_rebuild_reuses_its_version(tmp_path):
+    topics = ['pcos', 'menopause'] * 20
+    assert build(tmp_path, topics=topics) == build(tmp_path, topics=topics)
+    assert build(tmp_path, topics=topics) != build(tmp_path, topics=['nutrition'] * 40)
@@ -0,0 +1,47 @@
+# tests/test_shards.py
+# topic shards have to be consulted on the hybrid prefilter path too (big kbs), not
+# only when dense retrieval goes through snap.search
+
+import pytest
+
+from conftest import rag_module, write_kb
+
+TOPICS = {
+    'pcos': "pcos insulin ovary cyst androgen",
+    'menopause': "menopause hot flashes estrogen night sweats",
+}
+
+
+@pytest.fixture
+def kb_path(tmp_path):
+    rows = []
+    for topic, words in TOPICS.items():
+        for i in range(20):
+            rows.append((f"{words} question {i}", f"{topic} answer number {i}", topic))
+    return write_kb(tmp_path / "data.csv", rows, columns=("instruction", "output", "topic"))
+
+
+QUERIES = [("pcos insulin ovary question 3", 'pcos'), ("menopause hot flashes estrogen question 7", 'menopause'),
+           ("androgen cyst pcos question 11", 'pcos'), ("night sweats menopause question 2", 'menopause')]
+
+
+def test_prefilter_path_routes_through_shards(stub_embedder, kb_path):
+    rag = rag_module.WomensHealthRAG(kb_path, shards='topic', duplicate_threshold=None)
+    rag.prefilter_min_rows = 0      # every kb counts as big
+    for query, topic in QUERIES:
+        context = rag.retrieve_context(query, top_k=3)
+        assert all(ctx['answer'].startswith(topic) for ctx in context)
+
+    stats = rag.stats()['shards']
+    assert stats['routed'] + stats['fallbacks'] == len(QUERIES)
+    assert stats['routed'] > 0
+
+
+def test_prefilter_and_dense_paths_agree(stub_embedder, kb_path):
+    sharded = rag_module.WomensHealthRAG(kb_path, shards='topic', duplicate_threshold=None)
+    sharded.prefilter_min_rows = 0
+    plain = rag_module.WomensHealthRAG(kb_path, duplicate_threshold=None)
+    plain.prefilter_min_rows = 0
+    for query, _ in QUERIES:
+        assert (sharded.retrieve_context(query, top_k=1)[0]['id']
+                == plain.retrieve_context(query, top_k=1)[0]['id'])